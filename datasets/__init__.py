@@ -1,4 +1,13 @@
-from .datasets import register, make
-from . import imgrec_dataset, celeba, imagenette
-from . import learnit_shapenet, pixelnerf_shapenet, pixelnerf_dvr
-from . import co3d
+from .datasets import register, register_lazy, get, make
+
+# Modules are imported on first make() of one of their names
+register_lazy('datasets.imgrec_dataset', ['imgrec_dataset'])
+register_lazy('datasets.celeba', ['celeba'])
+register_lazy('datasets.imagenette', ['imagenette'])
+register_lazy('datasets.learnit_shapenet', ['learnit_shapenet'])
+register_lazy('datasets.pixelnerf_shapenet', ['pixelnerf_shapenet'])
+register_lazy('datasets.pixelnerf_dvr', ['pixelnerf_dvr'])
+register_lazy('datasets.nvs_shards', ['nvs_shards', 'nvs_ray_bank'])
+register_lazy('datasets.tar_shards', ['tar_imgrec', 'tar_nvs'])
+register_lazy('datasets.co3d', ['co3d_nvs'])
+register_lazy('datasets.episodic', ['object_episodes'])
@@ -9,7 +9,11 @@ from datasets import register
 @register('celeba')
 class Celeba(Dataset):
 
-    def __init__(self, root_path, split):
+    def __init__(self, root_path, split, min_size=None):
+        """
+            min_size: if set, JPEGs are decoded at the smallest power-of-two downscale keeping both sides >= min_size.
+        """
+        self.min_size = min_size
         if split == 'train':
             s, t = 1, 162770
         elif split == 'val':
@@ -25,4 +29,7 @@ class Celeba(Dataset):
         return len(self.data)
 
     def __getitem__(self, idx):
-        return Image.open(self.data[idx])
+        img = Image.open(self.data[idx])
+        if self.min_size is not None:
+            img.draft('RGB', (self.min_size, self.min_size))
+        return img
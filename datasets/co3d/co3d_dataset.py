@@ -354,50 +354,15 @@ class Co3dDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, index):
         entry = self.frame_annots[index]["frame_annotation"]
-
-        path = os.path.join(self.dataset_root, entry.image.path)
-        image = _load_image(path)
-        assert image.shape[-2:] == entry.image.size
-
-        # center crop
-        r1 = min(image.shape[-2], image.shape[-1]) // 2
-        r2 = min(image.shape[-2], image.shape[-1]) - r1
-        image = image[:,
-            image.shape[-2] // 2 - r1: image.shape[-2] // 2 + r2,
-            image.shape[-1] // 2 - r1: image.shape[-1] // 2 + r2,
-        ]
-
-        # resize and store scale
-        assert self.image_height == self.image_width
-        minscale = min(
-            self.image_height / image.shape[-2],
-            self.image_width / image.shape[-1],
+        return _load_frame(
+            os.path.join(self.dataset_root, entry.image.path),
+            entry.image.size,
+            torch.tensor(entry.viewpoint.focal_length, dtype=torch.float),
+            torch.tensor(entry.viewpoint.R, dtype=torch.float),
+            torch.tensor(entry.viewpoint.T, dtype=torch.float),
+            self.image_height,
+            self.image_width,
         )
-        mode = 'bilinear'
-        imre = torch.nn.functional.interpolate(
-            torch.from_numpy(image)[None],
-            scale_factor=minscale,
-            mode=mode,
-            align_corners=False if mode == "bilinear" else None,
-            recompute_scale_factor=True,
-        )[0]
-        imre_ = torch.zeros(image.shape[0], self.image_height, self.image_width)
-        imre_[:, 0: imre.shape[1], 0: imre.shape[2]] = imre
-        image = imre_
-        scale = minscale
-
-        # camera
-        focal_length = torch.tensor(entry.viewpoint.focal_length, dtype=torch.float)
-        half_image_size_wh_orig = torch.tensor(list(reversed(entry.image.size)), dtype=torch.float) / 2.0
-        focal_length_px = focal_length * half_image_size_wh_orig
-        focal_length = focal_length_px * scale
-
-        return {
-            'image': image,
-            'focal_length': focal_length,
-            'R': torch.tensor(entry.viewpoint.R, dtype=torch.float),
-            'T': torch.tensor(entry.viewpoint.T, dtype=torch.float),
-        }
 
     def _raw_getitem(self, index):
         assert index < len(
@@ -795,6 +760,54 @@ def _load_image(path):
     return im
 
 
+def _load_frame(path, size, focal_length, R, T, image_height, image_width):
+    """
+    Loads an image center-cropped and resized to (image_height, image_width),
+    with its focal length (NDC, as annotated) converted to pixels of the result.
+    """
+    image = _load_image(path)
+    assert image.shape[-2:] == tuple(size)
+
+    # center crop
+    r1 = min(image.shape[-2], image.shape[-1]) // 2
+    r2 = min(image.shape[-2], image.shape[-1]) - r1
+    image = image[:,
+        image.shape[-2] // 2 - r1: image.shape[-2] // 2 + r2,
+        image.shape[-1] // 2 - r1: image.shape[-1] // 2 + r2,
+    ]
+
+    # resize and store scale
+    assert image_height == image_width
+    minscale = min(
+        image_height / image.shape[-2],
+        image_width / image.shape[-1],
+    )
+    mode = 'bilinear'
+    imre = torch.nn.functional.interpolate(
+        torch.from_numpy(image)[None],
+        scale_factor=minscale,
+        mode=mode,
+        align_corners=False if mode == "bilinear" else None,
+        recompute_scale_factor=True,
+    )[0]
+    imre_ = torch.zeros(image.shape[0], image_height, image_width)
+    imre_[:, 0: imre.shape[1], 0: imre.shape[2]] = imre
+    image = imre_
+    scale = minscale
+
+    # camera
+    half_image_size_wh_orig = torch.tensor(list(reversed(size)), dtype=torch.float) / 2.0
+    focal_length_px = focal_length * half_image_size_wh_orig
+    focal_length = focal_length_px * scale
+
+    return {
+        'image': image,
+        'focal_length': focal_length,
+        'R': R,
+        'T': T,
+    }
+
+
 def _load_16big_png_depth(depth_png):
     with Image.open(depth_png) as depth_pil:
         # the image is stored with 16-bit depth but PIL reads it as I (32 bit).
@@ -4,7 +4,11 @@ import torch
 import numpy as np
 
 from .co3d_dataset import Co3dDataset
+from .frame_table import build_frame_table, Co3dFrameTable
 from datasets import register
+from datasets.view_pool import ViewDecodePool
+from datasets.meta_index import default_index_path, load_or_build_index
+from utils import imgs_to_uint8
 
 
 def make_co3d_dataset(root_path='/data/cyb/data/co3d', category='bowl', split='train_known'):
@@ -24,51 +28,60 @@ def make_co3d_dataset(root_path='/data/cyb/data/co3d', category='bowl', split='t
     )
 
 
+def load_co3d_frame_table(root_path='/data/cyb/data/co3d', category='bowl', split='train_known', index_path=None):
+    if isinstance(split, str):
+        split = [split]
+    cat_path = os.path.join(root_path, category)
+    sources = [os.path.join(cat_path, _)
+               for _ in ['frame_annotations.jgz', 'sequence_annotations.jgz', 'set_lists.json']]
+    if index_path is None:
+        index_path = default_index_path(cat_path, 'co3d_' + '_'.join(split))
+    build = lambda: build_frame_table(make_co3d_dataset(root_path, category, split))
+    return Co3dFrameTable(load_or_build_index(index_path, sources, build), root_path)
+
+
 @register('co3d_nvs')
 class Co3dNvs(torch.utils.data.Dataset):
 
-    def __init__(self, n_support, n_query, repeat=1, **kwargs):
-        ds = make_co3d_dataset(**kwargs)
+    def __init__(self, n_support, n_query, repeat=1, uint8=False, return_ids=False, decode_threads=0, index_path=None,
+                 **kwargs):
+        """
+            kwargs: root_path, category, split of make_co3d_dataset. The annotations are parsed once into a frame
+            table cached at index_path (defaults to a file in the category directory), rebuilt when they change.
+        """
+        ds = load_co3d_frame_table(index_path=index_path, **kwargs)
         self.ds = ds
         self.n_support = n_support
         self.n_query = n_query
 
-        seqs = []
-        seqs_name = []
-        cur_seq = []
-        last_name = None
-        for i in range(len(ds.frame_annots)):
-            cur_name = ds.frame_annots[i]['frame_annotation'].sequence_name
-            if last_name is None or cur_name == last_name:
-                cur_seq.append(i)
-            else:
-                seqs.append(cur_seq)
-                seqs_name.append(last_name)
-                cur_seq = [i]
-            last_name = cur_name
-        seqs.append(cur_seq)
-        seqs_name.append(last_name)
-
         self.seqs = []
         self.seqs_name = []
-        for i in range(len(seqs)):
-            if len(seqs[i]) >= self.n_support + self.n_query:
-                self.seqs.append(seqs[i])
-                self.seqs_name.append(seqs_name[i])
+        for name, seq in ds.sequences():
+            if len(seq) >= self.n_support + self.n_query:
+                self.seqs.append(seq)
+                self.seqs_name.append(name)
         print(f'{len(self.seqs)} sequences.')
 
         self.z_near = 0.2
         self.z_far = 16
         self.repeat = repeat
+        self.uint8 = uint8
+        self.return_ids = return_ids
+        self.decode_pool = ViewDecodePool(decode_threads)
 
     def __len__(self):
         return len(self.seqs) * self.repeat
 
     def __getitem__(self, idx):
         idx %= len(self.seqs)
-        seq = self.seqs[idx]
-        seq = np.random.choice(seq, self.n_support + self.n_query, replace=False)
-        seq = [self.ds[i] for i in seq]
+        view_ids = self.sample_view_ids(idx, self.n_support + self.n_query)
+        return self.make_result(idx, view_ids, self.load_views(idx, view_ids))
+
+    def sample_view_ids(self, idx, n):
+        return np.random.choice(len(self.seqs[idx]), n, replace=False)
+
+    def load_views(self, idx, view_ids):
+        seq = self.decode_pool.map(lambda i: self.ds[self.seqs[idx][i]], view_ids)
         imgs = []
         poses = []
         focals = []
@@ -82,12 +95,32 @@ class Co3dNvs(torch.utils.data.Dataset):
             r[:, 2] *= -1
             poses.append(torch.cat([r, t.unsqueeze(-1)], dim=1))
             focals.append(x['focal_length'])
+        return {'imgs': torch.stack(imgs), 'poses': torch.stack(poses), 'focals': torch.stack(focals)}
 
-        imgs = torch.stack(imgs)
-        poses = torch.stack(poses)
-        focals = torch.stack(focals)
-        t = self.n_support
+    def load_object(self, idx):
+        """
+            Load all frames of a sequence, for scripts/pack_tar_shards.py. Focal lengths are kept in their
+            NDC units and the principal point is stored as 0.
+        """
+        idx %= len(self.seqs)
+        views = self.load_views(idx, np.arange(len(self.seqs[idx])))
         return {
+            'key': self.seqs_name[idx],
+            'cat': None,
+            'imgs': views['imgs'],
+            'masks': None,
+            'poses': views['poses'],
+            'intrinsics': torch.cat([views['focals'], torch.zeros_like(views['focals'])], dim=1),
+            'near': self.z_near,
+            'far': self.z_far,
+        }
+
+    def make_result(self, idx, view_ids, views):
+        imgs, poses, focals = views['imgs'], views['poses'], views['focals']
+        if self.uint8:
+            imgs = imgs_to_uint8(imgs)
+        t = self.n_support
+        result = {
             'support_imgs': imgs[:t],
             'support_poses': poses[:t],
             'support_focals': focals[:t],
@@ -97,3 +130,7 @@ class Co3dNvs(torch.utils.data.Dataset):
             'near': self.z_near,
             'far': self.z_far,
         }
+        if self.return_ids:
+            result['obj_id'] = idx
+            result['query_view_ids'] = torch.as_tensor(np.asarray(view_ids)[t:])
+        return result
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import torch
+
+from .co3d_dataset import _load_frame
+
+
+def build_frame_table(ds):
+    """
+        Columnar arrays of the frames of a Co3dDataset (after its subset filters), with the runs of consecutive
+        frames of the same sequence as seq_offsets (n_seqs + 1,) and seq_names.
+    """
+    annots = [frame['frame_annotation'] for frame in ds.frame_annots]
+    names = np.array([a.sequence_name for a in annots])
+    starts = np.flatnonzero(np.concatenate([[True], names[1:] != names[:-1]])) if len(names) > 0 else np.zeros(0, int)
+    return {
+        'image_path': np.array([a.image.path for a in annots]),
+        'image_size': np.array([a.image.size for a in annots], dtype=np.int64).reshape(-1, 2),
+        'focal_length': np.array([a.viewpoint.focal_length for a in annots], dtype=np.float32).reshape(-1, 2),
+        'principal_point': np.array([a.viewpoint.principal_point for a in annots], dtype=np.float32).reshape(-1, 2),
+        'R': np.array([a.viewpoint.R for a in annots], dtype=np.float32).reshape(-1, 3, 3),
+        'T': np.array([a.viewpoint.T for a in annots], dtype=np.float32).reshape(-1, 3),
+        'seq_offsets': np.append(starts, len(annots)).astype(np.int64),
+        'seq_names': names[starts],
+        'image_hw': (ds.image_height, ds.image_width),
+    }
+
+
+class Co3dFrameTable(torch.utils.data.Dataset):
+    """
+        Frames of a table built by build_frame_table, items are the same as Co3dDataset.__getitem__.
+    """
+
+    def __init__(self, table, dataset_root):
+        self.table = table
+        self.dataset_root = dataset_root
+
+    def __len__(self):
+        return len(self.table['image_path'])
+
+    def sequences(self):
+        """
+            Returns a list of (sequence name, range of frame indices).
+        """
+        offsets = self.table['seq_offsets'].tolist()
+        return [(str(name), range(offsets[i], offsets[i + 1])) for i, name in enumerate(self.table['seq_names'])]
+
+    def __getitem__(self, index):
+        t = self.table
+        return _load_frame(
+            os.path.join(self.dataset_root, str(t['image_path'][index])),
+            t['image_size'][index].tolist(),
+            torch.from_numpy(t['focal_length'][index].copy()),
+            torch.from_numpy(t['R'][index].copy()),
+            torch.from_numpy(t['T'][index].copy()),
+            *t['image_hw'],
+        )
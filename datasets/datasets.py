@@ -1,7 +1,9 @@
 import copy
+import importlib
 
 
 datasets = {}
+lazy_datasets = {}
 
 
 def register(name):
@@ -11,11 +13,25 @@ def register(name):
     return decorator
 
 
+def register_lazy(module, names):
+    """
+        Names registered in module, which is imported on first use of one of them.
+    """
+    for name in names:
+        lazy_datasets[name] = module
+
+
+def get(name):
+    if name not in datasets and name in lazy_datasets:
+        importlib.import_module(lazy_datasets[name])
+    return datasets[name]
+
+
 def make(dataset_spec, args=None):
     if args is not None:
         dataset_args = copy.deepcopy(dataset_spec['args'])
         dataset_args.update(args)
     else:
         dataset_args = dataset_spec['args']
-    dataset = datasets[dataset_spec['name']](**dataset_args)
+    dataset = get(dataset_spec['name'])(**dataset_args)
     return dataset
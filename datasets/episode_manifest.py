@@ -0,0 +1,40 @@
+import json
+
+import numpy as np
+
+
+def make_manifest(dataset, seed=0, n_episodes=None):
+    """
+        Draws a fixed list of episodes with the view selection of the dataset (sample_view_ids), seeded.
+        Returns a dict of n_support, n_query and episodes [{'key', 'support', 'query'}], objects are cycled
+        as with repeat.
+    """
+    n_objects = len(dataset.index)
+    if n_episodes is None:
+        n_episodes = len(dataset)
+    state = np.random.get_state()
+    np.random.seed(seed)
+    episodes = []
+    for i in range(n_episodes):
+        index = i % n_objects
+        view_ids = [int(_) for _ in dataset.sample_view_ids(index, dataset.n_support + dataset.n_query)]
+        episodes.append({
+            'key': dataset.object_key(index),
+            'support': view_ids[:dataset.n_support],
+            'query': view_ids[dataset.n_support:],
+        })
+    np.random.set_state(state)
+    return {'seed': seed, 'n_support': dataset.n_support, 'n_query': dataset.n_query, 'episodes': episodes}
+
+
+def load_manifest(path, dataset):
+    """
+        Returns the episodes of a manifest written by scripts/make_eval_manifest.py as a list of
+        (object index, view ids) of the dataset.
+    """
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    assert (manifest['n_support'], manifest['n_query']) == (dataset.n_support, dataset.n_query), \
+        f'manifest {path} has n_support={manifest["n_support"]}, n_query={manifest["n_query"]}'
+    key2index = {dataset.object_key(i): i for i in range(len(dataset.index))}
+    return [(key2index[ep['key']], np.array(ep['support'] + ep['query'])) for ep in manifest['episodes']]
@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+
+import datasets
+from datasets import register
+
+
+def select_views(views, sel):
+    ret = dict()
+    for k, v in views.items():
+        if isinstance(v, torch.Tensor):
+            v = v[torch.from_numpy(sel)]
+        elif v is not None:
+            v = v[sel]
+        ret[k] = v
+    return ret
+
+
+@register('object_episodes')
+class ObjectEpisodes(Dataset):
+    """
+        Wraps an NVS dataset (with sample_view_ids, load_views and make_result), loads a pool of pool_size views
+        of an object once and draws n_episodes (support, query) episodes from it.
+        Each group of n_episodes consecutive indices shares a pool, the last pool is cached per worker.
+        Use with GroupedSampler and a per-GPU batch size divisible by n_episodes so that a group stays in one batch.
+        An epoch has the same number of episodes as the wrapped dataset (rounded up to whole groups).
+
+        Cfg example:
+
+        train_dataset:
+            name: object_episodes
+            args:
+                dataset: {name: pixelnerf_shapenet, args: {..., repeat: 16}}
+                pool_size: 12
+                n_episodes: 4
+            loader: {batch_size: , num_workers: }
+    """
+
+    def __init__(self, dataset, pool_size, n_episodes):
+        self.dataset = datasets.make(dataset)
+        assert getattr(self.dataset, 'support_lst', None) is None
+        assert pool_size >= self.dataset.n_support + self.dataset.n_query
+        self.n_objects = len(self.dataset) // self.dataset.repeat
+        self.pool_size = pool_size
+        self.n_episodes = n_episodes
+        self.group_size = n_episodes
+        self.n_groups = math.ceil(len(self.dataset) / n_episodes)
+        self.pool = None
+
+    def __len__(self):
+        return self.n_groups * self.n_episodes
+
+    def __getitem__(self, idx):
+        group = idx // self.n_episodes
+        if self.pool is None or self.pool[0] != group:
+            obj = group % self.n_objects
+            view_ids = np.asarray(self.dataset.sample_view_ids(obj, self.pool_size))
+            self.pool = (group, obj, view_ids, self.dataset.load_views(obj, view_ids))
+        _, obj, view_ids, views = self.pool
+
+        sel = np.random.choice(self.pool_size, self.dataset.n_support + self.dataset.n_query, replace=False)
+        return self.dataset.make_result(obj, view_ids[sel], select_views(views, sel))
+
+
+class GroupedSampler(Sampler):
+    """
+        Shuffles groups of group_size consecutive indices and keeps each group contiguous.
+        For distributed training, groups are split over replicas (padded to be divisible as in DistributedSampler).
+    """
+
+    def __init__(self, dataset, group_size, shuffle=True, num_replicas=1, rank=0, seed=0):
+        self.n = len(dataset)
+        assert self.n % group_size == 0
+        self.group_size = group_size
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        n_groups = self.n // group_size
+        self.groups_per_replica = math.ceil(n_groups / num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        n_groups = self.n // self.group_size
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            groups = torch.randperm(n_groups, generator=g).tolist()
+        else:
+            groups = list(range(n_groups))
+        total = self.groups_per_replica * self.num_replicas
+        groups = (groups * math.ceil(total / n_groups))[:total]
+        for group in groups[self.rank: total: self.num_replicas]:
+            yield from range(group * self.group_size, (group + 1) * self.group_size)
+
+    def __len__(self):
+        return self.groups_per_replica * self.group_size
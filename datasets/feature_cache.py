@@ -0,0 +1,47 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+
+class FeatureCache():
+    """
+        Per-view encoder features of a dataset stored as fp16 memory-mapped files, built by scripts/build_feature_cache.py.
+
+        Layout of root_path:
+            index.json: {'levels': [[C, h, w], ...], 'n_views': N, 'objects': {key: [offset, n_views]}}
+            level{i}.bin: (N, C, h, w) float16, views of an object are consecutive from its offset.
+    """
+
+    def __init__(self, root_path):
+        self.root_path = root_path
+        with open(os.path.join(root_path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.levels = [tuple(_) for _ in index['levels']]
+        self.n_views = index['n_views']
+        self.objects = index['objects']
+        self.feats = None
+
+    def _open(self):
+        # Opened lazily so that each DataLoader worker maps the files itself
+        self.feats = []
+        for i, shape in enumerate(self.levels):
+            path = os.path.join(self.root_path, f'level{i}.bin')
+            self.feats.append(np.memmap(path, dtype=np.float16, mode='r', shape=(self.n_views, *shape)))
+
+    def get(self, key, view_ids):
+        """
+            Returns:
+                list of (len(view_ids), C, h, w) float16 tensors, one per level.
+        """
+        if self.feats is None:
+            self._open()
+        offset, n = self.objects[key]
+        view_ids = np.asarray(view_ids)
+        assert (view_ids < n).all()
+        return [torch.from_numpy(np.ascontiguousarray(f[offset + view_ids])) for f in self.feats]
+
+
+def feature_cache_items(feature_cache, key, view_ids, prefix='support_feats'):
+    return {f'{prefix}_{i}': x for i, x in enumerate(feature_cache.get(key, view_ids))}
@@ -7,10 +7,24 @@ from torchvision import transforms
 from datasets import register
 
 
+def make_augment(augment):
+    if augment == 'none':
+        return transforms.Compose([])
+    elif augment == 'random_crop_178':
+        return transforms.Compose([
+            transforms.RandomCrop(178),
+            transforms.RandomHorizontalFlip(),
+        ])
+
+
 @register('imagenette')
 class Imagenette(Dataset):
 
-    def __init__(self, root_path, split, augment):
+    def __init__(self, root_path, split, augment, min_size=None):
+        """
+            min_size: if set, JPEGs are decoded at the smallest power-of-two downscale keeping both sides >= min_size.
+            Only used with augment none, since the crops of the augmentation are in source pixels.
+        """
         root_path = os.path.join(root_path, split)
         classes = sorted(os.listdir(root_path))
         self.data = []
@@ -18,16 +32,14 @@ class Imagenette(Dataset):
             filenames = sorted(os.listdir(os.path.join(root_path, c)))
             for f in filenames:
                 self.data.append(os.path.join(root_path, c, f))
-        if augment == 'none':
-            self.transform = transforms.Compose([])
-        elif augment == 'random_crop_178':
-            self.transform = transforms.Compose([
-                transforms.RandomCrop(178),
-                transforms.RandomHorizontalFlip(),
-            ])
+        self.transform = make_augment(augment)
+        self.min_size = min_size if augment == 'none' else None
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
-        return self.transform(Image.open(self.data[idx]).convert('RGB'))
+        img = Image.open(self.data[idx])
+        if self.min_size is not None:
+            img.draft('RGB', (self.min_size, self.min_size))
+        return self.transform(img.convert('RGB'))
@@ -1,3 +1,8 @@
+import os
+import json
+
+import numpy as np
+import torch
 from torch.utils.data import Dataset
 from torchvision import transforms
 
@@ -8,17 +13,45 @@ from datasets import register
 @register('imgrec_dataset')
 class ImgrecDataset(Dataset):
 
-    def __init__(self, imageset, width):
-        self.imageset = datasets.make(imageset)
+    def __init__(self, imageset, width, uint8=False, draft=False, cache_path=None):
+        """
+            draft: let the imageset (celeba, imagenette) decode JPEGs at a reduced size that still covers width.
+            cache_path: a cache of transformed images built by scripts/build_imgrec_cache.py, used when present.
+                It must have been built from the same imageset args (except root_path), without augmentation.
+        """
+        self.imageset = datasets.make(imageset, args=({'min_size': width} if draft else None))
         self.transform = transforms.Compose([
             transforms.Resize(width),
             transforms.CenterCrop(width),
-            transforms.ToTensor(),
+            transforms.PILToTensor() if uint8 else transforms.ToTensor(),
         ])
+        self.uint8 = uint8
+
+        self.cache = None
+        if cache_path is not None and os.path.exists(os.path.join(cache_path, 'meta.json')):
+            with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            assert imageset['args'].get('augment', 'none') == 'none', \
+                f'cache {cache_path} holds fixed images, the imageset must not augment'
+            def strip(args):
+                args = {k: v for k, v in args.items() if k not in ['root_path', 'min_size']}
+                args.setdefault('augment', 'none')
+                return args
+            assert meta['width'] == width and meta['n'] == len(self.imageset) \
+                and meta['imageset']['name'] == imageset['name'] \
+                and strip(meta['imageset']['args']) == strip(imageset['args']), \
+                f'cache {cache_path} does not match the dataset'
+            self.cache = np.memmap(os.path.join(cache_path, 'imgs.bin'), dtype=np.uint8, mode='r',
+                                   shape=(meta['n'], 3, width, width))
 
     def __len__(self):
         return len(self.imageset)
 
     def __getitem__(self, idx):
-        x = self.transform(self.imageset[idx])
+        if self.cache is not None:
+            x = torch.from_numpy(np.array(self.cache[idx]))
+            if not self.uint8:
+                x = x.float() / 255
+        else:
+            x = self.transform(self.imageset[idx])
         return {'inp': x, 'gt': x}
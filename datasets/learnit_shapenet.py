@@ -2,6 +2,7 @@
 
 import os
 import json
+import glob
 
 import imageio
 import numpy as np
@@ -10,65 +11,108 @@ import einops
 from torch.utils.data import Dataset
 
 from datasets import register
+from utils import imgs_to_uint8
+from .feature_cache import FeatureCache, feature_cache_items
+from .meta_index import default_index_path, load_or_build_index, mask_to_bbox
+from .view_pool import ViewDecodePool
+from .episode_manifest import load_manifest
 
 
 @register('learnit_shapenet')
 class LearnitShapenet(Dataset):
 
     def __init__(self, root_path, category, split, n_support, n_query,
-                 views_rng=None, repeat=1):
-        with open(os.path.join(root_path, category[:-1] + '_splits.json'), 'r') as f:
-            obj_ids = json.load(f)[split]
+                 views_rng=None, repeat=1, feature_cache=None, index_path=None, uint8=False,
+                 return_ids=False, decode_threads=0, manifest=None):
+        splits_path = os.path.join(root_path, category[:-1] + '_splits.json')
+        if index_path is None:
+            index_path = default_index_path(root_path, f'{category}_{split}')
+        self.split = split
+        self.splits_path = splits_path
         root_path = os.path.join(root_path, category)
+        self.root_path = root_path
 
-        _data = [os.path.join(root_path, _) for _ in obj_ids]
-        self.data = []
-        for x in _data:
-            if os.path.exists(os.path.join(x, 'transforms.json')):
-                self.data.append(x)
-            else:
-                print(f'Missing obj at {x}, skipped.')
+        # Object dirs (with the frames) change mtime when frames are added, removed or renamed
+        sources = [splits_path, root_path] + sorted(
+            glob.glob(os.path.join(root_path, '*', '')) + glob.glob(os.path.join(root_path, '*', 'transforms.json')))
+        self.index = load_or_build_index(index_path, sources, self.build_index)
+        self.data = [os.path.join(root_path, _['key']) for _ in self.index]
 
         self.n_support = n_support
         self.n_query = n_query
         self.views_rng = views_rng
         self.repeat = repeat
+        self.feature_cache = FeatureCache(feature_cache) if feature_cache is not None else None
+        self.uint8 = uint8
+        self.return_ids = return_ids
+        self.decode_pool = ViewDecodePool(decode_threads)
+        self.episodes = load_manifest(manifest, self) if manifest is not None else None
 
     def __len__(self):
+        if self.episodes is not None:
+            return len(self.episodes)
         return len(self.data) * self.repeat
 
+    def build_index(self):
+        """
+            Per object: frame file names, 4x4 poses, camera_angle_x and foreground bboxes from the alpha channel.
+        """
+        with open(self.splits_path, 'r') as f:
+            obj_ids = json.load(f)[self.split]
+
+        index = []
+        for obj_id in obj_ids:
+            x = os.path.join(self.root_path, obj_id)
+            if not os.path.exists(os.path.join(x, 'transforms.json')):
+                print(f'Missing obj at {x}, skipped.')
+                continue
+            with open(os.path.join(x, 'transforms.json'), 'r') as fp:
+                meta = json.load(fp)
+            frames = [os.path.basename(frame['file_path']) + '.png' for frame in meta['frames']]
+            bboxes = []
+            for fname in frames:
+                bbox = mask_to_bbox(imageio.imread(os.path.join(x, fname))[..., -1] > 0)
+                bboxes.append(bbox if bbox is not None else np.zeros(4, dtype=np.float32))
+            index.append({
+                'key': obj_id,
+                'frames': frames,
+                'poses': np.array([frame['transform_matrix'] for frame in meta['frames']], dtype=np.float32),
+                'camera_angle_x': float(meta['camera_angle_x']),
+                'bboxes': np.stack(bboxes),
+            })
+        return index
+
     def __getitem__(self, idx):
+        if self.episodes is not None:
+            idx, view_ids = self.episodes[idx]
+            return self.make_result(idx, view_ids, self.load_views(idx, view_ids))
         idx %= len(self.data)
+        view_ids = self.sample_view_ids(idx, self.n_support + self.n_query)
+        return self.make_result(idx, view_ids, self.load_views(idx, view_ids))
 
-        train_ex_dir = self.data[idx]
-        with open(os.path.join(train_ex_dir, 'transforms.json'), 'r') as fp:
-            meta = json.load(fp)
-        camera_angle_x = float(meta['camera_angle_x'])
-        frames = meta['frames']
-
+    def sample_view_ids(self, idx, n):
+        view_ids = np.arange(len(self.index[idx]['frames']))
         if self.views_rng is not None:
             s, t = self.views_rng
-            frames = frames[s: t]
-
-        frames = np.random.choice(frames, self.n_support + self.n_query, replace=False)
-
-        imgs = []
-        poses = []
-        for frame in frames:
-            fname = os.path.join(train_ex_dir, os.path.basename(frame['file_path']) + '.png')
-            imgs.append(imageio.imread(fname))
-            poses.append(np.array(frame['transform_matrix']))
-        H, W = imgs[0].shape[:2]
-        focal = .5 * W / np.tan(.5 * camera_angle_x)
-        imgs = (np.array(imgs) / 255.).astype(np.float32)
-        imgs = imgs[..., :3] * imgs[..., -1:] + 1 - imgs[..., -1:]
-        poses = np.array(poses).astype(np.float32)
+            view_ids = view_ids[s: t]
+        return np.random.choice(view_ids, n, replace=False)
 
-        imgs = einops.rearrange(torch.from_numpy(imgs), 'n h w c -> n c h w')
-        poses = torch.from_numpy(poses)[:, :3, :4]
+    def load_views(self, idx, view_ids):
+        obj = self.index[idx]
+        imgs = self.load_imgs(self.data[idx], [obj['frames'][i] for i in view_ids])
+        H, W = imgs.shape[-2:]
+        focal = .5 * W / np.tan(.5 * obj['camera_angle_x'])
+
+        poses = torch.from_numpy(obj['poses'][view_ids])[:, :3, :4]
         focal = torch.ones(len(poses), 2) * float(focal)
+        return {'imgs': imgs, 'poses': poses, 'focals': focal}
+
+    def make_result(self, idx, view_ids, views):
+        imgs, poses, focal = views['imgs'], views['poses'], views['focals']
+        if self.uint8:
+            imgs = imgs_to_uint8(imgs)
         t = self.n_support
-        return {
+        result = {
             'support_imgs': imgs[:t],
             'support_poses': poses[:t],
             'support_focals': focal[:t],
@@ -78,3 +122,51 @@ class LearnitShapenet(Dataset):
             'near': 2,
             'far': 6,
         }
+        if self.feature_cache is not None:
+            result.update(feature_cache_items(self.feature_cache, self.object_key(idx), view_ids[:t]))
+        if self.return_ids:
+            result['obj_id'] = idx
+            result['query_view_ids'] = torch.as_tensor(np.asarray(view_ids)[t:])
+        return result
+
+    def load_imgs(self, ex_dir, frames, ret_alpha=False):
+        imgs = self.decode_pool.map(lambda frame: imageio.imread(os.path.join(ex_dir, frame)), frames)
+        imgs = (np.array(imgs) / 255.).astype(np.float32)
+        alpha = imgs[..., -1]
+        imgs = imgs[..., :3] * imgs[..., -1:] + 1 - imgs[..., -1:]
+        imgs = einops.rearrange(torch.from_numpy(imgs), 'n h w c -> n c h w')
+        if ret_alpha:
+            return imgs, torch.from_numpy(alpha)
+        return imgs
+
+    def object_key(self, idx):
+        return os.path.relpath(self.data[idx % len(self.data)], self.root_path)
+
+    def load_object_views(self, idx):
+        """
+            Load all views of an object in transforms.json order, preprocessed as in __getitem__.
+            Returns: (object key, images (N, 3, H, W))
+        """
+        idx %= len(self.data)
+        return self.object_key(idx), self.load_imgs(self.data[idx], self.index[idx]['frames'])
+
+    def load_object(self, idx):
+        """
+            Load all views of an object with cameras, for scripts/pack_nvs_shards.py.
+            Returns: dict of key, imgs (N, 3, H, W), masks (N, H, W), poses (N, 3, 4), intrinsics (N, 4) as fx, fy, cx, cy
+        """
+        idx %= len(self.data)
+        obj = self.index[idx]
+        imgs, alpha = self.load_imgs(self.data[idx], obj['frames'], ret_alpha=True)
+        H, W = imgs.shape[-2:]
+        focal = .5 * W / np.tan(.5 * obj['camera_angle_x'])
+        intrinsics = torch.tensor([focal, focal, W / 2, H / 2], dtype=torch.float32).repeat(len(imgs), 1)
+        return {
+            'key': self.object_key(idx),
+            'imgs': imgs,
+            'masks': alpha > 0,
+            'poses': torch.from_numpy(obj['poses'])[:, :3, :4],
+            'intrinsics': intrinsics,
+            'near': 2,
+            'far': 6,
+        }
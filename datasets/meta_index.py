@@ -0,0 +1,89 @@
+import os
+import pickle
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+INDEX_VERSION = 3
+
+
+def default_index_path(root_path, tag):
+    return os.path.join(root_path, f'.trans_inr_index_{tag}.pkl')
+
+
+def load_or_build_index(index_path, sources, build_fn):
+    """
+        Load a dataset metadata index from index_path, or build it with build_fn() and save it.
+        The saved index is invalidated when the mtime of any path in sources changes,
+        so index_path should not be inside a source directory. A directory's mtime only changes when entries
+        are added, removed or renamed, not when files below it are rewritten in place.
+        If index_path is not writable, the index is only kept in memory.
+        Under DDP, rank 0 builds the index while the other ranks wait and then load it (all ranks must call this
+        for the same datasets in the same order), the others only build it themselves if it could not be saved.
+    """
+    mtimes = [os.path.getmtime(_) for _ in sources]
+    distributed = dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+    if distributed and dist.get_rank() != 0:
+        dist.barrier()
+        index = _load_index(index_path, mtimes)
+        return index if index is not None else build_fn()
+
+    index = _load_index(index_path, mtimes)
+    if index is None:
+        index = _build_and_save_index(index_path, mtimes, build_fn)
+    if distributed:
+        dist.barrier()
+    return index
+
+
+def _load_index(index_path, mtimes):
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'rb') as f:
+                cached = pickle.load(f)
+            if cached['version'] == INDEX_VERSION and cached['mtimes'] == mtimes:
+                return cached['index']
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+            pass
+    return None
+
+
+def _build_and_save_index(index_path, mtimes, build_fn):
+    index = build_fn()
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'version': INDEX_VERSION, 'mtimes': mtimes, 'index': index}, f)
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f'Cannot save dataset index to {index_path}: {e}')
+    return index
+
+
+def foreground_mask(imgs, channel_dim=-1):
+    """
+        Foreground of images on a white background: pixels with any channel below white (255 for uint8, else 1),
+        as in the adaptive ray sampling of NvsTrainer. Takes numpy arrays or tensors, reduces channel_dim.
+    """
+    white = 255 if imgs.dtype in (np.uint8, torch.uint8) else 1
+    return (imgs < white).any(channel_dim)
+
+
+def mask_to_bbox(mask):
+    """
+        Args:
+            mask: (H, W) or (H, W, 1) array
+        Returns:
+            [cmin, rmin, cmax, rmax] as float32, or None if the mask is empty.
+    """
+    if mask.ndim == 3:
+        mask = mask[..., 0]
+    rnz = np.where(np.any(mask, axis=1))[0]
+    cnz = np.where(np.any(mask, axis=0))[0]
+    if len(rnz) == 0:
+        return None
+    rmin, rmax = rnz[[0, -1]]
+    cmin, cmax = cnz[[0, -1]]
+    return np.array([cmin, rmin, cmax, rmax], dtype=np.float32)
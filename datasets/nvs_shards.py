@@ -0,0 +1,286 @@
+import os
+import copy
+import json
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset
+
+from datasets import register
+from .pixelnerf_dvr import color_jitter_augment
+from .query_pixels import SharedRatio
+from utils import imgs_to_uint8
+
+
+def pack_object(obj, image_size=None):
+    """
+        Converts the result of load_object() of an NVS dataset to packed arrays, resized to image_size (H, W) if given.
+        Returns: imgs (N, H, W, 3) uint8, masks (N, H, W) uint8 or None, cams (N, 16) float32
+    """
+    imgs, masks, intrinsics = obj['imgs'], obj['masks'], obj['intrinsics']
+    if image_size is not None and list(imgs.shape[-2:]) != list(image_size):
+        H, W = image_size
+        scale = torch.tensor([W / imgs.shape[-1], H / imgs.shape[-2]])
+        intrinsics = intrinsics * scale.repeat(2)
+        imgs = F.interpolate(imgs, size=(H, W), mode='area')
+        if masks is not None:
+            masks = F.interpolate(masks[:, None].float(), size=(H, W), mode='area')[:, 0] > 0.5
+
+    imgs = imgs_to_uint8(imgs).permute(0, 2, 3, 1).numpy()
+    if masks is not None:
+        masks = masks.to(torch.uint8).numpy()
+    cams = torch.cat([obj['poses'].reshape(-1, 12), intrinsics], dim=1).numpy().astype(np.float32)
+    return imgs, masks, cams
+
+
+@register('nvs_shards')
+class NvsShards(Dataset):
+    """
+        Multi-view dataset packed by scripts/pack_nvs_shards.py, views are sliced from memory maps without decoding.
+
+        Layout of root_path:
+            meta.json: {'image_size': [H, W], 'near', 'far', 'avg_intrinsics', 'has_masks', 'cats',
+                        'shards': [n_views of each shard], 'objects': [{'key', 'cat', 'shard', 'offset', 'n'}]}
+            shard{k}.imgs.bin: (n_views, H, W, 3) uint8
+            shard{k}.masks.bin: (n_views, H, W) uint8, if has_masks
+            shard{k}.cams.npy: (n_views, 16) float32, flattened 3x4 pose and fx, fy, cx, cy
+        Views of an object are consecutive from its offset in its shard.
+    """
+
+    def __init__(self, root_path, n_support, n_query, support_lst=None, viewrng=None, repeat=1,
+                 retcat=False, color_jitter=False, return_masks=False, uint8=False, return_ids=False):
+        self.root_path = root_path
+        with open(os.path.join(root_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.image_size = tuple(meta['image_size'])
+        self.near = meta['near']
+        self.far = meta['far']
+        self.avg_intrinsics = meta['avg_intrinsics']
+        self.has_masks = meta['has_masks']
+        self.cats = meta['cats']
+        self.cat2int = {c: i for i, c in enumerate(self.cats)}
+        self.shard_sizes = meta['shards']
+        self.objects = meta['objects']
+        self.has_ray_bank = meta.get('ray_bank', False)
+
+        self.n_support = n_support
+        self.n_query = n_query
+        self.support_lst = support_lst
+        if support_lst is not None:
+            assert len(support_lst) == n_support
+        self.viewrng = viewrng
+        self.repeat = repeat
+        self.retcat = retcat
+        self.color_jitter = color_jitter
+        self.return_masks = return_masks
+        self.uint8 = uint8
+        self.return_ids = return_ids
+        assert not return_masks or self.has_masks
+
+        self.shards = None
+
+    def _open(self):
+        # Opened lazily so that each DataLoader worker maps the files itself
+        H, W = self.image_size
+        self.shards = []
+        for k, n in enumerate(self.shard_sizes):
+            prefix = os.path.join(self.root_path, f'shard{k}')
+            shard = {
+                'imgs': np.memmap(prefix + '.imgs.bin', dtype=np.uint8, mode='r', shape=(n, H, W, 3)),
+                'cams': np.load(prefix + '.cams.npy', mmap_mode='r'),
+            }
+            if self.has_masks:
+                shard['masks'] = np.memmap(prefix + '.masks.bin', dtype=np.uint8, mode='r', shape=(n, H, W))
+            self.shards.append(shard)
+
+    def __len__(self):
+        return len(self.objects) * self.repeat
+
+    def __getitem__(self, idx):
+        idx %= len(self.objects)
+        view_ids = self.sample_view_ids(idx, self.n_support + self.n_query)
+        return self.make_result(idx, view_ids, self.load_views(idx, view_ids))
+
+    def make_result(self, idx, view_ids, views):
+        imgs = views['imgs']
+        if self.color_jitter or not self.uint8:
+            imgs = imgs.float() / 255
+        if self.color_jitter:
+            imgs = color_jitter_augment(imgs)
+            if self.uint8:
+                imgs = imgs_to_uint8(imgs)
+        focals = views['focals']
+        if self.avg_intrinsics:
+            focals = focals.mean(dim=0, keepdim=True).expand(len(focals), -1)
+
+        t = self.n_support
+        result = {
+            'support_imgs': imgs[:t],
+            'support_poses': views['poses'][:t],
+            'support_focals': focals[:t],
+            'query_imgs': imgs[t:],
+            'query_poses': views['poses'][t:],
+            'query_focals': focals[t:],
+            'near': self.near,
+            'far': self.far,
+        }
+        if self.return_masks:
+            result['support_masks'] = views['masks'][:t]
+            result['query_masks'] = views['masks'][t:]
+        if self.retcat:
+            result['cat'] = self.cat2int[self.objects[idx]['cat']]
+        if self.return_ids:
+            result['obj_id'] = idx
+            result['query_view_ids'] = torch.as_tensor(np.asarray(view_ids)[t:])
+        return result
+
+    def sample_view_ids(self, idx, n):
+        view_ids = np.arange(self.objects[idx]['n'])
+        if self.viewrng is not None:
+            l, r = self.viewrng
+            view_ids = view_ids[l: r]
+
+        if self.support_lst is None:
+            inds = np.random.choice(len(view_ids), n, replace=False)
+        else:
+            rest_inds = [i for i in range(len(view_ids)) if i not in self.support_lst]
+            rest_inds = np.random.choice(rest_inds, n - self.n_support, replace=False).tolist()
+            inds = self.support_lst + rest_inds
+        return view_ids[inds]
+
+    def load_views(self, idx, view_ids):
+        """
+            Returns:
+                dict of imgs (N, 3, H, W) uint8, poses (N, 3, 4), focals (N, 2), c (N, 2) and masks (N, H, W) if available.
+        """
+        if self.shards is None:
+            self._open()
+        obj = self.objects[idx]
+        shard = self.shards[obj['shard']]
+        view_ids = np.asarray(view_ids)
+        assert (view_ids < obj['n']).all()
+        inds = obj['offset'] + view_ids
+
+        imgs = torch.from_numpy(np.ascontiguousarray(shard['imgs'][inds])).permute(0, 3, 1, 2)
+        cams = torch.from_numpy(np.ascontiguousarray(shard['cams'][inds]))
+        ret = {
+            'imgs': imgs,
+            'poses': cams[:, :12].view(-1, 3, 4),
+            'focals': cams[:, 12: 14],
+            'c': cams[:, 14: 16],
+        }
+        if self.has_masks:
+            ret['masks'] = torch.from_numpy(np.ascontiguousarray(shard['masks'][inds])).bool()
+        return ret
+
+    def object_key(self, idx):
+        return self.objects[idx % len(self.objects)]['key']
+
+    def load_object_views(self, idx):
+        idx %= len(self.objects)
+        imgs = self.load_views(idx, np.arange(self.objects[idx]['n']))['imgs']
+        return self.object_key(idx), imgs.float() / 255
+
+    def load_object(self, idx):
+        idx %= len(self.objects)
+        obj = self.objects[idx]
+        views = self.load_views(idx, np.arange(obj['n']))
+        return {
+            'key': obj['key'],
+            'cat': obj['cat'],
+            'imgs': views['imgs'].float() / 255,
+            'masks': views.get('masks'),
+            'poses': views['poses'],
+            'intrinsics': torch.cat([views['focals'], views['c']], dim=1),
+            'near': self.near,
+            'far': self.far,
+        }
+
+
+@register('nvs_ray_bank')
+class NvsRayBank(NvsShards):
+    """
+        nvs_shards with a ray bank added by scripts/build_ray_bank.py, query views are returned as n_rays sampled rays
+        (query_rays_o, query_rays_d in fp16, query_rgbs) instead of whole images.
+        fg_ratio of the rays are sampled from foreground pixels (with replacement if not enough), NvsTrainer sets it
+        with set_fg_ratio() to 0.5 up to adaptive_sample_epoch (as its own adaptive sampling) and back after.
+        The ray bank stores per pixel:
+            shard{k}.rays_d.bin: (n_views * H * W, 3) float16
+            shard{k}.fg.bin: (n_views * H * W) uint8
+        rays_o is the camera position of each view, taken from cams.
+    """
+
+    def __init__(self, root_path, n_support, n_query, n_rays, fg_ratio=0, **kwargs):
+        super().__init__(root_path, n_support, n_query, **kwargs)
+        assert self.has_ray_bank
+        assert not self.color_jitter # would only apply to support images
+        self.n_rays = n_rays
+        self.fg_ratio = SharedRatio(fg_ratio)
+
+    def set_fg_ratio(self, ratio=None):
+        """
+            Set fg_ratio for the following epochs (also in loader workers), None restores the one from args.
+        """
+        self.fg_ratio.set(ratio)
+
+    def _open(self):
+        super()._open()
+        H, W = self.image_size
+        for k, (n, shard) in enumerate(zip(self.shard_sizes, self.shards)):
+            prefix = os.path.join(self.root_path, f'shard{k}')
+            shard['rays_d'] = np.memmap(prefix + '.rays_d.bin', dtype=np.float16, mode='r', shape=(n * H * W, 3))
+            shard['fg'] = np.memmap(prefix + '.fg.bin', dtype=np.uint8, mode='r', shape=(n * H * W,))
+            shard['rgbs'] = shard['imgs'].reshape(n * H * W, 3)
+
+    def full_query(self):
+        """
+            A copy returning whole query images, e.g. for visualization.
+        """
+        ret = copy.copy(self)
+        ret.n_rays = None
+        return ret
+
+    def __getitem__(self, idx):
+        if self.n_rays is None:
+            return super().__getitem__(idx)
+        idx %= len(self.objects)
+        view_ids = self.sample_view_ids(idx, self.n_support + self.n_query)
+        t = self.n_support
+        result = self.make_result(idx, view_ids[:t], self.load_views(idx, view_ids[:t]))
+        for k in ['query_imgs', 'query_poses', 'query_focals']:
+            result.pop(k)
+        result.pop('query_view_ids', None)
+        result.update(self.sample_rays(idx, view_ids[t:]))
+        return result
+
+    def sample_rays(self, idx, view_ids):
+        obj = self.objects[idx]
+        shard = self.shards[obj['shard']]
+        H, W = self.image_size
+        HW = H * W
+        views = obj['offset'] + np.asarray(view_ids)
+        n_pixels = len(views) * HW
+
+        n_fg = int(self.n_rays * float(self.fg_ratio))
+        if n_fg > 0:
+            fg = np.concatenate([shard['fg'][v * HW: (v + 1) * HW] for v in views]).nonzero()[0]
+            if len(fg) == 0:
+                fg = np.arange(n_pixels)
+            fg = np.random.choice(fg, n_fg, replace=(len(fg) < n_fg))
+            rd = np.random.choice(n_pixels, self.n_rays - n_fg, replace=False)
+            inds = np.concatenate([fg, rd])
+        else:
+            inds = np.random.choice(n_pixels, self.n_rays, replace=False)
+
+        ray_views = inds // HW
+        ray_ids = views[ray_views] * HW + inds % HW
+        rays_o = np.asarray(shard['cams'][views])[:, [3, 7, 11]][ray_views]
+        rgbs = torch.from_numpy(np.ascontiguousarray(shard['rgbs'][ray_ids]))
+        if not self.uint8:
+            rgbs = rgbs.float() / 255
+        return {
+            'query_rays_o': torch.from_numpy(np.ascontiguousarray(rays_o)),
+            'query_rays_d': torch.from_numpy(np.ascontiguousarray(shard['rays_d'][ray_ids])),
+            'query_rgbs': rgbs,
+        }
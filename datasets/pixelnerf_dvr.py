@@ -2,16 +2,24 @@
 
 from dataclasses import replace
 import os
+import copy
 
 import torch
 import torch.nn.functional as F
 import glob
 import imageio
 import numpy as np
-import cv2
+from PIL import Image
 from torchvision import transforms
 
 from datasets import register
+from utils import imgs_to_uint8, adjust_color
+from .feature_cache import FeatureCache, feature_cache_items
+from .meta_index import default_index_path, load_or_build_index, mask_to_bbox
+from .shm_cache import SharedArrayCache, load_resized_image
+from .query_pixels import subsample_query_pixels, SharedRatio
+from .view_pool import ViewDecodePool
+from .episode_manifest import load_manifest
 
 
 def get_image_to_tensor_balanced(image_size=0):
@@ -31,9 +39,6 @@ def get_mask_to_tensor():
     )
 
 
-import torchvision.transforms.functional_tensor as F_t
-
-
 def color_jitter_augment(images):
     hue_range = 0.1
     saturation_range = 0.1
@@ -49,14 +54,8 @@ def color_jitter_augment(images):
     saturation_factor = np.random.uniform(*saturation_range)
     brightness_factor = np.random.uniform(*brightness_range)
     contrast_factor = np.random.uniform(*contrast_range)
-    for i in range(len(images)):
-        tmp = images[i]
-        tmp = F_t.adjust_saturation(tmp, saturation_factor)
-        tmp = F_t.adjust_hue(tmp, hue_factor)
-        tmp = F_t.adjust_contrast(tmp, contrast_factor)
-        tmp = F_t.adjust_brightness(tmp, brightness_factor)
-        images[i] = tmp
-    return images
+    return adjust_color(images, brightness=brightness_factor, contrast=contrast_factor,
+                        saturation=saturation_factor, hue=hue_factor)
 
 
 @register('pixelnerf_dvr')
@@ -68,6 +67,9 @@ class PixelnerfDvr(torch.utils.data.Dataset):
 
     def __init__(
         self, sub_format, root_path, split, n_support, n_query, support_lst=None, repeat=1, viewrng=None, retcat=False,
+        feature_cache=None, index_path=None, uint8=False, return_ids=False, color_jitter=True,
+        shm_cache=None, query_n_rays=None, query_fg_ratio=0, decode_threads=0,
+        manifest=None,
     ):
         """
         :param path dataset root path, contains metadata.yml
@@ -78,6 +80,17 @@ class PixelnerfDvr(torch.utils.data.Dataset):
         :param scale_focal if true, assume focal length is specified for
         image of side length 2 instead of actual image size. This is used
         where image coordinates are placed in [-1, 1].
+        :param feature_cache root of a cache built by scripts/build_feature_cache.py, adds support_feats_* to results
+        :param index_path where the metadata index is cached, defaults to a file in root_path
+        :param uint8 return images as uint8, normalized by the trainer after transfer
+        :param return_ids also return obj_id and query_view_ids, e.g. for error-driven ray sampling
+        :param color_jitter color jitter on dtu train split, set false when augmenting batches on device (cfg augment)
+        :param shm_cache args of SharedArrayCache {name, size_mb, slot_kb}, caches decoded views in shared memory
+        :param query_n_rays return only this many query pixels (query_rgbs, query_pix_ids, query_hw) instead of
+        query_imgs, query_fg_ratio of them from the foreground bboxes (NvsTrainer sets it to 0.5 with
+        set_fg_ratio() up to adaptive_sample_epoch)
+        :param decode_threads decode the views of a sample with this many threads (per process)
+        :param manifest episode manifest written by scripts/make_eval_manifest.py, replays its fixed episodes
         """
         list_prefix = "softras_"
         image_size = None
@@ -98,6 +111,7 @@ class PixelnerfDvr(torch.utils.data.Dataset):
 
         super().__init__()
         self.base_path = root_path
+        self.color_jitter = color_jitter
         assert os.path.exists(self.base_path)
 
         cats = sorted([x for x in glob.glob(os.path.join(root_path, "*")) if os.path.isdir(x)])
@@ -160,6 +174,7 @@ class PixelnerfDvr(torch.utils.data.Dataset):
                 dtype=torch.float32,
             )
         self.sub_format = sub_format
+        self.avg_intrinsics = (sub_format != "shapenet")
         self.scale_focal = scale_focal
         self.max_imgs = max_imgs
 
@@ -172,201 +187,222 @@ class PixelnerfDvr(torch.utils.data.Dataset):
         self.support_lst = support_lst
         self.repeat = repeat
         self.viewrng = viewrng
+        self.feature_cache = FeatureCache(feature_cache) if feature_cache is not None else None
+        self.shm_cache = SharedArrayCache(**shm_cache) if shm_cache is not None else None
+        self.decode_pool = ViewDecodePool(decode_threads)
+        self.uint8 = uint8
+        self.return_ids = return_ids
+        self.query_n_rays = query_n_rays
+        self.query_fg_ratio = SharedRatio(query_fg_ratio)
+
+        if index_path is None:
+            index_path = default_index_path(self.base_path, f"dvr_{sub_format}_{split}")
+        # Image/mask dirs of the objects change mtime when views are added, removed or renamed
+        sources = [_ for _ in file_lists if os.path.exists(_)]
+        for _, root_dir in self.all_objs:
+            sources.extend(_ for _ in [os.path.join(root_dir, x) for x in ["image", "mask", "cameras.npz"]]
+                           if os.path.exists(_))
+        self.index = load_or_build_index(index_path, sources, self.build_index)
+        self.episodes = load_manifest(manifest, self) if manifest is not None else None
+
+    def build_index(self):
+        """
+        Scan all objects once: per object, the sorted image/mask file names, 4x4 poses after the
+        coordinate transforms, per-view fx, fy, cx, cy (scaled as in loading) and foreground bboxes if masks exist.
+        """
+        print("Building DVR index", self.base_path, "stage", self.stage)
+        index = []
+        for cat, root_dir in self.all_objs:
+            rgb_paths = [
+                x
+                for x in glob.glob(os.path.join(root_dir, "image", "*"))
+                if (x.endswith(".jpg") or x.endswith(".png"))
+            ]
+            rgb_paths = sorted(rgb_paths)
+            mask_paths = sorted(glob.glob(os.path.join(root_dir, "mask", "*.png")))
+            if len(mask_paths) == 0:
+                mask_paths = None
+
+            cam_path = os.path.join(root_dir, "cameras.npz")
+            all_cam = np.load(cam_path)
+
+            all_poses = []
+            all_intrinsics = []
+            for i, rgb_path in enumerate(rgb_paths):
+                if self.scale_focal:
+                    width, height = Image.open(rgb_path).size
+                    x_scale = width / 2.0
+                    y_scale = height / 2.0
+                    xy_delta = 1.0
+                else:
+                    x_scale = y_scale = 1.0
+                    xy_delta = 0.0
+
+                if self.sub_format == "dtu":
+                    # Decompose projection matrix
+                    # DVR uses slightly different format for DTU set
+                    P = all_cam["world_mat_" + str(i)]
+                    P = P[:3]
+
+                    import cv2 # only needed for dtu
+                    K, R, t = cv2.decomposeProjectionMatrix(P)[:3]
+                    K = K / K[2, 2]
+
+                    pose = np.eye(4, dtype=np.float32)
+                    pose[:3, :3] = R.transpose()
+                    pose[:3, 3] = (t[:3] / t[3])[:, 0]
+
+                    scale_mtx = all_cam.get("scale_mat_" + str(i))
+                    if scale_mtx is not None:
+                        norm_trans = scale_mtx[:3, 3:]
+                        norm_scale = np.diagonal(scale_mtx[:3, :3])[..., None]
+
+                        pose[:3, 3:] -= norm_trans
+                        pose[:3, 3:] /= norm_scale
+                else:
+                    # ShapeNet
+                    wmat_inv_key = "world_mat_inv_" + str(i)
+                    wmat_key = "world_mat_" + str(i)
+                    if wmat_inv_key in all_cam:
+                        extr_inv_mtx = all_cam[wmat_inv_key]
+                    else:
+                        extr_inv_mtx = all_cam[wmat_key]
+                        if extr_inv_mtx.shape[0] == 3:
+                            extr_inv_mtx = np.vstack((extr_inv_mtx, np.array([0, 0, 0, 1])))
+                        extr_inv_mtx = np.linalg.inv(extr_inv_mtx)
+
+                    K = all_cam["camera_mat_" + str(i)]
+                    assert abs(K[0, 0] - K[1, 1]) < 1e-9
+                    pose = extr_inv_mtx
+
+                all_intrinsics.append([
+                    K[0, 0] * x_scale,
+                    K[1, 1] * y_scale,
+                    (K[0, 2] + xy_delta) * x_scale,
+                    (K[1, 2] + xy_delta) * y_scale,
+                ])
+
+                pose = (
+                    self._coord_trans_world
+                    @ torch.tensor(pose, dtype=torch.float32)
+                    @ self._coord_trans_cam
+                )
+                all_poses.append(pose.numpy())
+
+            all_bboxes = None
+            if mask_paths is not None:
+                all_bboxes = []
+                for mask_path in mask_paths:
+                    bbox = mask_to_bbox(imageio.imread(mask_path))
+                    if bbox is None:
+                        raise RuntimeError(
+                            "ERROR: Bad image at", mask_path, "please investigate!"
+                        )
+                    all_bboxes.append(bbox)
+                all_bboxes = np.stack(all_bboxes)
+
+            index.append({
+                "cat": cat,
+                "key": os.path.relpath(root_dir, self.base_path),
+                "rgb": [os.path.basename(_) for _ in rgb_paths],
+                "mask": None if mask_paths is None else [os.path.basename(_) for _ in mask_paths],
+                "poses": np.stack(all_poses),
+                "intrinsics": np.array(all_intrinsics, dtype=np.float64),
+                "bboxes": all_bboxes,
+            })
+        return index
 
     def __len__(self):
-        return len(self.all_objs) * self.repeat
+        if self.episodes is not None:
+            return len(self.episodes)
+        return len(self.index) * self.repeat
 
     def __getitem__(self, index):
-        index %= len(self.all_objs)
-        cat, root_dir = self.all_objs[index]
-
-        rgb_paths = [
-            x
-            for x in glob.glob(os.path.join(root_dir, "image", "*"))
-            if (x.endswith(".jpg") or x.endswith(".png"))
-        ]
-        rgb_paths = sorted(rgb_paths)
-        mask_paths = sorted(glob.glob(os.path.join(root_dir, "mask", "*.png")))
-        if len(mask_paths) == 0:
-            mask_paths = [None] * len(rgb_paths)
-
-        if len(rgb_paths) <= self.max_imgs:
-            sel_indices = np.arange(len(rgb_paths))
+        if self.episodes is not None:
+            index, sel_indices = self.episodes[index]
+            return self.make_result(index, sel_indices, self.load_views(index, sel_indices))
+        index %= len(self.index)
+        sel_indices = self.sample_view_ids(index, self.n_support + self.n_query)
+        return self.make_result(index, sel_indices, self.load_views(index, sel_indices))
+
+    def sample_view_ids(self, index, n):
+        n_views = len(self.index[index]["rgb"])
+
+        if n_views <= self.max_imgs:
+            sel_indices = np.arange(n_views)
         else:
-            sel_indices = np.random.choice(len(rgb_paths), self.max_imgs, replace=False)
-            # rgb_paths = [rgb_paths[i] for i in sel_indices]
-            # mask_paths = [mask_paths[i] for i in sel_indices]
+            sel_indices = np.random.choice(n_views, self.max_imgs, replace=False)
 
         if self.viewrng is not None:
             l, r = self.viewrng
             sel_indices = sel_indices[l: r]
 
         if self.support_lst is None:
-            sel_indices = np.random.choice(sel_indices, self.n_support + self.n_query, replace=False)
+            sel_indices = np.random.choice(sel_indices, n, replace=False)
         else:
             rest_inds = []
             for i in sel_indices:
                 if i not in self.support_lst:
                     rest_inds.append(i)
-            rest_inds = np.random.choice(rest_inds, self.n_query, replace=False).tolist()
+            rest_inds = np.random.choice(rest_inds, n - self.n_support, replace=False).tolist()
             sel_indices = self.support_lst + rest_inds
+        return sel_indices
 
-        rgb_paths = [rgb_paths[i] for i in sel_indices]
-        mask_paths = [mask_paths[i] for i in sel_indices]
-        _len_rgb_paths = len(sel_indices)
-
-        cam_path = os.path.join(root_dir, "cameras.npz")
-        all_cam = np.load(cam_path)
-
-        all_imgs = []
-        all_poses = []
-        all_masks = []
-        all_bboxes = []
-        focal = None
-        if self.sub_format != "shapenet":
-            # Prepare to average intrinsics over images
-            fx, fy, cx, cy = 0.0, 0.0, 0.0, 0.0
-
-        for idx, (rgb_path, mask_path) in enumerate(zip(rgb_paths, mask_paths)):
-            i = sel_indices[idx]
-            img = imageio.imread(rgb_path)[..., :3]
-            if self.scale_focal:
-                x_scale = img.shape[1] / 2.0
-                y_scale = img.shape[0] / 2.0
-                xy_delta = 1.0
-            else:
-                x_scale = y_scale = 1.0
-                xy_delta = 0.0
-
-            if mask_path is not None:
-                mask = imageio.imread(mask_path)
-                if len(mask.shape) == 2:
-                    mask = mask[..., None]
-                mask = mask[..., :1]
-            if self.sub_format == "dtu":
-                # Decompose projection matrix
-                # DVR uses slightly different format for DTU set
-                P = all_cam["world_mat_" + str(i)]
-                P = P[:3]
-
-                K, R, t = cv2.decomposeProjectionMatrix(P)[:3]
-                K = K / K[2, 2]
-
-                pose = np.eye(4, dtype=np.float32)
-                pose[:3, :3] = R.transpose()
-                pose[:3, 3] = (t[:3] / t[3])[:, 0]
-
-                scale_mtx = all_cam.get("scale_mat_" + str(i))
-                if scale_mtx is not None:
-                    norm_trans = scale_mtx[:3, 3:]
-                    norm_scale = np.diagonal(scale_mtx[:3, :3])[..., None]
-
-                    pose[:3, 3:] -= norm_trans
-                    pose[:3, 3:] /= norm_scale
-
-                fx += torch.tensor(K[0, 0]) * x_scale
-                fy += torch.tensor(K[1, 1]) * y_scale
-                cx += (torch.tensor(K[0, 2]) + xy_delta) * x_scale
-                cy += (torch.tensor(K[1, 2]) + xy_delta) * y_scale
-            else:
-                # ShapeNet
-                wmat_inv_key = "world_mat_inv_" + str(i)
-                wmat_key = "world_mat_" + str(i)
-                if wmat_inv_key in all_cam:
-                    extr_inv_mtx = all_cam[wmat_inv_key]
-                else:
-                    extr_inv_mtx = all_cam[wmat_key]
-                    if extr_inv_mtx.shape[0] == 3:
-                        extr_inv_mtx = np.vstack((extr_inv_mtx, np.array([0, 0, 0, 1])))
-                    extr_inv_mtx = np.linalg.inv(extr_inv_mtx)
-
-                intr_mtx = all_cam["camera_mat_" + str(i)]
-                fx, fy = intr_mtx[0, 0], intr_mtx[1, 1]
-                assert abs(fx - fy) < 1e-9
-                fx = fx * x_scale
-                if focal is None:
-                    focal = torch.tensor((fx, fx), dtype=torch.float32)
-                else:
-                    assert abs(fx - focal[0]) < 1e-5
-                pose = extr_inv_mtx
-
-            pose = (
-                self._coord_trans_world
-                @ torch.tensor(pose, dtype=torch.float32)
-                @ self._coord_trans_cam
-            )
+    def load_views(self, index, sel_indices):
+        """
+        :return dict of imgs (N, 3, H, W), poses (N, 3, 4), intrinsics (N, 4) float64 array of fx, fy, cx, cy
+        and bboxes (N, 4) or None.
+        """
+        obj = self.index[index]
+        root_dir = os.path.join(self.base_path, obj["key"])
+        sel_indices = np.asarray(sel_indices)
+
+        loaded = self.decode_pool.map(lambda i: load_resized_image(
+            os.path.join(root_dir, "image", obj["rgb"][i]), self.image_to_tensor, self.image_size, self.shm_cache
+        ), sel_indices)
+        all_imgs = torch.stack([img for img, _ in loaded])
+        raw_size = loaded[-1][1]
+        all_poses = torch.from_numpy(obj["poses"][sel_indices])[:, :3, :4]
+        intrinsics = obj["intrinsics"][sel_indices]
+
+        all_bboxes = None
+        if self.sub_format == "shapenet" and obj["bboxes"] is not None:
+            all_bboxes = torch.from_numpy(obj["bboxes"][sel_indices])
+
+        if self.image_size is not None and raw_size != tuple(self.image_size):
+            scale = self.image_size[0] / raw_size[0]
+            intrinsics = intrinsics * scale
+            if all_bboxes is not None:
+                all_bboxes *= scale
 
-            img_tensor = self.image_to_tensor(img)
-            if mask_path is not None:
-                mask_tensor = self.mask_to_tensor(mask)
-
-                rows = np.any(mask, axis=1)
-                cols = np.any(mask, axis=0)
-                rnz = np.where(rows)[0]
-                cnz = np.where(cols)[0]
-                if len(rnz) == 0:
-                    raise RuntimeError(
-                        "ERROR: Bad image at", rgb_path, "please investigate!"
-                    )
-                rmin, rmax = rnz[[0, -1]]
-                cmin, cmax = cnz[[0, -1]]
-                bbox = torch.tensor([cmin, rmin, cmax, rmax], dtype=torch.float32)
-                all_masks.append(mask_tensor)
-                all_bboxes.append(bbox)
-
-            all_imgs.append(img_tensor)
-            all_poses.append(pose)
+        return {
+            "imgs": all_imgs,
+            "poses": all_poses,
+            "intrinsics": intrinsics,
+            "bboxes": all_bboxes,
+        }
 
+    def get_focal(self, intrinsics):
+        # For dtu, intrinsics are averaged over the selected views
         if self.sub_format != "shapenet":
-            fx /= _len_rgb_paths
-            fy /= _len_rgb_paths
-            cx /= _len_rgb_paths
-            cy /= _len_rgb_paths
-            focal = torch.tensor((fx, fy), dtype=torch.float32)
-            c = torch.tensor((cx, cy), dtype=torch.float32)
-            all_bboxes = None
-        elif mask_path is not None:
-            all_bboxes = torch.stack(all_bboxes)
-
-        all_imgs = torch.stack(all_imgs)
-        all_poses = torch.stack(all_poses)
-        if len(all_masks) > 0:
-            all_masks = torch.stack(all_masks)
+            fx, fy, _, _ = intrinsics.mean(axis=0)
+            return torch.tensor((fx, fy), dtype=torch.float32)
         else:
-            all_masks = None
-
-        if self.image_size is not None and all_imgs.shape[-2:] != self.image_size:
-            scale = self.image_size[0] / all_imgs.shape[-2]
-            focal *= scale
-            if self.sub_format != "shapenet":
-                c *= scale
-            elif mask_path is not None:
-                all_bboxes *= scale
+            fx = intrinsics[0, 0]
+            assert np.abs(intrinsics[:, 0] - fx).max() < 1e-5
+            return torch.tensor((fx, fx), dtype=torch.float32)
+
+    def make_result(self, index, sel_indices, views):
+        all_imgs = views["imgs"]
+        all_poses = views["poses"]
 
-            all_imgs = F.interpolate(all_imgs, size=self.image_size, mode="area")
-            if all_masks is not None:
-                all_masks = F.interpolate(all_masks, size=self.image_size, mode="area")
-
-        # result = {
-        #     "path": root_dir,
-        #     "img_id": index,
-        #     "focal": focal,
-        #     "images": all_imgs,
-        #     "poses": all_poses,
-        # }
-        # if all_masks is not None:
-        #     result["masks"] = all_masks
-        # if self.sub_format != "shapenet":
-        #     result["c"] = c
-        # else:
-        #     result["bbox"] = all_bboxes
-
-        if self.sub_format == 'dtu' and self.split == 'train':
+        if self.sub_format == 'dtu' and self.split == 'train' and self.color_jitter:
             all_imgs = color_jitter_augment(all_imgs)
+        if self.uint8:
+            all_imgs = imgs_to_uint8(all_imgs)
 
         t = self.n_support
-        all_poses = all_poses[:, :3, :4]
-        focal = focal.repeat(len(all_poses), 1)
+        focal = self.get_focal(views["intrinsics"]).repeat(len(all_poses), 1)
         result = {
             'support_imgs': all_imgs[:t],
             'support_poses': all_poses[:t],
@@ -378,172 +414,93 @@ class PixelnerfDvr(torch.utils.data.Dataset):
             'far': self.z_far,
         }
         if self.retcat:
-            result['cat'] = self.cat2int[cat]
+            result['cat'] = self.cat2int[self.index[index]["cat"]]
+        if self.feature_cache is not None:
+            result.update(feature_cache_items(self.feature_cache, self.object_key(index), sel_indices[:t]))
+        if self.return_ids:
+            result['obj_id'] = index
+            result['query_view_ids'] = torch.as_tensor(np.asarray(sel_indices)[t:])
+        if self.query_n_rays is not None:
+            bboxes = views["bboxes"][t:] if views["bboxes"] is not None else None
+            subsample_query_pixels(result, self.query_n_rays, float(self.query_fg_ratio), bboxes)
         return result
 
-    def select(self, index, si, qi):
-        index %= len(self.all_objs)
-        cat, root_dir = self.all_objs[index]
-
-        rgb_paths = [
-            x
-            for x in glob.glob(os.path.join(root_dir, "image", "*"))
-            if (x.endswith(".jpg") or x.endswith(".png"))
-        ]
-        rgb_paths = sorted(rgb_paths)
-        mask_paths = sorted(glob.glob(os.path.join(root_dir, "mask", "*.png")))
-        if len(mask_paths) == 0:
-            mask_paths = [None] * len(rgb_paths)
-
-        if len(rgb_paths) <= self.max_imgs:
-            sel_indices = np.arange(len(rgb_paths))
-        else:
-            assert False
-
-        _len_rgb_paths = len(sel_indices)
-
-        if self.viewrng is not None:
-            assert False
-
-        sel_indices = [si, qi]
+    def set_fg_ratio(self, ratio=None):
+        """
+        Set query_fg_ratio for the following epochs (also in loader workers), None restores the one from args.
+        """
+        self.query_fg_ratio.set(ratio)
 
-        rgb_paths = [rgb_paths[i] for i in sel_indices]
-        mask_paths = [mask_paths[i] for i in sel_indices]
+    def full_query(self):
+        """
+        A copy returning whole query images, e.g. for visualization.
+        """
+        ret = copy.copy(self)
+        ret.query_n_rays = None
+        return ret
 
-        cam_path = os.path.join(root_dir, "cameras.npz")
-        all_cam = np.load(cam_path)
+    def object_key(self, index):
+        return self.index[index % len(self.index)]["key"]
 
-        all_imgs = []
-        all_poses = []
-        all_masks = []
-        all_bboxes = []
-        focal = None
-        if self.sub_format != "shapenet":
-            # Prepare to average intrinsics over images
-            fx, fy, cx, cy = 0.0, 0.0, 0.0, 0.0
-
-        for idx, (rgb_path, mask_path) in enumerate(zip(rgb_paths, mask_paths)):
-            i = sel_indices[idx]
-            img = imageio.imread(rgb_path)[..., :3]
-            if self.scale_focal:
-                x_scale = img.shape[1] / 2.0
-                y_scale = img.shape[0] / 2.0
-                xy_delta = 1.0
-            else:
-                x_scale = y_scale = 1.0
-                xy_delta = 0.0
-
-            if mask_path is not None:
-                mask = imageio.imread(mask_path)
-                if len(mask.shape) == 2:
-                    mask = mask[..., None]
-                mask = mask[..., :1]
-            if self.sub_format == "dtu":
-                # Decompose projection matrix
-                # DVR uses slightly different format for DTU set
-                P = all_cam["world_mat_" + str(i)]
-                P = P[:3]
-
-                K, R, t = cv2.decomposeProjectionMatrix(P)[:3]
-                K = K / K[2, 2]
-
-                pose = np.eye(4, dtype=np.float32)
-                pose[:3, :3] = R.transpose()
-                pose[:3, 3] = (t[:3] / t[3])[:, 0]
-
-                scale_mtx = all_cam.get("scale_mat_" + str(i))
-                if scale_mtx is not None:
-                    norm_trans = scale_mtx[:3, 3:]
-                    norm_scale = np.diagonal(scale_mtx[:3, :3])[..., None]
-
-                    pose[:3, 3:] -= norm_trans
-                    pose[:3, 3:] /= norm_scale
-
-                fx += torch.tensor(K[0, 0]) * x_scale
-                fy += torch.tensor(K[1, 1]) * y_scale
-                cx += (torch.tensor(K[0, 2]) + xy_delta) * x_scale
-                cy += (torch.tensor(K[1, 2]) + xy_delta) * y_scale
-            else:
-                # ShapeNet
-                wmat_inv_key = "world_mat_inv_" + str(i)
-                wmat_key = "world_mat_" + str(i)
-                if wmat_inv_key in all_cam:
-                    extr_inv_mtx = all_cam[wmat_inv_key]
-                else:
-                    extr_inv_mtx = all_cam[wmat_key]
-                    if extr_inv_mtx.shape[0] == 3:
-                        extr_inv_mtx = np.vstack((extr_inv_mtx, np.array([0, 0, 0, 1])))
-                    extr_inv_mtx = np.linalg.inv(extr_inv_mtx)
-
-                intr_mtx = all_cam["camera_mat_" + str(i)]
-                fx, fy = intr_mtx[0, 0], intr_mtx[1, 1]
-                assert abs(fx - fy) < 1e-9
-                fx = fx * x_scale
-                if focal is None:
-                    focal = fx
-                else:
-                    assert abs(fx - focal) < 1e-5
-                pose = extr_inv_mtx
+    def load_object_views(self, index):
+        """
+        Load all views of an object in file order, preprocessed as in __getitem__ (without augmentation).
+        :return (object key, images (N, 3, H, W))
+        """
+        index %= len(self.index)
+        sel_indices = np.arange(len(self.index[index]["rgb"]))
+        return self.object_key(index), self.load_views(index, sel_indices)["imgs"]
 
-            pose = (
-                self._coord_trans_world
-                @ torch.tensor(pose, dtype=torch.float32)
-                @ self._coord_trans_cam
-            )
+    def load_object(self, index):
+        """
+        Load all views of an object with per-view cameras (not averaged), for scripts/pack_nvs_shards.py.
+        :return dict of key, cat, imgs (N, 3, H, W), masks (N, H, W) or None, poses (N, 3, 4), intrinsics (N, 4) as fx, fy, cx, cy
+        """
+        index %= len(self.index)
+        obj = self.index[index]
+        root_dir = os.path.join(self.base_path, obj["key"])
+        sel_indices = np.arange(len(obj["rgb"]))
+        views = self.load_views(index, sel_indices)
+
+        intrinsics = torch.from_numpy(obj["intrinsics"]).float()
+        if self.sub_format == "shapenet":
+            intrinsics[:, 1] = intrinsics[:, 0]
+
+        masks = None
+        if obj["mask"] is not None:
+            masks = []
+            for mask_name in obj["mask"]:
+                mask = imageio.imread(os.path.join(root_dir, "mask", mask_name))
+                if len(mask.shape) == 3:
+                    mask = mask[..., 0]
+                masks.append(torch.from_numpy(mask > 0))
+            masks = torch.stack(masks)
+
+        return {
+            "key": obj["key"],
+            "cat": obj["cat"],
+            "imgs": views["imgs"],
+            "masks": masks,
+            "poses": views["poses"],
+            "intrinsics": intrinsics,
+            "near": self.z_near,
+            "far": self.z_far,
+        }
 
-            img_tensor = self.image_to_tensor(img)
-            if mask_path is not None:
-                mask_tensor = self.mask_to_tensor(mask)
-
-                rows = np.any(mask, axis=1)
-                cols = np.any(mask, axis=0)
-                rnz = np.where(rows)[0]
-                cnz = np.where(cols)[0]
-                if len(rnz) == 0:
-                    raise RuntimeError(
-                        "ERROR: Bad image at", rgb_path, "please investigate!"
-                    )
-                rmin, rmax = rnz[[0, -1]]
-                cmin, cmax = cnz[[0, -1]]
-                bbox = torch.tensor([cmin, rmin, cmax, rmax], dtype=torch.float32)
-                all_masks.append(mask_tensor)
-                all_bboxes.append(bbox)
-
-            all_imgs.append(img_tensor)
-            all_poses.append(pose)
+    def select(self, index, si, qi):
+        index %= len(self.index)
+        assert len(self.index[index]["rgb"]) <= self.max_imgs
+        assert self.viewrng is None
 
+        views = self.load_views(index, [si, qi])
+        all_imgs = views["imgs"]
+        all_poses = views["poses"]
         if self.sub_format != "shapenet":
-            fx /= _len_rgb_paths
-            fy /= _len_rgb_paths
-            cx /= _len_rgb_paths
-            cy /= _len_rgb_paths
-            focal = torch.tensor((fx, fy), dtype=torch.float32)
-            c = torch.tensor((cx, cy), dtype=torch.float32)
-            all_bboxes = None
-        elif mask_path is not None:
-            all_bboxes = torch.stack(all_bboxes)
-
-        all_imgs = torch.stack(all_imgs)
-        all_poses = torch.stack(all_poses)
-        if len(all_masks) > 0:
-            all_masks = torch.stack(all_masks)
+            focal = self.get_focal(views["intrinsics"])
         else:
-            all_masks = None
-
-        if self.image_size is not None and all_imgs.shape[-2:] != self.image_size:
-            scale = self.image_size[0] / all_imgs.shape[-2]
-            focal *= scale
-            if self.sub_format != "shapenet":
-                c *= scale
-            elif mask_path is not None:
-                all_bboxes *= scale
-
-            all_imgs = F.interpolate(all_imgs, size=self.image_size, mode="area")
-            if all_masks is not None:
-                all_masks = F.interpolate(all_masks, size=self.image_size, mode="area")
+            focal = views["intrinsics"][0, 0]
 
         t = self.n_support
-        all_poses = all_poses[:, :3, :4]
         result = {
             'support_imgs': all_imgs[:t],
             'support_poses': all_poses[:t],
@@ -554,5 +511,5 @@ class PixelnerfDvr(torch.utils.data.Dataset):
             'far': self.z_far,
         }
         if self.retcat:
-            result['cat'] = self.cat2int[cat]
+            result['cat'] = self.cat2int[self.index[index]["cat"]]
         return result
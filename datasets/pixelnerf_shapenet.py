@@ -1,6 +1,7 @@
 # Modified from https://github.com/sxyu/pixel-nerf/blob/master/src/data/SRNDataset.py
 
 import os
+import copy
 
 import torch
 import torch.nn.functional as F
@@ -10,6 +11,13 @@ import numpy as np
 from torchvision import transforms
 
 from datasets import register
+from utils import imgs_to_uint8
+from .feature_cache import FeatureCache, feature_cache_items
+from .meta_index import default_index_path, load_or_build_index, mask_to_bbox, foreground_mask
+from .shm_cache import SharedArrayCache, load_resized_image
+from .query_pixels import subsample_query_pixels, SharedRatio
+from .view_pool import ViewDecodePool
+from .episode_manifest import load_manifest
 
 
 def get_image_to_tensor_balanced(image_size=0):
@@ -37,12 +45,25 @@ class PixelnerfShapenet(torch.utils.data.Dataset):
 
     def __init__(
         self, root_path, category, split, n_support, n_query, support_lst=None, repeat=1, viewrng=None,
-        image_size=(128, 128), world_scale=1.0
+        image_size=(128, 128), world_scale=1.0, feature_cache=None, index_path=None, uint8=False, return_ids=False,
+        shm_cache=None, query_n_rays=None, query_fg_ratio=0, decode_threads=0,
+        manifest=None,
     ):
         """
         :param stage train | val | test
         :param image_size result image size (resizes if different)
         :param world_scale amount to scale entire world by
+        :param feature_cache root of a cache built by scripts/build_feature_cache.py, adds support_feats_* to results
+        :param index_path where the metadata index is cached, defaults to a file next to the split directory,
+        rebuilt when objects, views or intrinsics change (delete it after overwriting existing images or poses in place)
+        :param uint8 return images as uint8, normalized by the trainer after transfer
+        :param return_ids also return obj_id and query_view_ids, e.g. for error-driven ray sampling
+        :param shm_cache args of SharedArrayCache {name, size_mb, slot_kb}, caches decoded views in shared memory
+        :param query_n_rays return only this many query pixels (query_rgbs, query_pix_ids, query_hw) instead of
+        query_imgs, query_fg_ratio of them from the foreground bboxes (NvsTrainer sets it to 0.5 with
+        set_fg_ratio() up to adaptive_sample_epoch)
+        :param decode_threads decode the views of a sample with this many threads (per process)
+        :param manifest episode manifest written by scripts/make_eval_manifest.py, replays its fixed episodes
         """
         super().__init__()
         self.base_path = os.path.join(root_path, category + "_" + split)
@@ -59,9 +80,6 @@ class PixelnerfShapenet(torch.utils.data.Dataset):
             if os.path.exists(tmp):
                 self.base_path = tmp
 
-        self.intrins = sorted(
-            glob.glob(os.path.join(self.base_path, "*", "intrinsics.txt"))
-        )
         self.image_to_tensor = get_image_to_tensor_balanced()
         self.mask_to_tensor = get_mask_to_tensor()
 
@@ -71,6 +89,16 @@ class PixelnerfShapenet(torch.utils.data.Dataset):
             torch.tensor([1, -1, -1, 1], dtype=torch.float32)
         )
 
+        if index_path is None:
+            index_path = default_index_path(os.path.dirname(self.base_path), os.path.basename(self.base_path))
+        # Object dirs and their rgb/pose dirs change mtime when views are added, removed or renamed
+        sources = [self.base_path] + sorted(
+            glob.glob(os.path.join(self.base_path, "*", "rgb"))
+            + glob.glob(os.path.join(self.base_path, "*", "pose"))
+            + glob.glob(os.path.join(self.base_path, "*", "intrinsics.txt"))
+        )
+        self.index = load_or_build_index(index_path, sources, self.build_index)
+
         if is_chair:
             self.z_near = 1.25
             self.z_far = 2.75
@@ -86,112 +114,190 @@ class PixelnerfShapenet(torch.utils.data.Dataset):
             assert len(support_lst) == n_support
         self.repeat = repeat
         self.viewrng = viewrng
+        self.feature_cache = FeatureCache(feature_cache) if feature_cache is not None else None
+        self.shm_cache = SharedArrayCache(**shm_cache) if shm_cache is not None else None
+        self.decode_pool = ViewDecodePool(decode_threads)
+        self.uint8 = uint8
+        self.return_ids = return_ids
+        self.query_n_rays = query_n_rays
+        self.query_fg_ratio = SharedRatio(query_fg_ratio)
+        self.episodes = load_manifest(manifest, self) if manifest is not None else None
+
+    def build_index(self):
+        """
+        Scan the split once: per object, the sorted view file names, 4x4 poses (in our camera convention),
+        focal/cx/cy and image size from intrinsics.txt, and the foreground bbox of each view.
+        """
+        print("Building SRN index", self.base_path)
+        intrins = sorted(
+            glob.glob(os.path.join(self.base_path, "*", "intrinsics.txt"))
+        )
+        coord_trans = self._coord_trans.numpy()
+        index = []
+        for intrin_path in intrins:
+            dir_path = os.path.dirname(intrin_path)
+            rgb_paths = sorted(glob.glob(os.path.join(dir_path, "rgb", "*")))
+            pose_paths = sorted(glob.glob(os.path.join(dir_path, "pose", "*")))
+            assert len(rgb_paths) == len(pose_paths)
+
+            with open(intrin_path, "r") as intrinfile:
+                lines = intrinfile.readlines()
+                focal, cx, cy, _ = map(float, lines[0].split())
+                height, width = map(int, lines[-1].split())
+
+            poses = []
+            bboxes = []
+            for rgb_path, pose_path in zip(rgb_paths, pose_paths):
+                poses.append(np.loadtxt(pose_path, dtype=np.float32).reshape(4, 4) @ coord_trans)
+                img = imageio.imread(rgb_path)[..., :3]
+                bbox = mask_to_bbox(foreground_mask(img))
+                if bbox is None:
+                    raise RuntimeError(
+                        "ERROR: Bad image at", rgb_path, "please investigate!"
+                    )
+                bboxes.append(bbox)
+
+            index.append({
+                "key": os.path.relpath(dir_path, self.base_path),
+                "rgb": [os.path.basename(_) for _ in rgb_paths],
+                "poses": np.stack(poses).astype(np.float32),
+                "bboxes": np.stack(bboxes),
+                "intrinsics": (focal, cx, cy),
+                "hw": (height, width),
+            })
+        return index
 
     def __len__(self):
-        return len(self.intrins) * self.repeat
+        if self.episodes is not None:
+            return len(self.episodes)
+        return len(self.index) * self.repeat
 
     def __getitem__(self, index):
-        index %= len(self.intrins)
-        intrin_path = self.intrins[index]
-        dir_path = os.path.dirname(intrin_path)
-        rgb_paths = sorted(glob.glob(os.path.join(dir_path, "rgb", "*")))
-        pose_paths = sorted(glob.glob(os.path.join(dir_path, "pose", "*")))
+        if self.episodes is not None:
+            index, view_ids = self.episodes[index]
+            return self.make_result(index, view_ids, self.load_views(index, view_ids))
+        index %= len(self.index)
+        view_ids = self.sample_view_ids(index, self.n_support + self.n_query)
+        return self.make_result(index, view_ids, self.load_views(index, view_ids))
 
+    def sample_view_ids(self, index, n):
+        view_ids = np.arange(len(self.index[index]["rgb"]))
         if self.viewrng is not None:
             l, r = self.viewrng
-            rgb_paths = rgb_paths[l: r]
-            pose_paths = pose_paths[l: r]
-
-        assert len(rgb_paths) == len(pose_paths)
+            view_ids = view_ids[l: r]
 
-        with open(intrin_path, "r") as intrinfile:
-            lines = intrinfile.readlines()
-            focal, cx, cy, _ = map(float, lines[0].split())
-            height, width = map(int, lines[-1].split())
-
-        zip_lst = list(zip(rgb_paths, pose_paths))
         if self.support_lst is None:
-            zip_lst_inds = np.random.choice(len(zip_lst), self.n_support + self.n_query, replace=False)
+            inds = np.random.choice(len(view_ids), n, replace=False)
         else:
             rest_inds = []
-            for i in range(len(zip_lst)):
+            for i in range(len(view_ids)):
                 if i not in self.support_lst:
                     rest_inds.append(i)
-            rest_inds = np.random.choice(rest_inds, self.n_query, replace=False).tolist()
-            zip_lst_inds = self.support_lst + rest_inds
-        zip_lst = [zip_lst[i] for i in zip_lst_inds]
-
-        all_imgs = []
-        all_poses = []
-        all_masks = []
-        all_bboxes = []
-        for rgb_path, pose_path in zip_lst:
-            img = imageio.imread(rgb_path)[..., :3]
-            img_tensor = self.image_to_tensor(img)
-            mask = (img != 255).all(axis=-1)[..., None].astype(np.uint8) * 255
-            mask_tensor = self.mask_to_tensor(mask)
-
-            pose = torch.from_numpy(
-                np.loadtxt(pose_path, dtype=np.float32).reshape(4, 4)
-            )
-            pose = pose @ self._coord_trans
-
-            rows = np.any(mask, axis=1)
-            cols = np.any(mask, axis=0)
-            rnz = np.where(rows)[0]
-            cnz = np.where(cols)[0]
-            if len(rnz) == 0:
-                raise RuntimeError(
-                    "ERROR: Bad image at", rgb_path, "please investigate!"
-                )
-            rmin, rmax = rnz[[0, -1]]
-            cmin, cmax = cnz[[0, -1]]
-            bbox = torch.tensor([cmin, rmin, cmax, rmax], dtype=torch.float32)
-
-            all_imgs.append(img_tensor)
-            all_masks.append(mask_tensor)
-            all_poses.append(pose)
-            all_bboxes.append(bbox)
-
-        all_imgs = torch.stack(all_imgs)
-        all_poses = torch.stack(all_poses)
-        all_masks = torch.stack(all_masks)
-        all_bboxes = torch.stack(all_bboxes)
-
-        if all_imgs.shape[-2:] != self.image_size:
-            scale = self.image_size[0] / all_imgs.shape[-2]
+            rest_inds = np.random.choice(rest_inds, n - self.n_support, replace=False).tolist()
+            inds = self.support_lst + rest_inds
+        return view_ids[inds]
+
+    def load_views(self, index, view_ids):
+        """
+        :return dict of imgs (N, 3, H, W), poses (N, 3, 4), focals (N, 2), c (N, 2), bboxes (N, 4) for the given views
+        """
+        obj = self.index[index]
+        dir_path = os.path.join(self.base_path, obj["key"])
+        focal, cx, cy = obj["intrinsics"]
+
+        loaded = self.decode_pool.map(lambda i: load_resized_image(
+            os.path.join(dir_path, "rgb", obj["rgb"][i]), self.image_to_tensor, self.image_size, self.shm_cache
+        ), view_ids)
+        all_imgs = torch.stack([img for img, _ in loaded])
+        raw_size = loaded[-1][1]
+        all_poses = torch.from_numpy(obj["poses"][view_ids])
+        all_bboxes = torch.from_numpy(obj["bboxes"][view_ids])
+
+        if raw_size != tuple(self.image_size):
+            scale = self.image_size[0] / raw_size[0]
             focal *= scale
             cx *= scale
             cy *= scale
             all_bboxes *= scale
 
-            all_imgs = F.interpolate(all_imgs, size=self.image_size, mode="area")
-            all_masks = F.interpolate(all_masks, size=self.image_size, mode="area")
-
         if self.world_scale != 1.0:
             focal *= self.world_scale
             all_poses[:, :3, 3] *= self.world_scale
         focal = torch.ones(len(all_poses), 2) * focal
 
-        # result = {
-        #     "path": dir_path,
-        #     "img_id": index,
-        #     "focal": focal,
-        #     "c": torch.tensor([cx, cy], dtype=torch.float32),
-        #     "images": all_imgs,
-        #     "masks": all_masks,
-        #     "bbox": all_bboxes,
-        #     "poses": all_poses,
-        # }
-        t = self.n_support
-        all_poses = all_poses[:, :3, :4]
         return {
-            'support_imgs': all_imgs[:t],
-            'support_poses': all_poses[:t],
-            'support_focals': focal[:t],
-            'query_imgs': all_imgs[t:],
-            'query_poses': all_poses[t:],
-            'query_focals': focal[t:],
+            "imgs": all_imgs,
+            "poses": all_poses[:, :3, :4],
+            "focals": focal,
+            "c": torch.tensor([cx, cy], dtype=torch.float32).repeat(len(all_poses), 1),
+            "bboxes": all_bboxes,
+        }
+
+    def make_result(self, index, view_ids, views):
+        imgs = views['imgs']
+        if self.uint8:
+            imgs = imgs_to_uint8(imgs)
+        t = self.n_support
+        result = {
+            'support_imgs': imgs[:t],
+            'support_poses': views['poses'][:t],
+            'support_focals': views['focals'][:t],
+            'query_imgs': imgs[t:],
+            'query_poses': views['poses'][t:],
+            'query_focals': views['focals'][t:],
             'near': self.z_near,
             'far': self.z_far,
         }
+        if self.feature_cache is not None:
+            result.update(feature_cache_items(self.feature_cache, self.object_key(index), view_ids[:t]))
+        if self.return_ids:
+            result['obj_id'] = index
+            result['query_view_ids'] = torch.as_tensor(np.asarray(view_ids)[t:])
+        if self.query_n_rays is not None:
+            bboxes = views["bboxes"][t:] if views["bboxes"] is not None else None
+            subsample_query_pixels(result, self.query_n_rays, float(self.query_fg_ratio), bboxes)
+        return result
+
+    def set_fg_ratio(self, ratio=None):
+        """
+        Set query_fg_ratio for the following epochs (also in loader workers), None restores the one from args.
+        """
+        self.query_fg_ratio.set(ratio)
+
+    def full_query(self):
+        """
+        A copy returning whole query images, e.g. for visualization.
+        """
+        ret = copy.copy(self)
+        ret.query_n_rays = None
+        return ret
+
+    def object_key(self, index):
+        return self.index[index % len(self.index)]["key"]
+
+    def load_object_views(self, index):
+        """
+        Load all views of an object in file order, preprocessed as in __getitem__.
+        :return (object key, images (N, 3, H, W))
+        """
+        index %= len(self.index)
+        view_ids = np.arange(len(self.index[index]["rgb"]))
+        return self.object_key(index), self.load_views(index, view_ids)["imgs"]
+
+    def load_object(self, index):
+        """
+        Load all views of an object with cameras, for scripts/pack_nvs_shards.py.
+        :return dict of key, imgs (N, 3, H, W), masks (N, H, W), poses (N, 3, 4), intrinsics (N, 4) as fx, fy, cx, cy
+        """
+        index %= len(self.index)
+        view_ids = np.arange(len(self.index[index]["rgb"]))
+        views = self.load_views(index, view_ids)
+        return {
+            "key": self.object_key(index),
+            "imgs": views["imgs"],
+            "masks": foreground_mask(views["imgs"], channel_dim=1),
+            "poses": views["poses"],
+            "intrinsics": torch.cat([views["focals"], views["c"]], dim=1),
+            "near": self.z_near,
+            "far": self.z_far,
+        }
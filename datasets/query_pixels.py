@@ -0,0 +1,47 @@
+import numpy as np
+import torch
+
+
+class SharedRatio():
+    """
+        A float in shared memory, so that the trainer can change it between epochs and DataLoader workers
+        (also persistent ones) see the new value. set(None) restores the initial value.
+    """
+
+    def __init__(self, value):
+        self.default = value
+        self.value = torch.tensor(float(value)).share_memory_()
+
+    def set(self, value=None):
+        self.value.fill_(self.default if value is None else value)
+
+    def __float__(self):
+        return self.value.item()
+
+
+def subsample_query_pixels(result, n_rays, fg_ratio=0, bboxes=None):
+    """
+        In place, replaces query_imgs (N, 3, H, W) of a dataset result by n_rays sampled pixels:
+            query_rgbs (n_rays, 3), query_pix_ids (n_rays,) indices into flattened (N, H, W), query_hw [H, W].
+        query_poses and query_focals are kept for ray generation (see utils.pixels_to_rays).
+        fg_ratio of the pixels are drawn uniformly in the foreground bbox (N, 4) [cmin, rmin, cmax, rmax] of a random
+        query view if bboxes are given, the rest uniformly without replacement.
+    """
+    imgs = result.pop('query_imgs')
+    N, _, H, W = imgs.shape
+    n_fg = int(n_rays * fg_ratio) if bboxes is not None else 0
+
+    pix_ids = [np.random.choice(N * H * W, n_rays - n_fg, replace=False)]
+    if n_fg > 0:
+        bboxes = np.asarray(bboxes, dtype=np.float64)
+        v = np.random.randint(N, size=n_fg)
+        cmin, rmin, cmax, rmax = bboxes[v].T
+        x = np.floor(cmin + np.random.rand(n_fg) * (cmax - cmin + 1)).clip(0, W - 1).astype(np.int64)
+        y = np.floor(rmin + np.random.rand(n_fg) * (rmax - rmin + 1)).clip(0, H - 1).astype(np.int64)
+        pix_ids.append(v * H * W + y * W + x)
+    pix_ids = torch.from_numpy(np.concatenate(pix_ids))
+
+    result['query_rgbs'] = imgs.permute(0, 2, 3, 1).reshape(-1, 3)[pix_ids]
+    result['query_pix_ids'] = pix_ids
+    result['query_hw'] = torch.tensor([H, W])
+    return result
@@ -0,0 +1,190 @@
+import os
+import fcntl
+import hashlib
+import tempfile
+import time
+import zlib
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import imageio
+
+
+MAGIC = 0x7472616e73696e72
+DTYPES = ['uint8', 'float16', 'float32', 'int64']
+
+# Slot table fields
+SEQ, KEY, LAST_USE, NBYTES, DTYPE, NDIM, SHAPE, AUX, CHECK = 0, 1, 2, 3, 4, 5, 6, 10, 12
+N_FIELDS = 16
+
+
+class SharedArrayCache():
+    """
+        Size-bounded cache of numpy arrays (up to 4-d, at most slot_kb each) with two int aux values, in POSIX shared
+        memory /dev/shm/{name}. All processes of a node that open the same name share it (DataLoader workers, DDP ranks
+        and later runs), the segment is kept until removed (rm /dev/shm/{name}) or reboot.
+
+        Keys are strings hashed to 64 bits. The cache is set-associative: a key maps to a set of `ways` slots,
+        a miss evicts the least recently used slot of its set.
+        Reads are lock-free with a per-slot sequence lock (a read that overlaps a write is a miss),
+        writes and creation take a node-wide file lock. The numpy stores have no memory fences, so a read also checks
+        a crc32 of the slot fields and data written with them, a torn read on weakly ordered CPUs is a miss.
+    """
+
+    def __init__(self, name, size_mb, slot_kb, ways=8):
+        self.name = name
+        self.slot_bytes = slot_kb * 1024
+        self.ways = ways
+        n_sets = max(size_mb * 1024 * 1024 // (self.slot_bytes * ways), 1)
+        self.n_slots = n_sets * ways
+        self.lock_path = os.path.join(tempfile.gettempdir(), f'{name}.lock')
+        self.pid = None
+        self.warned = False
+
+    def _open(self):
+        header_bytes = 8 * 8
+        table_bytes = self.n_slots * N_FIELDS * 8
+        size = header_bytes + table_bytes + self.n_slots * self.slot_bytes
+        with self._lock():
+            try:
+                shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+                created = True
+            except FileExistsError:
+                shm = shared_memory.SharedMemory(name=self.name)
+                created = False
+            # The segment outlives this process, do not let the resource tracker unlink it
+            resource_tracker.unregister(shm._name, 'shared_memory')
+
+            header = np.ndarray((8,), dtype=np.int64, buffer=shm.buf)
+            if created:
+                header[1: 4] = [self.n_slots, self.slot_bytes, self.ways]
+                header[0] = MAGIC
+            else:
+                assert header[0] == MAGIC and list(header[1: 4]) == [self.n_slots, self.slot_bytes, self.ways], \
+                    f'shared memory {self.name} exists with a different layout'
+
+        self.shm = shm
+        self.table = np.ndarray((self.n_slots, N_FIELDS), dtype=np.int64, buffer=shm.buf, offset=header_bytes)
+        self.data = np.ndarray((self.n_slots, self.slot_bytes), dtype=np.uint8, buffer=shm.buf,
+                               offset=header_bytes + table_bytes)
+        self.pid = os.getpid()
+
+    def _ensure_open(self):
+        # Opened lazily (and again in a forked process) so that the dataset stays picklable
+        if self.pid != os.getpid():
+            self._open()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['shm', 'table', 'data']:
+            state.pop(k, None)
+        state['pid'] = None
+        return state
+
+    def _lock(self):
+        cache = self
+
+        class Lock():
+            def __enter__(self):
+                self.f = open(cache.lock_path, 'a')
+                fcntl.flock(self.f, fcntl.LOCK_EX)
+
+            def __exit__(self, *args):
+                fcntl.flock(self.f, fcntl.LOCK_UN)
+                self.f.close()
+
+        return Lock()
+
+    def _hash(self, key):
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little', signed=True)
+        return h if h != 0 else 1 # 0 marks an empty slot
+
+    def _slots(self, h):
+        s = (h % (self.n_slots // self.ways)) * self.ways
+        return range(s, s + self.ways)
+
+    def _checksum(self, fields, x):
+        # Over the slot fields from KEY (with LAST_USE zeroed) and the data
+        fields = fields.copy()
+        fields[LAST_USE - KEY] = 0
+        return zlib.crc32(x, zlib.crc32(fields.tobytes()))
+
+    def get(self, key):
+        """
+            Returns (array, aux) or None.
+        """
+        self._ensure_open()
+        h = self._hash(key)
+        for slot in self._slots(h):
+            row = self.table[slot]
+            seq = int(row[SEQ])
+            if seq % 2 == 1 or row[KEY] != h:
+                continue
+            fields = row[KEY: CHECK].copy()
+            x = self.data[slot, :min(max(int(fields[NBYTES - KEY]), 0), self.slot_bytes)].copy()
+            check = int(row[CHECK])
+            if int(row[SEQ]) != seq or fields[0] != h or check != self._checksum(fields, x):
+                return None
+            ndim = int(fields[NDIM - KEY])
+            shape = tuple(int(_) for _ in fields[SHAPE - KEY: SHAPE - KEY + ndim])
+            dtype = DTYPES[int(fields[DTYPE - KEY])]
+            aux = (int(fields[AUX - KEY]), int(fields[AUX - KEY + 1]))
+            row[LAST_USE] = time.monotonic_ns()
+            return x.view(dtype).reshape(shape), aux
+        return None
+
+    def put(self, key, x, aux=(0, 0)):
+        """
+            Arrays larger than a slot are not cached (with a message once per process).
+        """
+        self._ensure_open()
+        x = np.ascontiguousarray(x)
+        if x.nbytes > self.slot_bytes or x.ndim > 4:
+            if not self.warned:
+                print(f'SharedArrayCache {self.name}: array of shape {x.shape} ({x.nbytes / 1024:.0f} KB) '
+                      f'does not fit a slot of {self.slot_bytes // 1024} KB, not cached')
+                self.warned = True
+            return
+        h = self._hash(key)
+        with self._lock():
+            slots = list(self._slots(h))
+            match = [s for s in slots if self.table[s, KEY] == h]
+            slot = match[0] if len(match) > 0 else min(slots, key=lambda s: self.table[s, LAST_USE])
+            row = self.table[slot]
+            row[SEQ] += 1
+            row[KEY] = h
+            row[NBYTES] = x.nbytes
+            row[DTYPE] = DTYPES.index(x.dtype.name)
+            row[NDIM] = x.ndim
+            row[SHAPE: SHAPE + x.ndim] = x.shape
+            row[AUX: AUX + 2] = aux
+            self.data[slot, :x.nbytes] = x.reshape(-1).view(np.uint8)
+            row[CHECK] = self._checksum(row[KEY: CHECK], self.data[slot, :x.nbytes])
+            row[LAST_USE] = time.monotonic_ns()
+            row[SEQ] += 1
+
+
+def load_resized_image(path, image_to_tensor, image_size, cache=None):
+    """
+        Decodes an image file to (3, H, W) resized to image_size (area) if given and different.
+        Returns the image and its original (H, W). With a SharedArrayCache, the decoded uint8 pixels are cached by
+        path and image_size (H * W * 3 bytes per view), conversion and resizing run on each read.
+    """
+    raw = None
+    key = f'{path}:{tuple(image_size) if image_size is not None else None}'
+    if cache is not None:
+        hit = cache.get(key)
+        if hit is not None:
+            raw = hit[0]
+    if raw is None:
+        raw = np.ascontiguousarray(imageio.imread(path)[..., :3])
+        if cache is not None:
+            cache.put(key, raw)
+
+    img = image_to_tensor(raw)
+    raw_size = tuple(img.shape[-2:])
+    if image_size is not None and raw_size != tuple(image_size):
+        img = F.interpolate(img.unsqueeze(0), size=image_size, mode="area")[0]
+    return img, raw_size
@@ -0,0 +1,280 @@
+import io
+import os
+import copy
+import json
+import math
+import tarfile
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+from PIL import Image
+from torchvision import transforms
+
+from datasets import register
+from .imagenette import make_augment
+
+
+def iter_tar_samples(path, bufsize=16 * 1024 * 1024):
+    """
+        Reads a tar file sequentially and yields (key, {ext: bytes}) of consecutive members sharing a key,
+        member names are {key}.{ext}.
+    """
+    with open(path, 'rb', buffering=bufsize) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+        key, sample = None, dict()
+        for member in tar:
+            if not member.isfile():
+                continue
+            k, ext = member.name.split('.', 1)
+            if k != key and key is not None:
+                yield key, sample
+                sample = dict()
+            key = k
+            sample[ext] = tar.extractfile(member).read()
+        if key is not None:
+            yield key, sample
+
+
+class TarShardStream(IterableDataset):
+    """
+        Streams samples from tar shards packed by scripts/pack_tar_shards.py, each shard is read sequentially.
+
+        Shards are split over ranks (shards[rank::world_size]) and then over DataLoader workers, in an order
+        shuffled by seed + epoch. Each rank yields ceil(n_samples / world_size) samples per epoch (truncating, or
+        cycling its shards if short). The DataLoader batches within each worker, so with set_batch_size(b)
+        (drop_last loaders, BaseTrainer does so) every worker yields a multiple of b samples and each rank runs
+        exactly len(self) // b steps, as with DistributedSampler.
+        Pack with enough shards (at least world_size * num_workers) of similar sizes to keep this close to exact.
+        With shuffle, samples are drawn from a buffer of shuffle_buffer samples.
+        Call set_epoch() before each epoch (BaseTrainer does so). Workers must not be persistent, they would keep
+        the epoch of their copy of the dataset.
+
+        Subclasses define decode(key, sample) returning an item, or override decode_stream().
+
+        Layout of root_path:
+            meta.json: {'kind', 'shards': [{'name', 'n'}], 'n_samples', ...}
+            {name}.tar: members {key}.{ext}
+    """
+
+    def __init__(self, root_path, shuffle=True, shuffle_buffer=1000, seed=0):
+        self.root_path = root_path
+        with open(os.path.join(root_path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.shards = self.meta['shards']
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.batch_size = 1
+
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        else:
+            self.rank, self.world_size = 0, 1
+        assert len(self.shards) >= self.world_size, 'fewer shards than ranks'
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_batch_size(self, batch_size):
+        self.batch_size = batch_size
+
+    def unshuffled(self):
+        """
+            A copy streaming shards in order without the shuffle buffer, e.g. to collect a few vis samples.
+        """
+        ret = copy.copy(self)
+        ret.shuffle = False
+        ret.batch_size = 1
+        return ret
+
+    def n_items(self, n_samples):
+        return n_samples
+
+    def __len__(self):
+        return math.ceil(self.n_items(self.meta['n_samples']) / self.world_size)
+
+    def _iter_raw(self, shards, stride, offset):
+        i = 0
+        for shard in shards:
+            for key, sample in iter_tar_samples(os.path.join(self.root_path, shard['name'] + '.tar')):
+                if i % stride == offset:
+                    yield key, sample
+                i += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        rng = np.random.RandomState(self.seed + self.epoch)
+        order = rng.permutation(len(self.shards)) if self.shuffle else np.arange(len(self.shards))
+        shards = [self.shards[i] for i in order[self.rank::self.world_size]]
+
+        # Split shards over workers, or samples if there are fewer shards than workers
+        n_rank = sum(shard['n'] for shard in shards)
+        if len(shards) >= n_workers:
+            counts = [sum(shard['n'] for shard in shards[w::n_workers]) for w in range(n_workers)]
+            shards, stride, offset = shards[worker_id::n_workers], 1, 0
+        else:
+            counts = [n_rank // n_workers + (w < n_rank % n_workers) for w in range(n_workers)]
+            stride, offset = n_workers, worker_id
+        counts = [self.n_items(c) for c in counts]
+
+        # Truncate from the last workers or cycle to get len(self) samples on this rank
+        diff = len(self) - sum(counts)
+        for w in reversed(range(n_workers)):
+            if diff >= 0:
+                break
+            d = min(counts[w], -diff)
+            counts[w] -= d
+            diff += d
+        active = [w for w in range(n_workers) if counts[w] > 0]
+        for i, w in enumerate(active):
+            counts[w] += diff // len(active) + (i < diff % len(active)) if diff > 0 else 0
+
+        # Whole batches per worker, len(self) // batch_size in total on every rank
+        b = self.batch_size
+        if b > 1:
+            batches = [c // b for c in counts]
+            short = len(self) // b - sum(batches)
+            for w in sorted(active, key=lambda w: -(counts[w] % b))[:short]:
+                batches[w] += 1
+            counts = [x * b for x in batches]
+        n = counts[worker_id]
+        if n == 0:
+            return
+
+        def stream():
+            count = 0
+            while True:
+                last = count
+                for item in self.decode_stream(self._iter_raw(shards, stride, offset)):
+                    yield item
+                    count += 1
+                    if count == n:
+                        return
+                if count == last:
+                    return
+
+        rng = np.random.RandomState((self.seed + self.epoch) * 1000 + self.rank * n_workers + worker_id)
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            yield from stream()
+            return
+        buf = []
+        for item in stream():
+            if len(buf) < self.shuffle_buffer:
+                buf.append(item)
+                continue
+            i = rng.randint(len(buf))
+            yield buf[i]
+            buf[i] = item
+        rng.shuffle(buf)
+        yield from buf
+
+    def decode_stream(self, raw):
+        for key, sample in raw:
+            yield self.decode(key, sample)
+
+
+@register('tar_imgrec')
+class TarImgrec(TarShardStream):
+    """
+        Streaming version of imgrec_dataset over an image set (celeba, imagenette) packed as tar shards.
+    """
+
+    def __init__(self, root_path, width, augment='none', uint8=False, draft=False, **kwargs):
+        super().__init__(root_path, **kwargs)
+        assert self.meta['kind'] == 'image'
+        self.draft_size = width if draft and augment == 'none' else None
+        self.augment = make_augment(augment)
+        self.transform = transforms.Compose([
+            transforms.Resize(width),
+            transforms.CenterCrop(width),
+            transforms.PILToTensor() if uint8 else transforms.ToTensor(),
+        ])
+
+    def decode(self, key, sample):
+        ext = next(iter(sample.keys()))
+        img = Image.open(io.BytesIO(sample[ext]))
+        if self.draft_size is not None:
+            img.draft('RGB', (self.draft_size, self.draft_size))
+        img = img.convert('RGB')
+        x = self.transform(self.augment(img))
+        return {'inp': x, 'gt': x}
+
+
+@register('tar_nvs')
+class TarNvs(TarShardStream):
+    """
+        Streaming NVS dataset over objects packed as tar shards, members of an object are
+        {key}.imgs.npy (N, H, W, 3) uint8, {key}.cams.npy (N, 16) as in nvs_shards, {key}.masks.npy (N, H, W) uint8
+        if has_masks and {key}.json {'index', 'cat'}.
+        Each object read yields repeat samples with different views.
+    """
+
+    def __init__(self, root_path, n_support, n_query, repeat=1, retcat=False, return_masks=False, uint8=False,
+                 return_ids=False, **kwargs):
+        super().__init__(root_path, **kwargs)
+        assert self.meta['kind'] == 'nvs'
+        self.near = self.meta['near']
+        self.far = self.meta['far']
+        self.avg_intrinsics = self.meta['avg_intrinsics']
+        self.cat2int = {c: i for i, c in enumerate(self.meta['cats'])}
+        self.n_support = n_support
+        self.n_query = n_query
+        self.repeat = repeat
+        self.retcat = retcat
+        self.return_masks = return_masks
+        self.uint8 = uint8
+        self.return_ids = return_ids
+        assert not return_masks or self.meta['has_masks']
+
+    def n_items(self, n_samples):
+        return n_samples * self.repeat
+
+    def decode_stream(self, raw):
+        for key, sample in raw:
+            obj = self.decode(key, sample)
+            for _ in range(self.repeat):
+                yield self.make_result(obj)
+
+    def decode(self, key, sample):
+        load = lambda ext: torch.from_numpy(np.load(io.BytesIO(sample[ext])))
+        obj = json.loads(sample['json'])
+        obj['imgs'] = load('imgs.npy').permute(0, 3, 1, 2)
+        obj['cams'] = load('cams.npy')
+        if self.return_masks:
+            obj['masks'] = load('masks.npy').bool()
+        return obj
+
+    def make_result(self, obj):
+        view_ids = np.random.choice(len(obj['imgs']), self.n_support + self.n_query, replace=False)
+        imgs = obj['imgs'][view_ids]
+        if not self.uint8:
+            imgs = imgs.float() / 255
+        cams = obj['cams'][view_ids]
+        poses = cams[:, :12].view(-1, 3, 4)
+        focals = cams[:, 12: 14]
+        if self.avg_intrinsics:
+            focals = focals.mean(dim=0, keepdim=True).expand(len(focals), -1)
+
+        t = self.n_support
+        result = {
+            'support_imgs': imgs[:t],
+            'support_poses': poses[:t],
+            'support_focals': focals[:t],
+            'query_imgs': imgs[t:],
+            'query_poses': poses[t:],
+            'query_focals': focals[t:],
+            'near': self.near,
+            'far': self.far,
+        }
+        if self.return_masks:
+            result['support_masks'] = obj['masks'][view_ids[:t]]
+            result['query_masks'] = obj['masks'][view_ids[t:]]
+        if self.retcat:
+            result['cat'] = self.cat2int[obj['cat']]
+        if self.return_ids:
+            result['obj_id'] = obj['index']
+            result['query_view_ids'] = torch.from_numpy(view_ids[t:])
+        return result
@@ -0,0 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ViewDecodePool():
+    """
+        Decodes the views of one sample concurrently. Image decoding and file reads mostly release the GIL,
+        so a few threads cut the latency of a sample with many views (vis, single-process eval).
+
+        The thread pool is created lazily per process (again after fork, e.g. in each DataLoader worker)
+        and is not pickled. With n_threads <= 1, map() runs serially in the caller.
+    """
+
+    def __init__(self, n_threads=0):
+        self.n_threads = n_threads
+        self.pool = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['pid'] = None
+        return state
+
+    def map(self, fn, items):
+        items = list(items)
+        if self.n_threads <= 1 or len(items) <= 1:
+            return [fn(x) for x in items]
+        if self.pid != os.getpid():
+            self.pool = ThreadPoolExecutor(self.n_threads)
+            self.pid = os.getpid()
+        return list(self.pool.map(fn, items))
@@ -1,8 +1,11 @@
-from .models import register, make
-from . import trans_nf
-from . import trans_hybrid_nf
-from . import tokenizers
-from . import hyponets
-from . import transformer
-from . import resnet
-from . import experimental
+from .models import register, register_lazy, get, make
+
+# Modules are imported on first make() of one of their names
+register_lazy('models.trans_nf', ['trans_nf'])
+register_lazy('models.trans_hybrid_nf', ['trans_hybrid_nf'])
+register_lazy('models.tokenizers', ['imgrec_tokenizer', 'nvs_tokenizer', 'nvs_analytic_tokenizer'])
+register_lazy('models.hyponets', ['hypo_mlp', 'hypo_nerf', 'hypo_hybrid_nerf'])
+register_lazy('models.transformer', ['transformer_encoder'])
+register_lazy('models.resnet', ['resnet18', 'resnet34', 'resnet50'])
+register_lazy('models.experimental', ['trans_nf_baseonly'])
+register_lazy('models.archive.trans_hybrid_nf_r34', ['trans_hybrid_nf_r34'])
@@ -1,5 +1,3 @@
-import math
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,24 +5,13 @@ import einops
 
 import models
 from models import register
-
-
-def init_wb(shape):
-    weight = torch.empty(shape[1], shape[0] - 1)
-    nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
-
-    bias = torch.empty(shape[1], 1)
-    fan_in, _ = nn.init._calculate_fan_in_and_fan_out(weight)
-    bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
-    nn.init.uniform_(bias, -bound, bound)
-
-    return torch.cat([weight, bias], dim=1).t().detach()
+from models.param_gen import init_wb, make_param_groups, generate_modulated_params
 
 
 @register('trans_hybrid_nf_r34')
 class TransHybridNfR34(nn.Module):
 
-    def __init__(self, tokenizer, hyponet, n_groups, transformer_encoder):
+    def __init__(self, tokenizer, hyponet, n_groups, transformer_encoder, freeze_encoder=False):
         super().__init__()
         dim = transformer_encoder['args']['dim']
         self.tokenizer = models.make(tokenizer, args={'dim': dim})
@@ -37,6 +24,10 @@ class TransHybridNfR34(nn.Module):
             'sd': torch.load('./assets/resnet34.pth'),
         }
         self.resnet_encoder = models.make(resnet_encoder, load_sd=True)
+        # A frozen encoder can be replaced by features from scripts/build_feature_cache.py (support_feats_* in data)
+        self.freeze_encoder = freeze_encoder
+        if freeze_encoder:
+            self.resnet_encoder.requires_grad_(False)
 
         self.base_params = nn.ParameterDict()
         n_wtokens = 0
@@ -53,12 +44,27 @@ class TransHybridNfR34(nn.Module):
             self.wtoken_rng[name] = (n_wtokens, n_wtokens + g)
             n_wtokens += g
         self.wtokens = nn.Parameter(torch.randn(n_wtokens, dim))
+        self.param_groups = make_param_groups(self.hyponet.param_shapes, self.wtoken_rng)
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.freeze_encoder:
+            self.resnet_encoder.eval()
+        return self
 
     def forward(self, data):
         imgs = data['support_imgs']
         B, N = imgs.shape[:2]
-        imgs = imgs.view(B * N, *imgs.shape[2:])
-        featmaps = self.resnet_encoder(imgs)
+        if 'support_feats_0' in data:
+            featmaps = []
+            i = 0
+            while f'support_feats_{i}' in data:
+                x = data[f'support_feats_{i}']
+                featmaps.append(x.view(B * N, *x.shape[2:]).float())
+                i += 1
+        else:
+            imgs = imgs.view(B * N, *imgs.shape[2:])
+            featmaps = self.resnet_encoder(imgs)
         resized = [featmaps[0]]
         for i in range(1, len(featmaps)):
             x = F.interpolate(featmaps[i], size=featmaps[0].shape[2:], mode='bilinear', align_corners=False)
@@ -78,21 +84,10 @@ class TransHybridNfR34(nn.Module):
 
         trans_out = trans_out[:, -len(self.wtokens):, :]
 
-        params = dict()
-        for name, shape in self.hyponet.param_shapes.items():
-            wb = einops.repeat(self.base_params[name], 'n m -> b n m', b=B)
-            w, b = wb[:, :-1, :], wb[:, -1:, :]
-
-            l, r = self.wtoken_rng[name]
-            x = self.wtoken_postfc[name](trans_out[:, l: r, :])
-            x = x.transpose(-1, -2) # (B, shape[0] - 1, g)
-            w = F.normalize(w * x.repeat(1, 1, w.shape[2] // x.shape[2]), dim=1)
-
-            wb = torch.cat([w, b], dim=1)
-            params[name] = wb
+        params = generate_modulated_params(trans_out, self.base_params, self.wtoken_postfc, self.param_groups)
 
         params['_featmaps'] = featmaps
         params['_poses'] = data['support_poses']
-        params['_HWf'] = (*data['support_imgs'].shape[-2:], data['focal'][0].item())
+        params['_HWf'] = (*data['support_imgs'].shape[-2:], data['support_focals'])
         self.hyponet.set_params(params)
         return self.hyponet
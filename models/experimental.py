@@ -1,5 +1,3 @@
-import math
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,18 +5,7 @@ import einops
 
 import models
 from models import register
-
-
-def init_wb(shape):
-    weight = torch.empty(shape[1], shape[0] - 1)
-    nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
-
-    bias = torch.empty(shape[1], 1)
-    fan_in, _ = nn.init._calculate_fan_in_and_fan_out(weight)
-    bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
-    nn.init.uniform_(bias, -bound, bound)
-
-    return torch.cat([weight, bias], dim=1).t().detach()
+from .param_gen import init_wb
 
 
 @register('trans_nf_baseonly')
@@ -33,12 +20,8 @@ class TransNfBaseonly(nn.Module):
             self.base_params[name] = nn.Parameter(init_wb(shape))
 
     def forward(self, data):
-        B = data['support_imgs'].shape[0]
-
-        params = dict()
-        for name, shape in self.hyponet.param_shapes.items():
-            wb = einops.repeat(self.base_params[name], 'n m -> b n m', b=B)
-            params[name] = wb
+        # batched_linear_mm broadcasts unbatched params over the batch
+        params = dict(self.base_params.items())
 
         self.hyponet.set_params(params)
         return self.hyponet
@@ -1,7 +1,16 @@
+from collections import namedtuple
+
 import torch
 
 
+# Factored per-object params: wb = base + u @ v, base: (D1 + 1, D2), u: (B, D1 + 1, r), v: (B, r, D2)
+LowrankWb = namedtuple('LowrankWb', ['base', 'u', 'v'])
+
+
 def batched_linear_mm(x, wb):
-    # x: (B, N, D1); wb: (B, D1 + 1, D2) or (D1 + 1, D2)
+    # x: (B, N, D1); wb: (B, D1 + 1, D2) or (D1 + 1, D2) or LowrankWb
     one = torch.ones(*x.shape[:-1], 1, device=x.device)
-    return torch.matmul(torch.cat([x, one], dim=-1), wb)
+    x = torch.cat([x, one], dim=-1)
+    if isinstance(wb, LowrankWb):
+        return torch.matmul(x, wb.base) + torch.matmul(torch.matmul(x, wb.u), wb.v)
+    return torch.matmul(x, wb)
@@ -1,7 +1,9 @@
 import copy
+import importlib
 
 
 models = {}
+lazy_models = {}
 
 
 def register(name):
@@ -11,13 +13,27 @@ def register(name):
     return decorator
 
 
+def register_lazy(module, names):
+    """
+        Names registered in module, which is imported on first use of one of them.
+    """
+    for name in names:
+        lazy_models[name] = module
+
+
+def get(name):
+    if name not in models and name in lazy_models:
+        importlib.import_module(lazy_models[name])
+    return models[name]
+
+
 def make(model_spec, args=None, load_sd=False):
     if args is not None:
         model_args = copy.deepcopy(model_spec['args'])
         model_args.update(args)
     else:
         model_args = model_spec['args']
-    model = models[model_spec['name']](**model_args)
+    model = get(model_spec['name'])(**model_args)
     if load_sd:
         model.load_state_dict(model_spec['sd'])
     return model
@@ -0,0 +1,141 @@
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .hyponets.layers import LowrankWb
+
+
+def init_wb(shape):
+    weight = torch.empty(shape[1], shape[0] - 1)
+    nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
+
+    bias = torch.empty(shape[1], 1)
+    fan_in, _ = nn.init._calculate_fan_in_and_fan_out(weight)
+    bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
+    nn.init.uniform_(bias, -bound, bound)
+
+    return torch.cat([weight, bias], dim=1).t().detach()
+
+
+def make_wtoken_postfc(dim, shape, wgen_mode):
+    """
+        modulate: a wtoken gives a scale for each of the shape[0] - 1 input dims.
+        lowrank: a wtoken gives a column of u (shape[0]) and a row of v (shape[1]),
+        v is zero-initialized so that generated params start at base.
+    """
+    if wgen_mode == 'modulate':
+        return nn.Sequential(
+            nn.LayerNorm(dim), ##
+            nn.Linear(dim, shape[0] - 1),
+        )
+    elif wgen_mode == 'lowrank':
+        fc = nn.Linear(dim, shape[0] + shape[1])
+        with torch.no_grad():
+            fc.weight[shape[0]:].zero_()
+            fc.bias[shape[0]:].zero_()
+        return nn.Sequential(nn.LayerNorm(dim), fc)
+
+
+def make_param_groups(param_shapes, wtoken_rng):
+    """
+        Group hyponet params that share the same shape and number of wtokens,
+        so that they can be generated with one batched op per group.
+
+        Returns:
+            list of (shape, n_tokens, names, token_slices), token_slices are merged contiguous ranges.
+    """
+    groups = dict()
+    for name, shape in param_shapes.items():
+        l, r = wtoken_rng[name]
+        groups.setdefault((tuple(shape), r - l), []).append(name)
+
+    ret = []
+    for (shape, g), names in groups.items():
+        token_slices = []
+        for name in names:
+            l, r = wtoken_rng[name]
+            if len(token_slices) > 0 and token_slices[-1][1] == l:
+                token_slices[-1] = (token_slices[-1][0], r)
+            else:
+                token_slices.append((l, r))
+        ret.append((shape, g, names, token_slices))
+    return ret
+
+
+def gather_tokens(x, token_slices):
+    if len(token_slices) == 1:
+        l, r = token_slices[0]
+        return x[:, l: r, :]
+    return torch.cat([x[:, l: r, :] for l, r in token_slices], dim=1)
+
+
+def batched_postfc(x, postfcs):
+    """
+        Apply a list of LayerNorm + Linear postfcs, one per layer, in one batched op.
+
+        Args:
+            x: (B, L, g, dim), L is the number of layers
+            postfcs: list of L nn.Sequential(nn.LayerNorm, nn.Linear)
+        Returns:
+            (B, L, g, out_dim)
+    """
+    lns = [_[0] for _ in postfcs]
+    fcs = [_[1] for _ in postfcs]
+    x = F.layer_norm(x, x.shape[-1:], eps=lns[0].eps)
+    x = x * torch.stack([_.weight for _ in lns]).unsqueeze(1) + torch.stack([_.bias for _ in lns]).unsqueeze(1)
+    x = torch.einsum('blgd,lod->blgo', x, torch.stack([_.weight for _ in fcs]))
+    return x + torch.stack([_.bias for _ in fcs]).unsqueeze(1)
+
+
+def generate_modulated_params(trans_out, base_params, wtoken_postfc, param_groups):
+    """
+        Batched form of modulating each base weight by its postfc(wtokens) layer by layer.
+        base_params are broadcast over the batch instead of being repeated.
+
+        Args:
+            trans_out: (B, n_wtokens, dim)
+        Returns:
+            params: dict of (B, shape[0], shape[1]), params of a group are views into one packed buffer.
+    """
+    B = trans_out.shape[0]
+    params = dict()
+    for shape, g, names, token_slices in param_groups:
+        L = len(names)
+        x = gather_tokens(trans_out, token_slices).view(B, L, g, -1)
+        x = batched_postfc(x, [wtoken_postfc[_] for _ in names])
+        x = x.transpose(-1, -2) # (B, L, shape[0] - 1, g)
+
+        wb = torch.stack([base_params[_] for _ in names]) # (L, shape[0], shape[1])
+        w, b = wb[:, :-1, :], wb[:, -1:, :]
+        w = w.view(L, shape[0] - 1, shape[1] // g, g) * x.unsqueeze(-2)
+        w = F.normalize(w.view(B, L, shape[0] - 1, shape[1]), dim=2)
+
+        wb = torch.cat([w, b.expand(B, -1, -1, -1)], dim=2)
+        for i, name in enumerate(names):
+            params[name] = wb[:, i]
+    return params
+
+
+def generate_lowrank_params(trans_out, base_params, wtoken_postfc, param_groups):
+    """
+        Generate per-object params as base + u @ v in factored form, the (shape[0], shape[1]) matrix
+        is never formed per object. The rank of a param is its number of wtokens.
+
+        Args:
+            trans_out: (B, n_wtokens, dim)
+        Returns:
+            params: dict of LowrankWb(base, u, v), u: (B, shape[0], r), v: (B, r, shape[1])
+    """
+    B = trans_out.shape[0]
+    params = dict()
+    for shape, r, names, token_slices in param_groups:
+        L = len(names)
+        x = gather_tokens(trans_out, token_slices).view(B, L, r, -1)
+        x = batched_postfc(x, [wtoken_postfc[_] for _ in names]) # (B, L, r, shape[0] + shape[1])
+        u = x[..., :shape[0]].transpose(-1, -2) * (r ** -0.5)
+        v = x[..., shape[0]:]
+        for i, name in enumerate(names):
+            params[name] = LowrankWb(base_params[name], u[:, i], v[:, i])
+    return params
@@ -1,8 +1,10 @@
 from typing import Type, Any, Callable, Union, List, Optional
+import copy
 
 import torch
 import torch.nn as nn
 from torch import Tensor
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from models.models import register
 
@@ -18,6 +20,8 @@ __all__ = [
     "resnext101_32x8d",
     "wide_resnet50_2",
     "wide_resnet101_2",
+    "fuse_conv_bn_",
+    "optimize_for_inference",
 ]
 
 
@@ -259,7 +263,7 @@ class ResNet(nn.Module):
 
         return nn.Sequential(*layers)
 
-    def _forward_impl(self, x: Tensor) -> Tensor:
+    def _forward_impl(self, x: Tensor) -> List[Tensor]:
         # See note [TorchScript super()]
         rets = []
 
@@ -284,10 +288,73 @@ class ResNet(nn.Module):
 
         # return x
 
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor) -> List[Tensor]:
         return self._forward_impl(x)
 
 
+def fuse_conv_bn_(model: nn.Module) -> nn.Module:
+    """Fold eval-mode BatchNorm into the preceding convolutions of a ResNet, in place.
+
+    The folded BatchNorm layers are replaced by nn.Identity, so the state dict of the result
+    no longer matches the unfused model.
+    """
+    assert not model.training, "BatchNorm can only be folded in eval mode"
+    for m in model.modules():
+        if isinstance(m, ResNet):
+            pairs = [("conv1", "bn1")]
+        elif isinstance(m, BasicBlock):
+            pairs = [("conv1", "bn1"), ("conv2", "bn2")]
+        elif isinstance(m, Bottleneck):
+            pairs = [("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")]
+        else:
+            continue
+        for conv, bn in pairs:
+            if isinstance(getattr(m, bn), nn.BatchNorm2d):
+                setattr(m, conv, fuse_conv_bn_eval(getattr(m, conv), getattr(m, bn)))
+                setattr(m, bn, nn.Identity())
+        ds = getattr(m, "downsample", None)
+        if isinstance(ds, nn.Sequential) and len(ds) == 2 and isinstance(ds[1], nn.BatchNorm2d):
+            m.downsample = nn.Sequential(fuse_conv_bn_eval(ds[0], ds[1]))
+    return model
+
+
+def optimize_for_inference(
+    model: nn.Module,
+    example_input: Tensor,
+    channels_last: bool = True,
+    script: bool = False,
+    rtol: float = 1e-3,
+    atol: float = 1e-4,
+) -> nn.Module:
+    """Returns an inference copy of a ResNet encoder, the input model is not modified.
+
+    BatchNorm is folded into the convolutions, weights are converted to channels-last, and
+    optionally the result is scripted and frozen. The outputs on example_input are checked
+    against the unfused model.
+
+    Args:
+        model (nn.Module): The ResNet encoder
+        example_input (Tensor): A (B, 3, H, W) input on the model's device used for verification
+        channels_last (bool): If True, converts weights to channels-last memory format
+        script (bool): If True, returns a frozen TorchScript module
+    """
+    ref = copy.deepcopy(model).eval()
+    fused = fuse_conv_bn_(copy.deepcopy(model).eval())
+    if channels_last:
+        fused = fused.to(memory_format=torch.channels_last)
+    if script:
+        fused = torch.jit.freeze(torch.jit.script(fused))
+
+    with torch.no_grad():
+        ref_out = ref(example_input)
+        x = example_input.contiguous(memory_format=torch.channels_last) if channels_last else example_input
+        fused_out = fused(x)
+    for i, (a, b) in enumerate(zip(ref_out, fused_out)):
+        if not torch.allclose(a, b, rtol=rtol, atol=atol):
+            raise RuntimeError(f"Fused encoder output {i} mismatch: max abs diff {(a - b).abs().max().item():.3e}")
+    return fused
+
+
 def _resnet(
     arch: str,
     block: Type[Union[BasicBlock, Bottleneck]],
@@ -3,12 +3,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from models import register
+from .layers import unfold_patch_embed, conv_patch_embed
 
 
 @register('imgrec_tokenizer')
 class ImgrecTokenizer(nn.Module):
 
-    def __init__(self, input_size, patch_size, dim, padding=0, img_channels=3):
+    def __init__(self, input_size, patch_size, dim, padding=0, img_channels=3, conv_embed=False):
         super().__init__()
         if isinstance(input_size, int):
             input_size = (input_size, input_size)
@@ -18,14 +19,14 @@ class ImgrecTokenizer(nn.Module):
             padding = (padding, padding)
         self.patch_size = patch_size
         self.padding = padding
+        self.conv_embed = conv_embed
         self.prefc = nn.Linear(patch_size[0] * patch_size[1] * img_channels, dim)
         n_patches = ((input_size[0] + padding[0] * 2) // patch_size[0]) * ((input_size[1] + padding[1] * 2)  // patch_size[1])
         self.posemb = nn.Parameter(torch.randn(n_patches, dim))
 
     def forward(self, data):
         x = data['inp']
-        p = self.patch_size
-        x = F.unfold(x, p, stride=p, padding=self.padding) # (B, C * p * p, L)
-        x = x.permute(0, 2, 1).contiguous()
-        x = self.prefc(x) + self.posemb.unsqueeze(0)
+        patch_embed = conv_patch_embed if self.conv_embed else unfold_patch_embed
+        x = patch_embed(x, self.prefc.weight, self.prefc.bias, self.patch_size, self.padding)
+        x = x + self.posemb.unsqueeze(0)
         return x
@@ -0,0 +1,19 @@
+import torch
+import torch.nn.functional as F
+
+
+def unfold_patch_embed(x, weight, bias, patch_size, padding):
+    # x: (B, C, H, W); weight: (dim, C * p * p) -> (B, L, dim)
+    x = F.unfold(x, patch_size, stride=patch_size, padding=padding) # (B, C * p * p, L)
+    x = x.permute(0, 2, 1).contiguous()
+    return F.linear(x, weight, bias)
+
+
+def conv_patch_embed(x, weight, bias, patch_size, padding):
+    # Same as unfold_patch_embed (F.unfold flattens patches channel-major, matching the conv weight layout),
+    # computed by a strided conv in channels-last so that no patch tensor is materialized.
+    C = x.shape[1]
+    weight = weight.view(weight.shape[0], C, *patch_size).contiguous(memory_format=torch.channels_last)
+    x = x.contiguous(memory_format=torch.channels_last)
+    x = F.conv2d(x, weight, bias, stride=patch_size, padding=padding) # (B, dim, h, w)
+    return x.permute(0, 2, 3, 1).flatten(1, 2)
@@ -4,13 +4,14 @@ import torch.nn.functional as F
 import einops
 
 from models import register
+from .layers import unfold_patch_embed, conv_patch_embed
 from utils import poses_to_rays
 
 
 @register('nvs_tokenizer')
 class NvsTokenizer(nn.Module):
 
-    def __init__(self, input_size, patch_size, dim, padding=0, img_channels=3):
+    def __init__(self, input_size, patch_size, dim, padding=0, img_channels=3, conv_embed=False):
         super().__init__()
         if isinstance(input_size, int):
             input_size = (input_size, input_size)
@@ -20,6 +21,7 @@ class NvsTokenizer(nn.Module):
             padding = (padding, padding)
         self.patch_size = patch_size
         self.padding = padding
+        self.conv_embed = conv_embed
         self.prefc = nn.Linear(patch_size[0] * patch_size[1] * (img_channels + 3 + 3), dim)
         self.grid_shape = ((input_size[0] + padding[0] * 2) // patch_size[0],
                            (input_size[1] + padding[1] * 2) // patch_size[1])
@@ -34,9 +36,72 @@ class NvsTokenizer(nn.Module):
 
         x = torch.cat([imgs, rays_o, rays_d], dim=2)
         x = einops.rearrange(x, 'b n d h w -> (b n) d h w')
-        p = self.patch_size
-        x = F.unfold(x, p, stride=p, padding=self.padding)
-        x = einops.rearrange(x, '(b n) ppd l -> b (n l) ppd', b=B)
+        patch_embed = conv_patch_embed if self.conv_embed else unfold_patch_embed
+        x = patch_embed(x, self.prefc.weight, self.prefc.bias, self.patch_size, self.padding)
+        x = einops.rearrange(x, '(b n) l d -> b (n l) d', b=B)
+        return x
+
+
+@register('nvs_analytic_tokenizer')
+class NvsAnalyticTokenizer(NvsTokenizer):
+    """
+        Same params and outputs as NvsTokenizer, only image pixels are patchified.
+        Since rays_o is constant per view and rays_d is linear in the pixel offsets, the ray part of each
+        patch embedding is computed from pose and focal with a per-patch basis of the pixel offsets.
+    """
+
+    def __init__(self, input_size, patch_size, dim, padding=0, img_channels=3, conv_embed=False):
+        super().__init__(input_size, patch_size, dim, padding=padding, img_channels=img_channels, conv_embed=conv_embed)
+        if isinstance(input_size, int):
+            input_size = (input_size, input_size)
+        self.input_size = tuple(input_size)
+        self.img_channels = img_channels
+        self.register_buffer('ray_basis', self.make_ray_basis(), persistent=False)
+
+    def make_ray_basis(self):
+        """
+            Returns:
+                basis: (L, 3, p * p), the (x - W / 2, y - H / 2, 1) of each pixel in each patch,
+                zero at padded pixels (which are zero in the unfolded ray maps).
+        """
+        H, W = self.input_size
+        ph, pw = self.patch_size
+        gh, gw = self.grid_shape
+        y = (torch.arange(gh) * ph - self.padding[0]).view(gh, 1, 1, 1) + torch.arange(ph).view(1, 1, ph, 1)
+        x = (torch.arange(gw) * pw - self.padding[1]).view(1, gw, 1, 1) + torch.arange(pw).view(1, 1, 1, pw)
+        valid = ((y >= 0) & (y < H) & (x >= 0) & (x < W)).float() # gh gw ph pw
+        basis = torch.stack([
+            (x + 0.5 - W / 2) * valid,
+            (y + 0.5 - H / 2) * valid,
+            valid,
+        ], dim=2)
+        return basis.view(gh * gw, 3, ph * pw)
+
+    def forward(self, data):
+        imgs = data['support_imgs']
+        B = imgs.shape[0]
+        assert tuple(imgs.shape[-2:]) == self.input_size
+        C = self.img_channels
+        weight = self.prefc.weight.view(self.prefc.weight.shape[0], C + 3 + 3, -1) # dim, C + 6, p * p
+
+        x = einops.rearrange(imgs, 'b n c h w -> (b n) c h w')
+        patch_embed = conv_patch_embed if self.conv_embed else unfold_patch_embed
+        x = patch_embed(x, weight[:, :C].reshape(weight.shape[0], -1), self.prefc.bias, self.patch_size, self.padding)
+
+        # rays_d = R[:, 0] * (x - W / 2) / fx - R[:, 1] * (y - H / 2) / fy - R[:, 2]
+        s_o = torch.einsum('dck,lk->lcd', weight[:, C: C + 3], self.ray_basis[:, 2])
+        s_d = torch.einsum('dck,lbk->lbcd', weight[:, C + 3:], self.ray_basis)
+        s = torch.cat([s_d, s_o.unsqueeze(1)], dim=1) # L 4 3 dim
+
+        poses = data['support_poses'].reshape(-1, 3, 4)
+        focals = data['support_focals'].reshape(-1, 2)
+        coef = torch.stack([
+            poses[..., 0] / focals[:, 0:1],
+            -poses[..., 1] / focals[:, 1:2],
+            -poses[..., 2],
+            poses[..., 3],
+        ], dim=1) # (b n) 4 3
+        x = x + torch.einsum('nbc,lbcd->nld', coef, s)
 
-        x = self.prefc(x)
+        x = einops.rearrange(x, '(b n) l d -> b (n l) d', b=B)
         return x
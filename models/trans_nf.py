@@ -1,5 +1,3 @@
-import math
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -7,45 +5,39 @@ import einops
 
 import models
 from models import register
-
-
-def init_wb(shape):
-    weight = torch.empty(shape[1], shape[0] - 1)
-    nn.init.kaiming_uniform_(weight, a=math.sqrt(5))
-
-    bias = torch.empty(shape[1], 1)
-    fan_in, _ = nn.init._calculate_fan_in_and_fan_out(weight)
-    bound = 1 / math.sqrt(fan_in) if fan_in > 0 else 0
-    nn.init.uniform_(bias, -bound, bound)
-
-    return torch.cat([weight, bias], dim=1).t().detach()
+from .param_gen import init_wb, make_wtoken_postfc, make_param_groups, \
+    generate_modulated_params, generate_lowrank_params
 
 
 @register('trans_nf')
 class TransNf(nn.Module):
 
-    def __init__(self, tokenizer, hyponet, n_groups, transformer_encoder):
+    def __init__(self, tokenizer, hyponet, n_groups, transformer_encoder, wgen_mode='modulate', lowrank_rank=8):
         super().__init__()
         dim = transformer_encoder['args']['dim']
         self.tokenizer = models.make(tokenizer, args={'dim': dim})
         self.hyponet = models.make(hyponet)
         self.transformer_encoder = models.make(transformer_encoder)
 
+        self.wgen_mode = wgen_mode
         self.base_params = nn.ParameterDict()
         n_wtokens = 0
         self.wtoken_postfc = nn.ModuleDict()
         self.wtoken_rng = dict()
         for name, shape in self.hyponet.param_shapes.items():
             self.base_params[name] = nn.Parameter(init_wb(shape))
-            g = min(n_groups, shape[1])
-            assert shape[1] % g == 0
-            self.wtoken_postfc[name] = nn.Sequential(
-                nn.LayerNorm(dim), ##
-                nn.Linear(dim, shape[0] - 1),
-            )
+            if wgen_mode == 'modulate':
+                g = min(n_groups, shape[1])
+                assert shape[1] % g == 0
+            elif wgen_mode == 'lowrank':
+                g = lowrank_rank
+            else:
+                raise ValueError(f'unknown wgen_mode {wgen_mode}')
+            self.wtoken_postfc[name] = make_wtoken_postfc(dim, shape, wgen_mode)
             self.wtoken_rng[name] = (n_wtokens, n_wtokens + g)
             n_wtokens += g
         self.wtokens = nn.Parameter(torch.randn(n_wtokens, dim))
+        self.param_groups = make_param_groups(self.hyponet.param_shapes, self.wtoken_rng)
 
     def forward(self, data):
         dtokens = self.tokenizer(data)
@@ -54,18 +46,12 @@ class TransNf(nn.Module):
         trans_out = self.transformer_encoder(torch.cat([dtokens, wtokens], dim=1))
         trans_out = trans_out[:, -len(self.wtokens):, :]
 
-        params = dict()
-        for name, shape in self.hyponet.param_shapes.items():
-            wb = einops.repeat(self.base_params[name], 'n m -> b n m', b=B)
-            w, b = wb[:, :-1, :], wb[:, -1:, :]
-
-            l, r = self.wtoken_rng[name]
-            x = self.wtoken_postfc[name](trans_out[:, l: r, :])
-            x = x.transpose(-1, -2) # (B, shape[0] - 1, g)
-            w = F.normalize(w * x.repeat(1, 1, w.shape[2] // x.shape[2]), dim=1)
-
-            wb = torch.cat([w, b], dim=1)
-            params[name] = wb
+        if self.wgen_mode == 'modulate':
+            params = generate_modulated_params(trans_out, self.base_params, self.wtoken_postfc, self.param_groups)
+        elif self.wgen_mode == 'lowrank':
+            params = generate_lowrank_params(trans_out, self.base_params, self.wtoken_postfc, self.param_groups)
+        else:
+            raise ValueError(f'unknown wgen_mode {self.wgen_mode}')
 
         self.hyponet.set_params(params)
         return self.hyponet
@@ -0,0 +1,78 @@
+"""
+    Precompute frozen resnet34 features for every view of an NVS dataset, for trans_hybrid_nf_r34 with freeze_encoder.
+    The cache is used by passing feature_cache: <out> in the dataset args.
+
+    python scripts/build_feature_cache.py --cfg cfgs/xxx.yaml --dataset train_dataset -o <out>
+"""
+
+import argparse
+import os
+import json
+
+import yaml
+import torch
+import numpy as np
+from tqdm import tqdm
+
+import datasets
+import models
+from models.resnet import optimize_for_inference
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg')
+    parser.add_argument('--dataset', default='train_dataset')
+    parser.add_argument('--load-root', default='../../data')
+    parser.add_argument('--encoder', default='assets/resnet34.pth')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--gpu', '-g', default='0')
+    parser.add_argument('--outdir', '-o')
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    dataset_spec = cfg[args.dataset]
+    dataset_args = {k: (v.replace('$load_root$', args.load_root) if isinstance(v, str) else v)
+                    for k, v in dataset_spec['args'].items()}
+    dataset_args.update({'repeat': 1, 'feature_cache': None})
+    dataset = datasets.make({'name': dataset_spec['name'], 'args': dataset_args})
+
+    encoder = models.make({'name': 'resnet34', 'args': {}, 'sd': torch.load(args.encoder, map_location='cpu')}, load_sd=True)
+    encoder.cuda().eval()
+
+    if os.path.exists(args.outdir):
+        print('outdir exists!')
+        exit()
+    os.makedirs(args.outdir)
+
+    objects = dict()
+    levels = None
+    files = None
+    n_views = 0
+    with torch.no_grad():
+        for index in tqdm(range(len(dataset))):
+            key, imgs = dataset.load_object_views(index)
+            if levels is None:
+                encoder = optimize_for_inference(encoder, imgs[:1].cuda())
+            feats = [[] for _ in range(4)]
+            for i in range(0, len(imgs), args.batch_size):
+                x = imgs[i: i + args.batch_size].cuda().contiguous(memory_format=torch.channels_last)
+                for j, y in enumerate(encoder(x)):
+                    feats[j].append(y.half().contiguous().cpu().numpy())
+            feats = [np.concatenate(_, axis=0) for _ in feats]
+
+            if levels is None:
+                levels = [list(_.shape[1:]) for _ in feats]
+                files = [open(os.path.join(args.outdir, f'level{j}.bin'), 'wb') for j in range(len(levels))]
+            for f, x in zip(files, feats):
+                f.write(x.tobytes())
+            objects[key] = [n_views, len(imgs)]
+            n_views += len(imgs)
+
+    for f in files:
+        f.close()
+    with open(os.path.join(args.outdir, 'index.json'), 'w') as f:
+        json.dump({'levels': levels, 'n_views': n_views, 'objects': objects}, f)
@@ -0,0 +1,57 @@
+"""
+    Run the imgrec_dataset transform (Resize, CenterCrop) once over an image set and store the results as a
+    (N, 3, width, width) uint8 memmap. The cache is used by passing cache_path: <out> in the imgrec_dataset args.
+
+    python scripts/build_imgrec_cache.py --cfg cfgs/xxx.yaml --dataset train_dataset -o <out>
+"""
+
+import argparse
+import os
+import json
+
+import yaml
+import numpy as np
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+import datasets
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg')
+    parser.add_argument('--dataset', default='train_dataset')
+    parser.add_argument('--load-root', default='../../data')
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--outdir', '-o')
+    args = parser.parse_args()
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    dataset_spec = cfg[args.dataset]
+    assert dataset_spec['name'] == 'imgrec_dataset'
+    imageset = dataset_spec['args']['imageset']
+    imageset = {'name': imageset['name'],
+                'args': {k: (v.replace('$load_root$', args.load_root) if isinstance(v, str) else v)
+                         for k, v in imageset['args'].items()}}
+    assert imageset['args'].get('augment', 'none') == 'none', 'the cached transform must be deterministic'
+    width = dataset_spec['args']['width']
+    dataset = datasets.make({'name': 'imgrec_dataset', 'args': {'imageset': imageset, 'width': width, 'uint8': True}})
+
+    if os.path.exists(args.outdir):
+        print('outdir exists!')
+        exit()
+    os.makedirs(args.outdir)
+
+    n = len(dataset)
+    imgs = np.memmap(os.path.join(args.outdir, 'imgs.bin'), dtype=np.uint8, mode='w+', shape=(n, 3, width, width))
+    loader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=args.num_workers)
+    i = 0
+    for data in tqdm(loader):
+        x = data['gt'].numpy()
+        imgs[i: i + len(x)] = x
+        i += len(x)
+    imgs.flush()
+
+    with open(os.path.join(args.outdir, 'meta.json'), 'w') as f:
+        json.dump({'n': n, 'width': width, 'imageset': imageset}, f)
@@ -0,0 +1,47 @@
+"""
+    Add a ray bank (per-pixel rays_d and foreground flags) to shards packed by scripts/pack_nvs_shards.py,
+    for the nvs_ray_bank dataset. Foreground is any pixel that is not white, as in NvsTrainer adaptive sampling.
+
+    python scripts/build_ray_bank.py -i <shards>
+"""
+
+import argparse
+import os
+import json
+
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from utils import poses_to_rays
+from datasets.meta_index import foreground_mask
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i')
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    with open(os.path.join(args.input, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('ray_bank', False):
+        print('ray bank exists!')
+        exit()
+    H, W = meta['image_size']
+
+    for k, n in enumerate(tqdm(meta['shards'])):
+        prefix = os.path.join(args.input, f'shard{k}')
+        imgs = np.memmap(prefix + '.imgs.bin', dtype=np.uint8, mode='r', shape=(n, H, W, 3))
+        cams = torch.from_numpy(np.load(prefix + '.cams.npy'))
+        with open(prefix + '.rays_d.bin', 'wb') as f_rays_d, open(prefix + '.fg.bin', 'wb') as f_fg:
+            for i in range(0, n, args.batch_size):
+                x = cams[i: i + args.batch_size]
+                _, rays_d = poses_to_rays(x[:, :12].view(-1, 3, 4), H, W, x[:, 12: 14].contiguous())
+                f_rays_d.write(rays_d.half().numpy().tobytes())
+                fg = foreground_mask(imgs[i: i + args.batch_size]).astype(np.uint8)
+                f_fg.write(fg.tobytes())
+
+    meta['ray_bank'] = True
+    with open(os.path.join(args.input, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
@@ -9,7 +9,7 @@ from tqdm import tqdm
 from torch.utils.data import DataLoader
 
 import models
-from utils import Averager, poses_to_rays, volume_rendering, batched_volume_rendering
+from utils import Averager, poses_to_rays, volume_rendering, batched_volume_rendering, normalize_uint8_imgs_
 from datasets.learnit_shapenet import LearnitShapenet
 
 
@@ -27,11 +27,14 @@ if __name__ == '__main__':
     parser.add_argument('--batch-size', type=int, default=1)
     parser.add_argument('--model', '-m')
     parser.add_argument('--gpu', '-g')
+    parser.add_argument('--uint8', action='store_true')
+    parser.add_argument('--manifest', default=None)
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
-    dataset = LearnitShapenet(args.dataset_root, args.category, 'test', args.n_support, args.n_query, repeat=args.repeat)
+    dataset = LearnitShapenet(args.dataset_root, args.category, 'test', args.n_support, args.n_query, repeat=args.repeat,
+                              uint8=args.uint8, manifest=args.manifest)
     loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=8, pin_memory=True)
 
     model = models.make(torch.load(args.model, map_location='cpu')['model'], load_sd=True)
@@ -43,6 +46,7 @@ if __name__ == '__main__':
     with torch.no_grad():
         for data in tqdm(loader):
             data = {k: v.cuda() for k, v in data.items()}
+            normalize_uint8_imgs_(data)
             query_imgs = data.pop('query_imgs')
             query_poses = data.pop('query_poses')
 
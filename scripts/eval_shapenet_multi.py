@@ -11,7 +11,7 @@ from tqdm import tqdm
 from torch.utils.data import DataLoader
 
 import models
-from utils import Averager, poses_to_rays, volume_rendering, batched_volume_rendering
+from utils import Averager, poses_to_rays, volume_rendering, batched_volume_rendering, normalize_uint8_imgs_
 from datasets.pixelnerf_dvr import PixelnerfDvr
 
 
@@ -27,13 +27,16 @@ if __name__ == '__main__':
     parser.add_argument('--batch-size', type=int, default=1)
     parser.add_argument('--model', '-m')
     parser.add_argument('--gpu', '-g')
+    parser.add_argument('--uint8', action='store_true')
+    parser.add_argument('--manifest', default=None)
     args = parser.parse_args()
 
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
     with open(os.path.join(args.dataset_root, 'metadata.yaml'), 'r') as f:
         metadata = yaml.load(f, Loader=yaml.FullLoader)
-    dataset = PixelnerfDvr('shapenet', args.dataset_root, 'test', args.n_support, args.n_query, repeat=args.repeat, retcat=True)
+    dataset = PixelnerfDvr('shapenet', args.dataset_root, 'test', args.n_support, args.n_query, repeat=args.repeat, retcat=True,
+                           uint8=args.uint8, manifest=args.manifest)
     loader = DataLoader(dataset, batch_size=args.batch_size, num_workers=8, pin_memory=True)
 
     model = models.make(torch.load(args.model, map_location='cpu')['model'], load_sd=True)
@@ -54,6 +57,7 @@ if __name__ == '__main__':
         pbar = tqdm(loader)
         for data in pbar:
             data = {k: v.cuda() for k, v in data.items()}
+            normalize_uint8_imgs_(data)
             query_imgs = data.pop('query_imgs')
             query_poses = data.pop('query_poses')
             cats = data.pop('cat')
@@ -0,0 +1,46 @@
+"""
+    Draw a fixed list of evaluation episodes (object, support view ids, query view ids) for an NVS dataset,
+    so that eval runs of different checkpoints see the same episodes. The manifest is replayed by passing
+    manifest: <out> in the dataset args (pixelnerf_shapenet, pixelnerf_dvr, learnit_shapenet) or --manifest
+    to the eval scripts; n_support and n_query must match.
+
+    python scripts/make_eval_manifest.py --cfg cfgs/xxx.yaml --dataset test_dataset -o <out>.json
+"""
+
+import argparse
+import os
+import json
+
+import yaml
+
+import datasets
+from datasets.episode_manifest import make_manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg')
+    parser.add_argument('--dataset', default='test_dataset')
+    parser.add_argument('--load-root', default='../../data')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n-episodes', type=int, default=None)
+    parser.add_argument('--out', '-o')
+    args = parser.parse_args()
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    dataset_spec = cfg[args.dataset]
+    dataset_args = {k: (v.replace('$load_root$', args.load_root) if isinstance(v, str) else v)
+                    for k, v in dataset_spec['args'].items()}
+    dataset_args['manifest'] = None
+    dataset = datasets.make({'name': dataset_spec['name'], 'args': dataset_args})
+
+    if os.path.exists(args.out):
+        print('out exists!')
+        exit()
+
+    manifest = make_manifest(dataset, seed=args.seed, n_episodes=args.n_episodes)
+    manifest['dataset'] = {'name': dataset_spec['name'], 'args': dataset_args}
+    with open(args.out, 'w') as f:
+        json.dump(manifest, f)
+    print(f'{len(manifest["episodes"])} episodes.')
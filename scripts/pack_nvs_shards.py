@@ -0,0 +1,112 @@
+"""
+    Pack all views of an NVS dataset (pixelnerf_shapenet, pixelnerf_dvr, learnit_shapenet) into memory-mapped shards
+    read by the nvs_shards dataset, see datasets/nvs_shards.py for the layout.
+
+    python scripts/pack_nvs_shards.py --cfg cfgs/xxx.yaml --dataset train_dataset -o <out>
+"""
+
+import argparse
+import os
+import json
+
+import yaml
+import numpy as np
+from tqdm import tqdm
+
+import datasets
+from datasets.nvs_shards import pack_object
+
+
+class ShardWriter():
+
+    def __init__(self, outdir, has_masks):
+        self.outdir = outdir
+        self.has_masks = has_masks
+        self.sizes = []
+        self.files = None
+
+    def new_shard(self):
+        self.close()
+        prefix = os.path.join(self.outdir, f'shard{len(self.sizes)}')
+        self.files = {'imgs': open(prefix + '.imgs.bin', 'wb'), 'cams': []}
+        if self.has_masks:
+            self.files['masks'] = open(prefix + '.masks.bin', 'wb')
+        self.sizes.append(0)
+
+    def write(self, imgs, masks, cams):
+        self.files['imgs'].write(imgs.tobytes())
+        if self.has_masks:
+            self.files['masks'].write(masks.tobytes())
+        self.files['cams'].append(cams)
+        self.sizes[-1] += len(imgs)
+
+    def close(self):
+        if self.files is None:
+            return
+        self.files['imgs'].close()
+        if self.has_masks:
+            self.files['masks'].close()
+        cams = np.concatenate(self.files['cams'], axis=0)
+        np.save(os.path.join(self.outdir, f'shard{len(self.sizes) - 1}.cams.npy'), cams)
+        self.files = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg')
+    parser.add_argument('--dataset', default='train_dataset')
+    parser.add_argument('--load-root', default='../../data')
+    parser.add_argument('--image-size', type=int, nargs=2, default=None)
+    parser.add_argument('--objects-per-shard', type=int, default=500)
+    parser.add_argument('--outdir', '-o')
+    args = parser.parse_args()
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    dataset_spec = cfg[args.dataset]
+    dataset_args = {k: (v.replace('$load_root$', args.load_root) if isinstance(v, str) else v)
+                    for k, v in dataset_spec['args'].items()}
+    dataset_args.update({'repeat': 1, 'feature_cache': None})
+    dataset = datasets.make({'name': dataset_spec['name'], 'args': dataset_args})
+
+    if os.path.exists(args.outdir):
+        print('outdir exists!')
+        exit()
+    os.makedirs(args.outdir)
+
+    meta = None
+    writer = None
+    objects = []
+    for index in tqdm(range(len(dataset))):
+        obj = dataset.load_object(index)
+        imgs, masks, cams = pack_object(obj, args.image_size)
+
+        if meta is None:
+            meta = {
+                'image_size': list(imgs.shape[1: 3]),
+                'near': obj['near'],
+                'far': obj['far'],
+                'avg_intrinsics': getattr(dataset, 'avg_intrinsics', False),
+                'has_masks': masks is not None,
+                'cats': getattr(dataset, 'cats', []),
+            }
+            writer = ShardWriter(args.outdir, meta['has_masks'])
+        assert list(imgs.shape[1: 3]) == meta['image_size']
+        assert (masks is not None) == meta['has_masks']
+
+        if len(objects) % args.objects_per_shard == 0:
+            writer.new_shard()
+        objects.append({
+            'key': obj['key'],
+            'cat': obj.get('cat'),
+            'shard': len(writer.sizes) - 1,
+            'offset': writer.sizes[-1],
+            'n': len(imgs),
+        })
+        writer.write(imgs, masks, cams)
+    writer.close()
+
+    meta['shards'] = writer.sizes
+    meta['objects'] = objects
+    with open(os.path.join(args.outdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
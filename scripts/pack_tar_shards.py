@@ -0,0 +1,130 @@
+"""
+    Pack a dataset into tar shards for sequential streaming, see datasets/tar_shards.py.
+        Image sets (celeba, imagenette, or imgrec_dataset over them): encoded files are stored as is, read by tar_imgrec.
+        NVS datasets with load_object (pixelnerf_shapenet, pixelnerf_dvr, learnit_shapenet, co3d_nvs, nvs_shards):
+        all views of an object are stored as uint8 arrays, read by tar_nvs.
+
+    python scripts/pack_tar_shards.py --cfg cfgs/xxx.yaml --dataset train_dataset -o <out>
+"""
+
+import argparse
+import io
+import os
+import json
+import tarfile
+
+import yaml
+import numpy as np
+from tqdm import tqdm
+
+import datasets
+from datasets.nvs_shards import pack_object
+
+
+def replace_load_root(args, load_root):
+    if isinstance(args, dict):
+        return {k: replace_load_root(v, load_root) for k, v in args.items()}
+    elif isinstance(args, str):
+        return args.replace('$load_root$', load_root)
+    else:
+        return args
+
+
+class TarWriter():
+
+    def __init__(self, outdir, samples_per_shard):
+        self.outdir = outdir
+        self.samples_per_shard = samples_per_shard
+        self.shards = []
+        self.tar = None
+
+    def write(self, key, files):
+        if self.tar is None or self.shards[-1]['n'] == self.samples_per_shard:
+            self.close()
+            name = f'shard{len(self.shards):05}'
+            self.tar = tarfile.open(os.path.join(self.outdir, name + '.tar'), 'w')
+            self.shards.append({'name': name, 'n': 0})
+        for ext, data in files.items():
+            info = tarfile.TarInfo(f'{key}.{ext}')
+            info.size = len(data)
+            self.tar.addfile(info, io.BytesIO(data))
+        self.shards[-1]['n'] += 1
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+
+def npy_bytes(x):
+    f = io.BytesIO()
+    np.save(f, x)
+    return f.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cfg')
+    parser.add_argument('--dataset', default='train_dataset')
+    parser.add_argument('--load-root', default='../../data')
+    parser.add_argument('--image-size', type=int, nargs=2, default=None)
+    parser.add_argument('--samples-per-shard', type=int, default=None,
+                        help='default 5000 for image sets, 100 for NVS objects')
+    parser.add_argument('--no-shuffle', action='store_true', help='keep dataset order instead of shuffling samples')
+    parser.add_argument('--outdir', '-o')
+    args = parser.parse_args()
+
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.load(f, Loader=yaml.FullLoader)
+    dataset_spec = replace_load_root(cfg[args.dataset], args.load_root)
+    if dataset_spec['name'] == 'imgrec_dataset':
+        dataset_spec = dataset_spec['args']['imageset']
+    dataset_args = dict(dataset_spec['args'])
+    if 'repeat' in dataset_args or 'n_support' in dataset_args:
+        dataset_args['repeat'] = 1
+    dataset_args.pop('feature_cache', None)
+    dataset = datasets.make({'name': dataset_spec['name'], 'args': dataset_args})
+
+    if os.path.exists(args.outdir):
+        print('outdir exists!')
+        exit()
+    os.makedirs(args.outdir)
+
+    is_nvs = hasattr(dataset, 'load_object')
+    n = len(dataset)
+    order = np.arange(n) if args.no_shuffle else np.random.RandomState(0).permutation(n)
+    samples_per_shard = args.samples_per_shard or (100 if is_nvs else 5000)
+    writer = TarWriter(args.outdir, samples_per_shard)
+    meta = {'kind': 'nvs' if is_nvs else 'image'}
+
+    for i, index in enumerate(tqdm(order)):
+        index = int(index)
+        if is_nvs:
+            obj = dataset.load_object(index)
+            imgs, masks, cams = pack_object(obj, args.image_size)
+            if 'near' not in meta:
+                meta.update({
+                    'near': obj['near'],
+                    'far': obj['far'],
+                    'avg_intrinsics': getattr(dataset, 'avg_intrinsics', False),
+                    'has_masks': masks is not None,
+                    'cats': getattr(dataset, 'cats', []),
+                })
+            files = {
+                'json': json.dumps({'index': index, 'key': obj['key'], 'cat': obj.get('cat')}).encode(),
+                'imgs.npy': npy_bytes(imgs),
+                'cams.npy': npy_bytes(cams),
+            }
+            if meta['has_masks']:
+                files['masks.npy'] = npy_bytes(masks)
+        else:
+            path = dataset.data[index]
+            with open(path, 'rb') as f:
+                files = {os.path.splitext(path)[1][1:].lower(): f.read()}
+        writer.write(f'{i:08}', files)
+    writer.close()
+
+    meta['shards'] = writer.shards
+    meta['n_samples'] = n
+    with open(os.path.join(args.outdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
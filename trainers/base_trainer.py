@@ -20,20 +20,22 @@
 
 import os
 import os.path as osp
+import copy
 import time
+import itertools
 
 import yaml
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
 import torch.distributed as dist
-import wandb
 from tqdm import tqdm
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 from torch.utils.data.distributed import DistributedSampler
 from torch.nn.parallel import DistributedDataParallel
 
 import datasets
+from datasets.episodic import GroupedSampler
 import models
 import utils
 from trainers import register
@@ -69,6 +71,7 @@ class BaseTrainer():
                 with open('wandb.yaml', 'r') as f:
                     wandb_cfg = yaml.load(f, Loader=yaml.FullLoader)
                 os.environ['WANDB_API_KEY'] = wandb_cfg['api_key']
+                import wandb # imported only when uploading
                 wandb.init(project=wandb_cfg['project'], entity=wandb_cfg['entity'], config=cfg)
             else:
                 self.enable_wandb = False
@@ -79,13 +82,16 @@ class BaseTrainer():
             self.enable_tb = False
             self.enable_wandb = False
 
-        # Setup distributed devices
-        torch.cuda.set_device(rank)
-        self.device = torch.device('cuda', torch.cuda.current_device())
+        # Setup distributed devices, batches and the model are moved to self.device (cpu without CUDA)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(rank)
+            self.device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            self.device = torch.device('cpu')
 
         if self.distributed:
             dist_url = f"tcp://localhost:{env['port']}"
-            dist.init_process_group(backend='nccl', init_method=dist_url,
+            dist.init_process_group(backend=('nccl' if self.device.type == 'cuda' else 'gloo'), init_method=dist_url,
                                     world_size=self.tot_gpus, rank=rank)
             self.log(f'Distributed training enabled.')
 
@@ -112,12 +118,16 @@ class BaseTrainer():
         if self.enable_tb:
             self.writer.close()
         if self.enable_wandb:
+            import wandb
             wandb.finish()
 
     def make_datasets(self):
         """
             By default, train dataset performs shuffle and drop_last.
             Distributed sampler will extend the dataset with a prefix to make the length divisible by tot_gpus, samplers should be stored in .dist_samplers.
+            Datasets with .group_size (e.g. object_episodes) use GroupedSampler to keep each group contiguous.
+            Iterable datasets (e.g. tar_shards) split data over ranks themselves and are stored in .dist_samplers
+            for set_epoch().
 
             Cfg example:
 
@@ -129,34 +139,53 @@ class BaseTrainer():
         cfg = self.cfg
         self.dist_samplers = []
 
-        def make_distributed_loader(dataset, batch_size, num_workers, shuffle=False, drop_last=False):
-            sampler = DistributedSampler(dataset, shuffle=shuffle) if self.distributed else None
-            loader = DataLoader(
-                dataset,
-                batch_size // self.tot_gpus,
-                drop_last=drop_last,
-                sampler=sampler,
-                shuffle=(shuffle and (sampler is None)),
-                num_workers=num_workers // self.tot_gpus,
-                pin_memory=True)
-            return loader, sampler
-
         if cfg.get('train_dataset') is not None:
             train_dataset = datasets.make(cfg['train_dataset'])
             self.log(f'Train dataset: len={len(train_dataset)}')
             l = cfg['train_dataset']['loader']
-            self.train_loader, train_sampler = make_distributed_loader(
+            self.train_loader, self.train_sampler = self.make_distributed_loader(
                 train_dataset, l['batch_size'], l['num_workers'], shuffle=True, drop_last=True)
-            self.dist_samplers.append(train_sampler)
+            self.dist_samplers.append(self.train_sampler)
 
         if cfg.get('test_dataset') is not None:
             test_dataset = datasets.make(cfg['test_dataset'])
             self.log(f'Test dataset: len={len(test_dataset)}')
             l = cfg['test_dataset']['loader']
-            self.test_loader, test_sampler = make_distributed_loader(
+            self.test_loader, test_sampler = self.make_distributed_loader(
                 test_dataset, l['batch_size'], l['num_workers'], shuffle=False, drop_last=False)
             self.dist_samplers.append(test_sampler)
 
+    def make_distributed_loader(self, dataset, batch_size, num_workers, shuffle=False, drop_last=False, **kwargs):
+        """
+            batch_size and num_workers are split over GPUs, kwargs are passed to DataLoader.
+            Returns the loader and the object to call set_epoch() on (or None).
+        """
+        if isinstance(dataset, IterableDataset):
+            if kwargs.get('persistent_workers', False):
+                raise ValueError('persistent workers would keep the epoch of their copy of an iterable dataset')
+            # Whole batches per worker, so that all ranks run the same number of steps
+            if hasattr(dataset, 'set_batch_size'):
+                dataset.set_batch_size(batch_size // self.tot_gpus if drop_last else 1)
+            sampler = dataset
+            loader_sampler = None
+        else:
+            if hasattr(dataset, 'group_size'):
+                sampler = GroupedSampler(dataset, dataset.group_size, shuffle=shuffle,
+                                         num_replicas=self.tot_gpus, rank=self.rank)
+            else:
+                sampler = DistributedSampler(dataset, shuffle=shuffle) if self.distributed else None
+            loader_sampler = sampler
+        loader = DataLoader(
+            dataset,
+            batch_size // self.tot_gpus,
+            drop_last=drop_last,
+            sampler=loader_sampler,
+            shuffle=(shuffle and (sampler is None)),
+            num_workers=num_workers // self.tot_gpus,
+            pin_memory=(self.device.type == 'cuda'),
+            **kwargs)
+        return loader, sampler
+
     def make_model(self, model_spec=None, load_sd=False):
         if model_spec is None:
             model_spec = self.cfg['model']
@@ -165,10 +194,10 @@ class BaseTrainer():
 
         if self.distributed:
             model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
-            model.cuda()
-            model_ddp = DistributedDataParallel(model, device_ids=[self.rank])
+            model.to(self.device)
+            model_ddp = DistributedDataParallel(model, device_ids=([self.rank] if self.device.type == 'cuda' else None))
         else:
-            model.cuda()
+            model.to(self.device)
             model_ddp = model
         self.model = model
         self.model_ddp = model_ddp
@@ -186,14 +215,19 @@ class BaseTrainer():
         eval_epoch = cfg.get('eval_epoch', max_epoch)
         vis_epoch = cfg.get('vis_epoch', eval_epoch)
         save_epoch = cfg.get('save_epoch', max_epoch + 1)
+
+        if cfg.get('loader_autotune') is not None:
+            self.epoch = 1
+            self.autotune_train_loader()
+
         epoch_timer = utils.EpochTimer(max_epoch)
 
         for epoch in range(1, max_epoch + 1):
             self.epoch = epoch
             self.log_buffer = [f'Epoch {epoch}']
 
-            if self.distributed:
-                for sampler in self.dist_samplers:
+            for sampler in self.dist_samplers:
+                if sampler is not None:
                     sampler.set_epoch(epoch)
 
             self.adjust_learning_rate()
@@ -216,6 +250,108 @@ class BaseTrainer():
             self.log_buffer.append(f'{epoch_time} (d {t_data_ratio:.2f}) {tot_time}/{est_time}')
             self.log(', '.join(self.log_buffer))
 
+    def autotune_train_loader(self):
+        """
+            Before training, reads n_iters batches with each train loader setting, consuming them at a fixed model
+            time per step, and keeps the setting with the lowest data stall ratio t_data / (t_data + t_model),
+            estimated for an epoch including worker startup when workers are not persistent. n_iters should be well
+            above num_workers * prefetch_factor so that batches loaded during startup do not hide stalls.
+            Each setting is probed with its own non-persistent workers, released (and shut down by the
+            loader iterator) before the next one.
+
+            The model time is model_time (seconds per step) if given, else measured on a few train steps after
+            which the model and optimizer states are restored, so the probe does not train the model.
+            persistent_workers is not used with iterable datasets, whose workers would miss set_epoch().
+
+            Cfg example (num_workers per GPU):
+
+            loader_autotune: {n_iters: 50, num_workers: [2, 4, 8], prefetch_factor: [2, 4], persistent_workers: [true]}
+        """
+        at = self.cfg['loader_autotune']
+        n_iters = at.get('n_iters', 50)
+        dataset = self.train_loader.dataset
+        iterable = isinstance(dataset, IterableDataset)
+        default_workers = sorted({2, 4, 8, max(os.cpu_count() // self.tot_gpus, 1)})
+        settings = []
+        for nw, pf, pw in itertools.product(at.get('num_workers', default_workers), at.get('prefetch_factor', [2, 4]),
+                                            at.get('persistent_workers', [True])):
+            kwargs = {'prefetch_factor': pf, 'persistent_workers': pw and not iterable} if nw > 0 else {}
+            if (nw, kwargs) not in settings:
+                settings.append((nw, kwargs))
+
+        batch_size = self.cfg['train_dataset']['loader']['batch_size']
+        model_time = at.get('model_time')
+        if model_time is None:
+            model_time = self.measure_train_step_time()
+        self.log(f'Loader autotune: model time {model_time:.3f}s per step')
+
+        best = None
+        for nw, kwargs in settings:
+            probe_kwargs = dict(kwargs, persistent_workers=False) if nw > 0 else kwargs
+            loader, sampler = self.make_distributed_loader(
+                dataset, batch_size, nw * self.tot_gpus, shuffle=True, drop_last=True, **probe_kwargs)
+            if sampler is not None:
+                sampler.set_epoch(self.epoch)
+            n_steps = len(loader)
+            n = min(n_iters, n_steps)
+            assert n >= 2
+            t_startup, t_data = 0, 0
+            it = iter(loader)
+            for i in range(n):
+                t0 = time.time()
+                next(it)
+                t1 = time.time()
+                if i == 0:
+                    t_startup = t1 - t0
+                else:
+                    t_data += t1 - t0
+                time.sleep(model_time)
+            # Dropping the iterator of non-persistent workers shuts them down before the next setting
+            del it, loader
+
+            epoch_data = t_data / (n - 1) * n_steps
+            if not kwargs.get('persistent_workers', False):
+                epoch_data += t_startup
+            ratio = epoch_data / (epoch_data + model_time * n_steps)
+            if self.distributed:
+                x = torch.tensor(ratio, device=self.device)
+                self.dist_all_reduce_mean_(x)
+                ratio = x.item()
+            desc = ' '.join([f'num_workers={nw} (per GPU)'] + [f'{k}={v}' for k, v in kwargs.items()])
+            self.log(f'Loader autotune: {desc}: d {ratio:.3f}')
+            # Prefer earlier (cheaper) settings unless clearly better
+            if best is None or ratio < best[0] - 0.01:
+                best = (ratio, desc, nw, kwargs)
+
+        ratio, desc, nw, kwargs = best
+        self.train_loader, self.train_sampler = self.make_distributed_loader(
+            dataset, batch_size, nw * self.tot_gpus, shuffle=True, drop_last=True, **kwargs)
+        self.dist_samplers[0] = self.train_sampler # train sampler is added first in make_datasets
+        self.log(f'Loader autotune: chose {desc} (d {ratio:.3f})')
+
+    def measure_train_step_time(self, n_steps=5):
+        """
+            Seconds per train step on the first batches of the train loader, the model and optimizer states are
+            restored afterwards. Other state updated by train_step (e.g. error maps) may see these batches.
+        """
+        model_sd = copy.deepcopy(self.model.state_dict())
+        optimizer_sd = copy.deepcopy(self.optimizer.state_dict())
+        self.model_ddp.train()
+        batches = list(itertools.islice(self.train_loader, n_steps + 1))
+        assert len(batches) >= 2
+        self.train_step(batches[0]) # warm-up
+        t0 = time.time()
+        for data in batches[1:]:
+            self.train_step(data)
+        t = (time.time() - t0) / (len(batches) - 1)
+        self.model.load_state_dict(model_sd)
+        self.optimizer.load_state_dict(optimizer_sd)
+        if self.distributed:
+            x = torch.tensor(t, device=self.device)
+            self.dist_all_reduce_mean_(x)
+            t = x.item()
+        return t
+
     def adjust_learning_rate(self):
         base_lr = self.cfg['optimizer']['args']['lr']
         for param_group in self.optimizer.param_groups:
@@ -227,6 +363,7 @@ class BaseTrainer():
         if self.enable_tb:
             self.writer.add_scalar(k, v, global_step=t)
         if self.enable_wandb:
+            import wandb
             wandb.log({k: v}, step=t)
 
     def dist_all_reduce_mean_(self, x):
@@ -240,8 +377,18 @@ class BaseTrainer():
             ave_scalars[k].v = x.item()
             ave_scalars[k].n *= self.tot_gpus
 
+    def prefetch(self, loader):
+        """
+            With cfg prefetch_batches > 0, the next batches are moved to device in a background thread.
+        """
+        n = self.cfg.get('prefetch_batches', 0)
+        if n > 0:
+            loader = utils.DevicePrefetcher(loader, self.device, n_prefetch=n)
+        return loader
+
     def train_step(self, data):
-        data = {k: v.cuda() for k, v in data.items()}
+        data = {k: v.to(self.device) for k, v in data.items()}
+        utils.normalize_uint8_imgs_(data)
         loss = self.model_ddp(data)
         self.optimizer.zero_grad()
         loss.backward()
@@ -252,7 +399,7 @@ class BaseTrainer():
         self.model_ddp.train()
         ave_scalars = dict()
 
-        pbar = self.train_loader
+        pbar = self.prefetch(self.train_loader)
         if self.is_master:
             pbar = tqdm(pbar, desc='train', leave=False)
 
@@ -282,7 +429,8 @@ class BaseTrainer():
         self.log_buffer.append(logtext)
 
     def evaluate_step(self, data):
-        data = {k: v.cuda() for k, v in data.items()}
+        data = {k: v.to(self.device) for k, v in data.items()}
+        utils.normalize_uint8_imgs_(data)
         with torch.no_grad():
             loss = self.model_ddp(data)
         return {'loss': loss.item()}
@@ -291,7 +439,7 @@ class BaseTrainer():
         self.model_ddp.eval()
         ave_scalars = dict()
 
-        pbar = self.test_loader
+        pbar = self.prefetch(self.test_loader)
         if self.is_master:
             pbar = tqdm(pbar, desc='eval', leave=False)
 
@@ -0,0 +1,99 @@
+import torch
+import torch.distributed as dist
+
+
+class ErrorMaps():
+    """
+        Low-resolution per-view error maps of training objects for error-driven ray sampling.
+
+        Maps are stored in n_slots direct-mapped slots (res x res each) at a hash of obj_id * max_views + view_id,
+        a slot is reset to init_value when another view takes it, so memory is bounded by n_slots:
+        n_slots * res * res * 4 bytes on every GPU (16 MB by default). Views beyond n_slots share slots,
+        raise n_slots towards n_objects * views per object when memory allows.
+        Updates are all-gathered under DDP and applied deterministically (the last update of a slot in gathered
+        order takes it, errors are summed in sorted order), so maps stay identical on every rank.
+    """
+
+    def __init__(self, n_slots=16384, res=16, ema=0.1, max_views=256, init_value=1.0, device='cuda'):
+        self.n_slots = n_slots
+        self.res = res
+        self.ema = ema
+        self.max_views = max_views
+        self.init_value = init_value
+        self.maps = torch.full((n_slots, res * res), init_value, device=device)
+        self.tags = torch.full((n_slots,), -1, dtype=torch.long, device=device)
+
+    def _keys(self, obj_ids, view_ids):
+        assert (view_ids < self.max_views).all()
+        return obj_ids.long().unsqueeze(-1) * self.max_views + view_ids.long()
+
+    def _slots(self, keys):
+        # Multiplicative hash then range reduction, so that keys differing only in high bits spread over slots
+        h = (keys * 2654435761) & 0xffffffff
+        return (h * self.n_slots) >> 32
+
+    def _cells(self, inds, H, W):
+        pix = inds % (H * W)
+        y, x = pix // W, pix % W
+        return (y * self.res // H) * self.res + (x * self.res // W)
+
+    def sample(self, obj_ids, view_ids, H, W, n):
+        """
+            Args:
+                obj_ids: (B,), view_ids: (B, N) query views
+            Returns:
+                inds: (B, n) indices into flattened (N, H, W) pixels, drawn proportional to error
+        """
+        B, N = view_ids.shape
+        r = self.res
+        keys = self._keys(obj_ids, view_ids)
+        slots = self._slots(keys)
+        valid = (self.tags[slots] == keys).unsqueeze(-1)
+        weights = torch.where(valid, self.maps[slots], torch.full_like(self.maps[slots], self.init_value))
+        cells = torch.multinomial(weights.view(B, N * r * r).clamp(min=1e-8), n, replacement=True)
+
+        v, c = cells // (r * r), cells % (r * r)
+        y0, x0 = (c // r) * H // r, (c % r) * W // r
+        y1, x1 = (c // r + 1) * H // r, (c % r + 1) * W // r
+        y = y0 + (torch.rand(B, n, device=cells.device) * (y1 - y0)).long()
+        x = x0 + (torch.rand(B, n, device=cells.device) * (x1 - x0)).long()
+        return v * (H * W) + y * W + x
+
+    def update(self, obj_ids, view_ids, inds, errs, H, W):
+        """
+            EMA update with per-ray errors.
+
+            Args:
+                obj_ids: (B,), view_ids: (B, N), inds: (B, n) indices into flattened (N, H, W), errs: (B, n)
+        """
+        keys = torch.gather(self._keys(obj_ids, view_ids), 1, inds // (H * W)).view(-1)
+        cells = self._cells(inds, H, W).view(-1)
+        errs = errs.detach().float().view(-1)
+
+        if dist.is_available() and dist.is_initialized():
+            gathered = []
+            for x in [keys, cells, errs]:
+                lst = [torch.empty_like(x) for _ in range(dist.get_world_size())]
+                dist.all_gather(lst, x)
+                gathered.append(torch.cat(lst))
+            keys, cells, errs = gathered
+
+        # When keys collide in a slot, the last one in gathered order takes it and the others are dropped
+        slots = self._slots(keys)
+        uslots, inverse = torch.unique(slots, return_inverse=True)
+        last = torch.zeros_like(uslots).scatter_reduce_(
+            0, inverse, torch.arange(len(slots), device=slots.device), reduce='amax')
+        ukeys = keys[last]
+        keep = keys == ukeys[inverse]
+        slots, cells, errs = slots[keep], cells[keep], errs[keep]
+
+        self.maps[uslots[self.tags[uslots] != ukeys]] = self.init_value
+        self.tags[uslots] = ukeys
+
+        # Per-cell mean error from a cumsum over sorted cells, which is deterministic unlike index_add_ on CUDA
+        flat, order = torch.sort(slots * (self.res * self.res) + cells, stable=True)
+        flat, cnts = torch.unique_consecutive(flat, return_counts=True)
+        csum = torch.cumsum(errs[order].double(), 0)[torch.cumsum(cnts, 0) - 1]
+        sums = torch.diff(csum, prepend=csum.new_zeros(1))
+        maps = self.maps.view(-1)
+        maps[flat] = (1 - self.ema) * maps[flat] + self.ema * (sums / cnts).float()
@@ -1,21 +1,32 @@
+import itertools
+
 import numpy as np
 import torch
 import torchvision
 import einops
-import wandb
+from torch.utils.data import IterableDataset
 
 from .base_trainer import BaseTrainer
 from trainers import register
-from utils import make_coord_grid
+from utils import make_coord_grid, normalize_uint8_imgs_, augment_imgrec_batch
 
 
 @register('imgrec_trainer')
 class ImgrecTrainer(BaseTrainer):
 
     def make_datasets(self):
+        """
+            Cfg augment: {color_jitter: {brightness, contrast, saturation, hue}, crop_scale: [lo, hi], flip}
+            augments train batches on device.
+        """
         super().make_datasets()
 
         def get_vislist(dataset, n_vis=32):
+            if isinstance(dataset, IterableDataset):
+                # Without the shuffle buffer, which would decode shuffle_buffer samples first
+                if hasattr(dataset, 'unshuffled'):
+                    dataset = dataset.unshuffled()
+                return list(itertools.islice(dataset, n_vis))
             ids = torch.arange(n_vis) * (len(dataset) // n_vis)
             return [dataset[i] for i in ids]
 
@@ -32,7 +43,10 @@ class ImgrecTrainer(BaseTrainer):
             param_group['lr'] = lr
 
     def _iter_step(self, data, is_train):
-        data = {k: v.cuda() for k, v in data.items()}
+        data = {k: v.to(self.device) for k, v in data.items()}
+        normalize_uint8_imgs_(data)
+        if is_train and self.cfg.get('augment') is not None:
+            augment_imgrec_batch(data, **self.cfg['augment'])
         gt = data.pop('gt')
         B = gt.shape[0]
 
@@ -65,7 +79,8 @@ class ImgrecTrainer(BaseTrainer):
         self.model_ddp.eval()
         res = []
         for data in vislist:
-            data = {k: v.unsqueeze(0).cuda() for k, v in data.items()}
+            data = {k: v.unsqueeze(0).to(self.device) for k, v in data.items()}
+            normalize_uint8_imgs_(data)
             gt = data.pop('gt')[0]
             with torch.no_grad():
                 hyponet = self.model_ddp(data)
@@ -82,6 +97,7 @@ class ImgrecTrainer(BaseTrainer):
         if self.enable_tb:
             self.writer.add_image(tag, imggrid, self.epoch)
         if self.enable_wandb:
+            import wandb
             wandb.log({tag: wandb.Image(imggrid)}, step=self.epoch)
 
     def visualize_epoch(self):
@@ -1,21 +1,54 @@
+import itertools
+
 import torch
 import torchvision
 import numpy as np
 import einops
-import wandb
+from torch.utils.data import IterableDataset
 
 from .base_trainer import BaseTrainer
+from .error_maps import ErrorMaps
 from trainers import register
-from utils import poses_to_rays, volume_rendering, batched_volume_rendering
+from utils import poses_to_rays, pixels_to_rays, volume_rendering, batched_volume_rendering, normalize_uint8_imgs_, augment_nvs_batch
 
 
 @register('nvs_trainer')
 class NvsTrainer(BaseTrainer):
 
     def make_datasets(self):
+        """
+            Cfg error_sample: {uniform_ratio, n_slots, res, ema, max_views} enables error-driven ray sampling
+            (after adaptive_sample_epoch), the train dataset should set return_ids. The maps take
+            n_slots * res * res * 4 bytes per GPU (defaults 16384, 16: 16 MB), see ErrorMaps.
+            Cfg augment: {color_jitter: {brightness, contrast, saturation, hue}, flip} augments train batches on device.
+        """
         super().make_datasets()
 
+        # Ray-sampling datasets replace the sampling below, adaptive_sample_epoch is applied by set_fg_ratio()
+        if hasattr(self, 'train_loader'):
+            dataset = self.train_loader.dataset
+            if getattr(dataset, 'n_rays', None) is not None or getattr(dataset, 'query_n_rays', None) is not None:
+                for k in ['error_sample', 'augment']:
+                    if self.cfg.get(k) is not None:
+                        raise ValueError(f'the train dataset samples rays (nvs_ray_bank, query_n_rays), '
+                                         f'{k} needs whole query images')
+
+        error_sample = self.cfg.get('error_sample')
+        if error_sample is not None:
+            error_sample = dict(error_sample)
+            self.error_uniform_ratio = error_sample.pop('uniform_ratio', 0.25)
+            self.error_maps = ErrorMaps(**error_sample, device=self.device)
+        else:
+            self.error_maps = None
+
         def get_vislist(dataset, n_vis=8):
+            if hasattr(dataset, 'full_query'):
+                dataset = dataset.full_query()
+            if isinstance(dataset, IterableDataset):
+                # Without the shuffle buffer, which would decode shuffle_buffer samples first
+                if hasattr(dataset, 'unshuffled'):
+                    dataset = dataset.unshuffled()
+                return list(itertools.islice(dataset, n_vis))
             ids = torch.arange(n_vis) * (len(dataset) // n_vis)
             return [dataset[i] for i in ids]
 
@@ -35,48 +68,80 @@ class NvsTrainer(BaseTrainer):
         for param_group in self.optimizer.param_groups:
             param_group['lr'] = lr
 
+    def train_epoch(self):
+        # Datasets sampling rays themselves take the foreground ratio of _adaptive_sample_rays
+        dataset = self.train_loader.dataset
+        if hasattr(dataset, 'set_fg_ratio'):
+            dataset.set_fg_ratio(0.5 if self.epoch <= self.cfg.get('adaptive_sample_epoch', 0) else None)
+        super().train_epoch()
+
     def _adaptive_sample_rays(self, rays_o, rays_d, gt, n_sample):
-        B = gt.shape[0]
-        inds = []
+        """
+            Half of the rays are drawn from foreground (non-white) pixels, the rest uniformly, per sample on device.
+            Background pixels get a tiny weight so that they fill in when there are not enough foreground pixels.
+        """
+        B, P = gt.shape[:2]
         fg_n_sample = n_sample // 2
-        for i in range(B):
-            fg = ((gt[i].min(dim=-1).values < 1).nonzero().view(-1)).cpu().numpy()
-            if fg_n_sample <= len(fg):
-                fg = np.random.choice(fg, fg_n_sample, replace=False)
-            else:
-                fg = np.concatenate([fg, np.random.choice(fg, fg_n_sample - len(fg), replace=True)], axis=0)
-            rd = np.random.choice(rays_o.shape[1], n_sample - fg_n_sample, replace=False)
-            inds.append(np.concatenate([fg, rd], axis=0))
-
-        def subselect(x, inds):
-            t = torch.empty(B, len(inds[0]), 3, device=x.device)
-            for i in range(B):
-                t[i] = x[i][inds[i], :]
-            return t
-
-        return subselect(rays_o, inds), subselect(rays_d, inds), subselect(gt, inds)
+        fg = (gt.min(dim=-1).values < 1).float()
+        fg_inds = torch.multinomial(fg + 1e-6, fg_n_sample, replacement=False)
+        rd_inds = torch.multinomial(torch.ones(B, P, device=gt.device), n_sample - fg_n_sample, replacement=False)
+        inds = torch.cat([fg_inds, rd_inds], dim=1).unsqueeze(-1).expand(-1, -1, 3)
+        return torch.gather(rays_o, 1, inds), torch.gather(rays_d, 1, inds), torch.gather(gt, 1, inds)
 
     def _iter_step(self, data, is_train):
-        data = {k: v.cuda() for k, v in data.items()}
-        query_imgs = data.pop('query_imgs')
-        query_poses = data.pop('query_poses')
-
-        hyponet = self.model_ddp(data)
-
-        B = query_imgs.shape[0]
-        H, W = query_imgs.shape[-2:]
-        rays_o, rays_d = poses_to_rays(query_poses, H, W, data['query_focals'])
+        data = {k: v.to(self.device) for k, v in data.items()}
+        normalize_uint8_imgs_(data)
+        obj_ids = data.pop('obj_id', None)
+        query_view_ids = data.pop('query_view_ids', None)
+        ray_inds = None
+        if is_train and self.cfg.get('augment') is not None:
+            augment_nvs_batch(data, **self.cfg['augment'])
+
+        if 'query_rays_o' in data:
+            # Rays sampled by the dataset (e.g. nvs_ray_bank)
+            rays_o = data.pop('query_rays_o')
+            rays_d = data.pop('query_rays_d').float()
+            gt = data.pop('query_rgbs')
+            B = gt.shape[0]
+            hyponet = self.model_ddp(data)
+        elif 'query_pix_ids' in data:
+            # Pixels sampled by the dataset (query_n_rays)
+            pix_ids = data.pop('query_pix_ids')
+            H, W = data.pop('query_hw')[0].tolist()
+            gt = data.pop('query_rgbs')
+            query_poses = data.pop('query_poses')
+            hyponet = self.model_ddp(data)
+            B = gt.shape[0]
+            rays_o, rays_d = pixels_to_rays(query_poses, H, W, data['query_focals'], pix_ids)
+        else:
+            query_imgs = data.pop('query_imgs')
+            query_poses = data.pop('query_poses')
 
-        gt = einops.rearrange(query_imgs, 'b n c h w -> b (n h w) c')
-        rays_o = einops.rearrange(rays_o, 'b n h w c -> b (n h w) c')
-        rays_d = einops.rearrange(rays_d, 'b n h w c -> b (n h w) c')
+            hyponet = self.model_ddp(data)
 
-        n_sample = self.cfg['train_n_rays']
-        if is_train and self.epoch <= self.cfg.get('adaptive_sample_epoch', 0):
-            rays_o, rays_d, gt = self._adaptive_sample_rays(rays_o, rays_d, gt, n_sample)
-        else:
-            ray_ids = np.random.choice(rays_o.shape[1], n_sample, replace=False)
-            rays_o, rays_d, gt = map(lambda _: _[:, ray_ids, :], [rays_o, rays_d, gt])
+            B = query_imgs.shape[0]
+            H, W = query_imgs.shape[-2:]
+            rays_o, rays_d = poses_to_rays(query_poses, H, W, data['query_focals'])
+
+            gt = einops.rearrange(query_imgs, 'b n c h w -> b (n h w) c')
+            rays_o = einops.rearrange(rays_o, 'b n h w c -> b (n h w) c')
+            rays_d = einops.rearrange(rays_d, 'b n h w c -> b (n h w) c')
+
+            n_sample = self.cfg['train_n_rays']
+            if is_train and self.epoch <= self.cfg.get('adaptive_sample_epoch', 0):
+                rays_o, rays_d, gt = self._adaptive_sample_rays(rays_o, rays_d, gt, n_sample)
+            elif is_train and self.error_maps is not None:
+                assert obj_ids is not None, 'error_sample needs return_ids in the train dataset'
+                n_uniform = int(n_sample * self.error_uniform_ratio)
+                ray_inds = torch.cat([
+                    self.error_maps.sample(obj_ids, query_view_ids, H, W, n_sample - n_uniform),
+                    torch.randint(rays_o.shape[1], (B, n_uniform), device=rays_o.device),
+                ], dim=1)
+                inds = ray_inds.unsqueeze(-1).expand(-1, -1, 3)
+                rays_o, rays_d, gt = map(lambda _: torch.gather(_, 1, inds), [rays_o, rays_d, gt])
+            else:
+                ray_ids = np.random.choice(rays_o.shape[1], n_sample, replace=False)
+                rays_o, rays_d, gt = map(lambda _: _[:, ray_ids, :], [rays_o, rays_d, gt])
 
         pred = volume_rendering(
             hyponet, rays_o, rays_d,
@@ -90,6 +155,9 @@ class NvsTrainer(BaseTrainer):
         loss = mses.mean()
         psnr = (-10 * torch.log10(mses)).mean()
 
+        if ray_inds is not None:
+            self.error_maps.update(obj_ids, query_view_ids, ray_inds, ((pred - gt)**2).mean(dim=-1), H, W)
+
         if is_train:
             self.optimizer.zero_grad()
             loss.backward()
@@ -114,7 +182,8 @@ class NvsTrainer(BaseTrainer):
                     v = torch.tensor([v])
                 else:
                     v = v.unsqueeze(0)
-                data[k] = v.cuda()
+                data[k] = v.to(self.device)
+            normalize_uint8_imgs_(data)
             query_imgs = data.pop('query_imgs')
             query_poses = data.pop('query_poses')
 
@@ -153,6 +222,7 @@ class NvsTrainer(BaseTrainer):
         if self.enable_tb:
             self.writer.add_image(tag, imggrid, self.epoch)
         if self.enable_wandb:
+            import wandb
             wandb.log({tag: wandb.Image(imggrid)}, step=self.epoch)
 
     def visualize_epoch(self):
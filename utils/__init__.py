@@ -1,2 +1,3 @@
 from .common import *
 from .geometry import *
+from .augment import *
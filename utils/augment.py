@@ -0,0 +1,143 @@
+import torch
+import torch.nn.functional as F
+
+
+def _rgb_to_grayscale(x):
+    return (0.2989 * x[..., 0, :, :] + 0.587 * x[..., 1, :, :] + 0.114 * x[..., 2, :, :]).unsqueeze(-3)
+
+
+def _blend(x, y, ratio):
+    return (ratio * x + (1 - ratio) * y).clamp(0, 1)
+
+
+def _rgb_to_hsv(x):
+    r, g, b = x.unbind(dim=-3)
+    maxc = x.max(dim=-3).values
+    minc = x.min(dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack([h, s, maxc], dim=-3)
+
+
+def _hsv_to_rgb(x):
+    h, s, v = x.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.to(dtype=torch.int32)
+    p = (v * (1.0 - s)).clamp(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0.0, 1.0)
+    i = i % 6
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum('...ijk, ...xijk -> ...xjk', mask.to(dtype=x.dtype), a4)
+
+
+def adjust_color(imgs, brightness=1, contrast=1, saturation=1, hue=0):
+    """
+        Batched version of torchvision adjust_saturation, adjust_hue, adjust_contrast, adjust_brightness (in this order).
+        Factors are scalars or tensors broadcastable to imgs (..., 3, H, W), e.g. (B, 1, 1, 1) for per-image factors.
+    """
+    imgs = _blend(imgs, _rgb_to_grayscale(imgs), saturation)
+    hsv = _rgb_to_hsv(imgs)
+    h = torch.remainder(hsv[..., :1, :, :] + hue, 1.0)
+    imgs = _hsv_to_rgb(torch.cat([h, hsv[..., 1:, :, :]], dim=-3))
+    mean = _rgb_to_grayscale(imgs).mean(dim=(-3, -2, -1), keepdim=True)
+    imgs = _blend(imgs, mean, contrast)
+    return (imgs * brightness).clamp(0, 1)
+
+
+def _uniform(shape, r, center, device):
+    return center + (torch.rand(shape, device=device) * 2 - 1) * r
+
+
+def batch_color_jitter(imgs, brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1):
+    """
+        imgs: (B, ..., 3, H, W), random factors are drawn per sample (shared by the images of a sample).
+    """
+    shape = (imgs.shape[0],) + (1,) * (imgs.dim() - 1)
+    return adjust_color(
+        imgs,
+        brightness=_uniform(shape, brightness, 1, imgs.device),
+        contrast=_uniform(shape, contrast, 1, imgs.device),
+        saturation=_uniform(shape, saturation, 1, imgs.device),
+        hue=_uniform(shape, hue, 0, imgs.device),
+    )
+
+
+def batch_crop_flip(imgs, crop_scale=None, flip=False):
+    """
+        imgs: (B, 3, H, W), per image random crop with side ratio in crop_scale [lo, hi] resized back to (H, W),
+        and random horizontal flip. Implemented with a single grid_sample.
+    """
+    B = imgs.shape[0]
+    if crop_scale is None:
+        if not flip:
+            return imgs
+        f = torch.rand(B, device=imgs.device) < 0.5
+        return torch.where(f[:, None, None, None], imgs.flip(-1), imgs)
+
+    theta = torch.zeros(B, 2, 3, device=imgs.device)
+    lo, hi = crop_scale
+    s = lo + torch.rand(B, device=imgs.device) * (hi - lo)
+    theta[:, 0, 2] = (torch.rand(B, device=imgs.device) * 2 - 1) * (1 - s)
+    theta[:, 1, 2] = (torch.rand(B, device=imgs.device) * 2 - 1) * (1 - s)
+    theta[:, 0, 0] = s
+    theta[:, 1, 1] = s
+    if flip:
+        theta[:, 0, 0] *= torch.where(torch.rand(B, device=imgs.device) < 0.5, -1, 1)
+    grid = F.affine_grid(theta, imgs.shape, align_corners=False)
+    return F.grid_sample(imgs, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+def augment_imgrec_batch(data, color_jitter=None, crop_scale=None, flip=False):
+    """
+        In place on a batch of imgrec_dataset on device (after normalization), inp and gt get the same augmentation.
+        color_jitter: None or dict of batch_color_jitter ranges.
+    """
+    x = data['gt']
+    x = batch_crop_flip(x, crop_scale=crop_scale, flip=flip)
+    if color_jitter is not None:
+        x = batch_color_jitter(x, **color_jitter)
+    data['inp'] = x
+    data['gt'] = x
+    return data
+
+
+def augment_nvs_batch(data, color_jitter=None, flip=False):
+    """
+        In place on a batch of an NVS dataset on device (after normalization).
+        color_jitter: None or dict of batch_color_jitter ranges, support and query views of a sample share the factors.
+        flip: each view is flipped horizontally at random with its camera x-axis negated, so that rays stay exact.
+    """
+    assert 'query_imgs' in data, 'augmentation needs whole query images'
+    t = data['support_imgs'].shape[1]
+    keys = ['support', 'query']
+    if color_jitter is not None:
+        imgs = torch.cat([data[k + '_imgs'] for k in keys], dim=1)
+        imgs = batch_color_jitter(imgs, **color_jitter)
+        data['support_imgs'], data['query_imgs'] = imgs[:, :t], imgs[:, t:]
+    if flip:
+        assert not any(k.startswith('support_feats') for k in data.keys())
+        for k in keys:
+            imgs, poses = data[k + '_imgs'], data[k + '_poses'].clone()
+            f = torch.rand(imgs.shape[:2], device=imgs.device) < 0.5
+            data[k + '_imgs'] = torch.where(f[:, :, None, None, None], imgs.flip(-1), imgs)
+            poses[..., 0] = torch.where(f[..., None], -poses[..., 0], poses[..., 0])
+            data[k + '_poses'] = poses
+            if k + '_masks' in data:
+                data[k + '_masks'] = torch.where(f[:, :, None, None], data[k + '_masks'].flip(-1), data[k + '_masks'])
+    return data
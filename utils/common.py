@@ -1,9 +1,12 @@
 import os
+import queue
 import shutil
 import time
 import logging
+import threading
 
 import numpy as np
+import torch
 from torch.optim import SGD, Adam
 from tensorboardX import SummaryWriter
 
@@ -98,3 +101,88 @@ def time_text(secs):
         return f'{secs / 60:.1f}m'
     else:
         return f'{secs:.1f}s'
+
+
+def imgs_to_uint8(x):
+    # float images in [0, 1] -> uint8, for datasets with uint8 transport
+    return (x * 255).round().clamp(0, 255).to(torch.uint8)
+
+
+def normalize_uint8_imgs_(data):
+    # In place, uint8 image tensors of a batch -> float in [0, 1], called after transfer to device
+    for k, v in data.items():
+        if isinstance(v, torch.Tensor) and v.dtype == torch.uint8:
+            data[k] = v.float().div_(255)
+    return data
+
+
+class DevicePrefetcher():
+    """
+        Wraps a loader of dict batches and moves the next n_prefetch batches to device in a background thread,
+        on a side CUDA stream if device is cuda. Yields batches already on device.
+    """
+
+    def __init__(self, loader, device, n_prefetch=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.n_prefetch = n_prefetch
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, data):
+        return {k: (v.to(self.device, non_blocking=True) if isinstance(v, torch.Tensor) else v)
+                for k, v in data.items()}
+
+    def _worker(self, q, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            if self.device.type == 'cuda':
+                torch.cuda.set_device(self.device)
+                stream = torch.cuda.Stream(self.device)
+            else:
+                stream = None
+            for data in self.loader:
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        data = self._to_device(data)
+                        event = stream.record_event()
+                else:
+                    data, event = self._to_device(data), None
+                if not put((data, event)):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.n_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                data, event = item
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    for v in data.values():
+                        if isinstance(v, torch.Tensor):
+                            v.record_stream(stream)
+                yield data
+        finally:
+            stop.set()
+            thread.join()
@@ -62,6 +62,33 @@ def poses_to_rays(poses, image_h, image_w, focal):
     return rays_o, rays_d
 
 
+def pixels_to_rays(poses, image_h, image_w, focal, pix_ids):
+    """
+        Rays of poses_to_rays at the given pixels only.
+
+        Args:
+            poses: (b n 3 4)
+            focal: (b n 2)
+            pix_ids: (b p), indices into flattened (n image_h image_w)
+        Returns:
+            rays_o, rays_d: shape (b p 3)
+    """
+    view = pix_ids // (image_h * image_w)
+    y = (pix_ids // image_w) % image_h + 0.5
+    x = pix_ids % image_w + 0.5
+    poses = torch.gather(poses, 1, view[..., None, None].expand(-1, -1, 3, 4)) # b p 3 4
+    focal = torch.gather(focal, 1, view[..., None].expand(-1, -1, 2)) # b p 2
+    dirs = torch.stack([
+        (x - image_w / 2) / focal[..., 0],
+        -(y - image_h / 2) / focal[..., 1],
+        -torch.ones_like(x, dtype=focal.dtype)
+    ], dim=-1) # b p 3
+
+    rays_o = poses[..., -1] # b p 3
+    rays_d = (dirs.unsqueeze(-2) * poses[..., :3]).sum(dim=-1) # b p 3
+    return rays_o, rays_d
+
+
 def volume_rendering(nerf, rays_o, rays_d, near, far, points_per_ray, use_viewdirs, rand):
     """
         Args: